@@ -97,11 +97,75 @@ OAUTH_AUTHORIZE_VIEW = 'oauth_provider.views.authorize_client'
 OAUTH_CALLBACK_VIEW = 'oauth_provider.views.callback_view'
 SERVER_STMT_LIMIT = 100
 
+# Number of seconds a statements 'more' link stays valid
+STMT_MORE_TIMEOUT = 86400
+
+# Statements stored more than this many days ago are moved to the archive by archive_statements
+STMT_ARCHIVE_AFTER_DAYS = 365
+
+# When True, statement POSTs and PUTs are checked, given ids and appended to the SQLite spool at
+# STMT_SPOOL_PATH, and the process_statement_spool command saves them. A GET for a statement
+# that's still spooled can wait up to STMT_SPOOL_MAX_WAIT seconds for it
+STMT_ASYNC_INGEST = False
+STMT_SPOOL_PATH = '/var/www/adllrs/statement_spool.db'
+STMT_SPOOL_MAX_WAIT = 10
+
+# Number of statements each process keeps rendered JSON for. Set STMT_SHARED_CACHE to one
+# of the CACHES below to also share rendered statements between processes
+STMT_CACHE_SIZE = 10000
+STMT_SHARED_CACHE = None
+
+# Number of agent identifiers (mbox, mbox_sha1sum, openid, account) each process remembers the agents for.
+# A process that creates, changes or deletes an agent replaces the identifiers' versions in
+# AGENT_VERSION_CACHE, which has to be shared by every process of every host - 'default' is only
+# shared on one host, so more than one host needs one of the CACHES shared between them (memcached).
+# None doesn't remember any, every lookup goes to the database
+AGENT_CACHE_SIZE = 10000
+AGENT_VERSION_CACHE = None
+
+# Number of activity IRIs each process remembers the activities for, and how many seconds it
+# remembers an IRI isn't on record (another process may create it)
+ACTIVITY_CACHE_SIZE = 10000
+ACTIVITY_MISS_TIMEOUT = 5
+
+# Activity IRIs are fetched for their metadata by the resolve_activity_metadata command instead of
+# while statements are saved. It makes ACTIVITY_METADATA_WORKERS requests at a time, at most
+# ACTIVITY_METADATA_PER_HOST of them to the same host, waiting ACTIVITY_METADATA_TIMEOUT seconds for
+# each. Metadata it finds is fetched again after ACTIVITY_METADATA_TTL seconds, IRIs without any
+# after ACTIVITY_METADATA_MISS_TTL
+ACTIVITY_METADATA_WORKERS = 8
+ACTIVITY_METADATA_PER_HOST = 2
+ACTIVITY_METADATA_TIMEOUT = 10
+ACTIVITY_METADATA_TTL = 86400
+ACTIVITY_METADATA_MISS_TTL = 3600
+
+# Link activity IDs have to resolve. When False only their syntax is checked while statements are
+# saved and resolve_activity_metadata records whether they resolve (activity_metadata.reachable),
+# True requests them before the statement is saved and rejects the ones that don't
+ACTIVITY_LINK_CHECK_INLINE = False
+
+# Number of verb IRIs each process remembers the verb and its display for. A process that changes
+# a verb replaces its version in VERB_VERSION_CACHE, which has to be shared by every process of
+# every host - like AGENT_VERSION_CACHE, 'default' is only shared on one host. None doesn't remember
+# any, each transaction looks its verbs up in the database
+VERB_CACHE_SIZE = 1000
+VERB_VERSION_CACHE = None
+
+# Shared by the processes on a host through a memory mapped file. MAX_ENTRIES is the number of
+# SLOT_SIZE byte slots in the file, values that don't fit in a slot only live in each process'
+# local tier, which is checked first and trusted for LOCAL_TIMEOUT seconds. The file is LOCATION
+# with the slot size and count appended, changing them starts a new file - remove the old one
 CACHES = {
     'default': {
-        'BACKEND': 'django.core.cache.backends.db.DatabaseCache',
-        'LOCATION': 'cache_statement_list',
+        'BACKEND': 'lrs.MmapCache.MmapCache',
+        'LOCATION': '/var/www/adllrs/lrs_cache',
         'TIMEOUT': 86400,
+        'OPTIONS': {
+            'MAX_ENTRIES': 20000,
+            'SLOT_SIZE': 4096,
+            'LOCAL_TIMEOUT': 1,
+            'LOCAL_MAX_ENTRIES': 1000,
+        }
     }
 }
 
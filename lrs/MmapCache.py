@@ -0,0 +1,282 @@
+from collections import OrderedDict
+from django.core.cache.backends.base import BaseCache
+from django.core.exceptions import ImproperlyConfigured
+import errno
+import fcntl
+import hashlib
+import mmap
+import os
+import struct
+import threading
+import time
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+MAGIC = 'LRSCACH1'
+# magic, slot size, number of slots, access clock, hits, misses, evictions
+FILE_HEADER = struct.Struct('<8sIIQQQQ')
+# key hash, expires, last used, key length, value length
+SLOT_HEADER = struct.Struct('<QdQHI')
+# A key can only live in one of the slots of its set, the least recently used one is evicted
+SET_SIZE = 8
+
+def hash_key(key):
+    # 0 marks an empty slot
+    return struct.unpack('<Q', hashlib.sha1(key).digest()[:8])[0] or 1
+
+class MmapCache(BaseCache):
+    # Cache shared by every process on the host through a memory mapped file of fixed size
+    # slots, with a small per-process tier in front of it. LOCATION is the path of the file, which
+    # gets the layout appended so processes started with other settings never share a file
+    def __init__(self, location, params):
+        BaseCache.__init__(self, params)
+        options = params.get('OPTIONS', {})
+        self._slot_size = int(options.get('SLOT_SIZE', 4096))
+        # Round up to whole sets
+        self._num_slots = max(SET_SIZE, -(-self._max_entries // SET_SIZE) * SET_SIZE)
+        self._path = '%s.%d-%d' % (location, self._slot_size, self._num_slots)
+        # Other processes' sets and deletes can take this long to show up in the local tier
+        self._local_timeout = float(options.get('LOCAL_TIMEOUT', 1))
+        self._local_max_entries = int(options.get('LOCAL_MAX_ENTRIES', 1000))
+        self._local = OrderedDict()
+        self._local_hits = 0
+        self._lock = threading.RLock()
+        self._pid = None
+        self._fd = None
+        self._map = None
+
+    def _open(self):
+        # Locks belong to the open file, so every (forked) process needs its own
+        if self._pid == os.getpid():
+            return
+        size = FILE_HEADER.size + self._num_slots * self._slot_size
+        if not os.path.exists(self._path):
+            self._create(size)
+        self._fd = os.open(self._path, os.O_RDWR)
+        # Other processes have it mapped, so it's never truncated or rewritten here - shrinking it
+        # under them kills them with SIGBUS
+        header = os.read(self._fd, FILE_HEADER.size)
+        if len(header) < FILE_HEADER.size or FILE_HEADER.unpack(header)[:3] != (MAGIC, self._slot_size, self._num_slots) \
+                or os.fstat(self._fd).st_size != size:
+            os.close(self._fd)
+            raise ImproperlyConfigured("%s isn't a cache file laid out for %d slots of %d bytes, remove it while "
+                "nothing is using it" % (self._path, self._num_slots, self._slot_size))
+        self._map = mmap.mmap(self._fd, size)
+        self._local.clear()
+        self._pid = os.getpid()
+
+    def _create(self, size):
+        # The file is filled in under a name of its own and linked into place, so no process ever
+        # sees it half written. link fails if another process got there first, which is fine
+        tmp_path = '%s.%d.tmp' % (self._path, os.getpid())
+        fd = os.open(tmp_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0600)
+        try:
+            os.ftruncate(fd, size)
+            os.write(fd, FILE_HEADER.pack(MAGIC, self._slot_size, self._num_slots, 0, 0, 0, 0))
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        try:
+            os.link(tmp_path, self._path)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        finally:
+            os.remove(tmp_path)
+
+    def _acquire(self):
+        self._lock.acquire()
+        self._open()
+        fcntl.flock(self._fd, fcntl.LOCK_EX)
+
+    def _release(self):
+        fcntl.flock(self._fd, fcntl.LOCK_UN)
+        self._lock.release()
+
+    def _read_header(self):
+        return list(FILE_HEADER.unpack_from(self._map, 0))
+
+    def _count(self, field):
+        # field is the index into FILE_HEADER
+        header = self._read_header()
+        header[field] += 1
+        FILE_HEADER.pack_into(self._map, 0, *header)
+
+    def _tick(self):
+        header = self._read_header()
+        header[3] += 1
+        FILE_HEADER.pack_into(self._map, 0, *header)
+        return header[3]
+
+    def _slot_offset(self, slot):
+        return FILE_HEADER.size + slot * self._slot_size
+
+    def _read_slot(self, slot):
+        return SLOT_HEADER.unpack_from(self._map, self._slot_offset(slot))
+
+    def _slot_key(self, slot, key_len):
+        start = self._slot_offset(slot) + SLOT_HEADER.size
+        return self._map[start:start + key_len]
+
+    def _set_slots(self, key_hash):
+        first = (key_hash % (self._num_slots // SET_SIZE)) * SET_SIZE
+        return range(first, first + SET_SIZE)
+
+    def _find(self, key, key_hash):
+        for slot in self._set_slots(key_hash):
+            slot_hash, expires, last_used, key_len, value_len = self._read_slot(slot)
+            if slot_hash == key_hash and self._slot_key(slot, key_len) == key:
+                return slot
+        return None
+
+    def _clear_slot(self, slot):
+        SLOT_HEADER.pack_into(self._map, self._slot_offset(slot), 0, 0, 0, 0, 0)
+
+    def _get_shared(self, key, now):
+        # Returns (pickled value, expires) or None, caller holds the lock
+        key_hash = hash_key(key)
+        slot = self._find(key, key_hash)
+        if slot is not None:
+            slot_hash, expires, last_used, key_len, value_len = self._read_slot(slot)
+            if expires > now:
+                SLOT_HEADER.pack_into(self._map, self._slot_offset(slot), slot_hash, expires, self._tick(),
+                    key_len, value_len)
+                start = self._slot_offset(slot) + SLOT_HEADER.size + key_len
+                self._count(4)
+                return self._map[start:start + value_len], expires
+            self._clear_slot(slot)
+        self._count(5)
+        return None
+
+    def _set_shared(self, key, pickled, expires, now):
+        # Caller holds the lock
+        key_hash = hash_key(key)
+        slot = self._find(key, key_hash)
+        if SLOT_HEADER.size + len(key) + len(pickled) > self._slot_size:
+            # Too big to share, make sure an older value isn't left behind
+            if slot is not None:
+                self._clear_slot(slot)
+            return False
+        if slot is None:
+            # Use an empty or expired slot if there is one, otherwise evict the least recently used
+            candidates = []
+            for s in self._set_slots(key_hash):
+                slot_hash, slot_expires, last_used, key_len, value_len = self._read_slot(s)
+                if slot_hash == 0 or slot_expires <= now:
+                    slot = s
+                    break
+                candidates.append((last_used, s))
+            if slot is None:
+                slot = min(candidates)[1]
+                self._count(6)
+        offset = self._slot_offset(slot)
+        SLOT_HEADER.pack_into(self._map, offset, key_hash, expires, self._tick(), len(key), len(pickled))
+        start = offset + SLOT_HEADER.size
+        self._map[start:start + len(key) + len(pickled)] = key + pickled
+        return True
+
+    def _get_local(self, key, now):
+        entry = self._local.pop(key, None)
+        if entry is None or entry[1] <= now:
+            return None
+        self._local[key] = entry
+        self._local_hits += 1
+        return entry[0]
+
+    def _set_local(self, key, pickled, expires, now):
+        self._local.pop(key, None)
+        self._local[key] = (pickled, min(expires, now + self._local_timeout))
+        while len(self._local) > self._local_max_entries:
+            self._local.popitem(last=False)
+
+    def _get_expires(self, timeout, now):
+        if timeout is None:
+            timeout = self.default_timeout
+        return now + timeout
+
+    def add(self, key, value, timeout=None, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        pickled = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        now = time.time()
+        self._acquire()
+        try:
+            slot = self._find(key, hash_key(key))
+            if slot is not None and self._read_slot(slot)[1] > now:
+                return False
+            expires = self._get_expires(timeout, now)
+            self._set_shared(key, pickled, expires, now)
+            self._set_local(key, pickled, expires, now)
+            return True
+        finally:
+            self._release()
+
+    def get(self, key, default=None, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        now = time.time()
+        self._lock.acquire()
+        try:
+            # Local hits don't need the file lock
+            self._open()
+            pickled = self._get_local(key, now)
+            if pickled is None:
+                fcntl.flock(self._fd, fcntl.LOCK_EX)
+                try:
+                    found = self._get_shared(key, now)
+                finally:
+                    fcntl.flock(self._fd, fcntl.LOCK_UN)
+                if found is None:
+                    return default
+                pickled, expires = found
+                self._set_local(key, pickled, expires, now)
+        finally:
+            self._lock.release()
+        return pickle.loads(pickled)
+
+    def set(self, key, value, timeout=None, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        pickled = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        now = time.time()
+        expires = self._get_expires(timeout, now)
+        self._acquire()
+        try:
+            self._set_shared(key, pickled, expires, now)
+            self._set_local(key, pickled, expires, now)
+        finally:
+            self._release()
+
+    def delete(self, key, version=None):
+        key = self.make_key(key, version=version)
+        self.validate_key(key)
+        self._acquire()
+        try:
+            self._local.pop(key, None)
+            slot = self._find(key, hash_key(key))
+            if slot is not None:
+                self._clear_slot(slot)
+        finally:
+            self._release()
+
+    def clear(self):
+        self._acquire()
+        try:
+            self._local.clear()
+            for slot in range(self._num_slots):
+                self._clear_slot(slot)
+        finally:
+            self._release()
+
+    def get_stats(self):
+        # Shared counters are for every process on the host, local_hits is just this one
+        self._acquire()
+        try:
+            header = self._read_header()
+            entries = len([s for s in range(self._num_slots) if self._read_slot(s)[0]])
+        finally:
+            self._release()
+        return {'hits': header[4], 'misses': header[5], 'evictions': header[6], 'entries': entries,
+            'slots': self._num_slots, 'local_hits': self._local_hits, 'local_entries': len(self._local)}
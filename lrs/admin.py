@@ -24,6 +24,7 @@ admin.site.register(models.group)
 admin.site.register(models.agent_profile, AgentProfileAdmin)
 admin.site.register(models.activity)
 admin.site.register(models.activity_definition)
+admin.site.register(models.activity_metadata)
 admin.site.register(models.ContextActivity)
 admin.site.register(models.context)
 admin.site.register(models.activity_state)
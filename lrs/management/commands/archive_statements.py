@@ -0,0 +1,61 @@
+from datetime import datetime, timedelta
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from django.utils.timezone import utc
+from optparse import make_option
+from lrs import models
+
+BATCH_SIZE = 500
+
+@transaction.commit_on_success
+def archive_batch(cutoff):
+    # Oldest first so an interrupted run still leaves everything archived older than what's left
+    stmts = list(models.statement.objects.filter(stored__lt=cutoff).order_by('stored', 'id')[:BATCH_SIZE])
+    if not stmts:
+        return 0
+    stmt_ids = [s.id for s in stmts]
+    stmt_ct = ContentType.objects.get_for_model(models.statement)
+    contexts = dict((c.object_id, c) for c in models.context.objects.filter(content_type=stmt_ct,
+        object_id__in=stmt_ids))
+
+    archived = []
+    for stmt in stmts:
+        if not stmt.full_statement:
+            stmt.save_full_statement()
+        cntx = contexts.get(stmt.id, None)
+        archived.append(models.statement_archive(id=stmt.id, statement_id=stmt.statement_id,
+            stored=stmt.stored, authoritative=stmt.authoritative, voided=stmt.voided, actor=stmt.actor_id,
+            verb=stmt.verb_id, stmt_object=stmt.stmt_object_id, registration=cntx and cntx.registration,
+            instructor=cntx and cntx.instructor_id, authority=stmt.authority_id,
+            full_statement=stmt.full_statement))
+    models.statement_archive.objects.bulk_create(archived)
+
+    # A queryset delete takes each statement's result and context rows (and their extensions and
+    # language maps) with it, but skips statement.delete() - that would also remove the actors,
+    # verbs and objects the archive still points at. The statement rollups still count them
+    models.statement.objects.filter(id__in=stmt_ids).delete()
+    return len(stmts)
+
+class Command(NoArgsCommand):
+    args = 'None'
+    help = 'Moves statements stored more than STMT_ARCHIVE_AFTER_DAYS days ago into the statement archive.'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--days', type='int', dest='days', default=None,
+            help='Archive statements stored more than this many days ago instead'),
+    )
+
+    def handle_noargs(self, *args, **options):
+        days = options['days']
+        if days is None:
+            days = settings.STMT_ARCHIVE_AFTER_DAYS
+        cutoff = datetime.utcnow().replace(tzinfo=utc) - timedelta(days=days)
+
+        total = 0
+        count = archive_batch(cutoff)
+        while count:
+            total += count
+            count = archive_batch(cutoff)
+        self.stdout.write('Archived %d statements stored before %s\n' % (total, cutoff))
+        return
@@ -0,0 +1,31 @@
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from lrs import models
+
+BATCH_SIZE = 500
+
+@transaction.commit_on_success
+def backfill_batch():
+    stmts = list(models.statement.objects.filter(authoritative_key__isnull=True).only(
+        'id', 'actor', 'stmt_object', 'authority')[:BATCH_SIZE])
+    stmt_ct = ContentType.objects.get_for_model(models.statement)
+    context_ids = dict(models.context.objects.filter(content_type=stmt_ct,
+        object_id__in=[s.id for s in stmts]).values_list('object_id', 'id'))
+    for stmt in stmts:
+        models.statement.objects.filter(id=stmt.id).update(
+            authoritative_key=stmt.get_authoritative_key(context_ids.get(stmt.id, None)))
+    return len(stmts)
+
+class Command(NoArgsCommand):
+    args = 'None'
+    help = 'Sets authoritative_key on statements stored before the column existed.'
+
+    def handle_noargs(self, *args, **options):
+        total = 0
+        count = backfill_batch()
+        while count:
+            total += count
+            count = backfill_batch()
+        self.stdout.write('Set authoritative_key on %d statements\n' % total)
+        return
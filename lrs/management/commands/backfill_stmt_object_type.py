@@ -0,0 +1,16 @@
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from lrs.models import statement_object, stmt_object_models
+
+class Command(NoArgsCommand):
+    args = 'None'
+    help = 'Sets stmt_object_type on statement objects created before the column existed.'
+
+    @transaction.commit_on_success
+    def handle_noargs(self, *args, **options):
+        # One UPDATE per subclass table - groups are agents so they are picked up with them
+        for type_name, model in stmt_object_models.items():
+            count = statement_object.objects.filter(stmt_object_type__isnull=True,
+                id__in=model.objects.values('pk')).update(stmt_object_type=type_name)
+            self.stdout.write('Set %s stmt_object_type on %d rows\n' % (type_name, count))
+        return
@@ -0,0 +1,91 @@
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db import connection
+from itertools import combinations
+from lrs import models
+from lrs.util import retrieve_statement
+import re
+
+FILTERS = ('since', 'until', 'object', 'related_activities', 'verb', 'registration', 'actor', 'instructor')
+SQLITE_SCAN = re.compile(r'^SCAN (TABLE )?lrs_')
+# With nothing to filter on, the newest statements are read off the end of the (stored, id) index
+SQLITE_ORDER_SCAN = re.compile(r'^SCAN (TABLE )?lrs_statement USING (COVERING )?INDEX lrs_statement_stored_id\b')
+
+def format_time(dt):
+    # convert_to_utc expects an offset on the end
+    return dt.strftime(retrieve_statement.CURSOR_TIME_FORMAT) + '+00:00'
+
+def get_filter_values():
+    # Pull real values out of the seeded data so every filter resolves to something
+    values = {}
+    stmts = models.statement.objects.order_by('stored')
+    if stmts.exists():
+        values['since'] = format_time(stmts[0].stored)
+        values['until'] = format_time(stmts.reverse()[0].stored)
+        values['verb'] = stmts[0].verb.verb_id
+    acts = models.activity.objects.filter(object_of_statement__isnull=False)[:1]
+    if acts:
+        values['object'] = {'objectType': 'Activity', 'id': acts[0].activity_id}
+    # Also combined without object, where complex_get has to ignore it
+    values['related_activities'] = 'true'
+    actors = models.agent.objects.filter(actor_statement__isnull=False, mbox__isnull=False)[:1]
+    if actors:
+        values['actor'] = {'mbox': actors[0].mbox}
+    stmt_ct = ContentType.objects.get_for_model(models.statement)
+    cntxs = models.context.objects.filter(content_type=stmt_ct)
+    if cntxs:
+        values['registration'] = cntxs[0].registration
+    inst_cntxs = cntxs.filter(instructor__mbox__isnull=False)[:1]
+    if inst_cntxs:
+        values['instructor'] = {'mbox': inst_cntxs[0].instructor.mbox}
+    return values
+
+def explain(sql, params, filtered=True):
+    cursor = connection.cursor()
+    if connection.vendor == 'sqlite':
+        cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        # SCAN ... USING INDEX still reads the whole index, only SEARCH narrows it down
+        return [row[-1] for row in cursor.fetchall() if SQLITE_SCAN.match(row[-1])
+            and (filtered or not SQLITE_ORDER_SCAN.match(row[-1]))]
+    cursor.execute('EXPLAIN ' + sql, params)
+    rows = cursor.fetchall()
+    if connection.vendor == 'postgresql':
+        return [row[0] for row in rows if 'Seq Scan' in row[0]]
+    if connection.vendor == 'mysql':
+        columns = [c[0] for c in cursor.description]
+        return ['Full scan on %s' % row[columns.index('table')] for row in rows
+            if row[columns.index('type')] == 'ALL']
+    raise CommandError('EXPLAIN checking is not supported for %s' % connection.vendor)
+
+class Command(NoArgsCommand):
+    args = 'None'
+    help = 'Runs EXPLAIN on every complex_get filter combination and fails if any of them scans a whole table.'
+
+    def handle_noargs(self, *args, **options):
+        values = get_filter_values()
+        missing = [f for f in FILTERS if not f in values]
+        if missing:
+            self.stdout.write('No seeded data for %s - combinations using them are skipped\n' % ', '.join(missing))
+        filters = [f for f in FILTERS if f in values]
+
+        if connection.vendor == 'postgresql':
+            # Small seeded tables make sequential scans look cheap, only use them when there is no index
+            connection.cursor().execute('SET enable_seqscan = off')
+
+        failures = 0
+        for num in range(len(filters) + 1):
+            for combo in combinations(filters, num):
+                for authoritative in ('true', 'false'):
+                    query = dict((f, values[f]) for f in combo)
+                    query['authoritative'] = authoritative
+                    stmt_set = retrieve_statement.complex_get(query)
+                    sql, params = stmt_set[:retrieve_statement.get_limit(query) + 1].query.sql_with_params()
+                    # related_activities only widens an object filter
+                    scans = explain(sql, params, bool([f for f in combo if f != 'related_activities']))
+                    if scans:
+                        failures += 1
+                        self.stdout.write('SCAN %s: %s\n' % (query, '; '.join(scans)))
+        if failures:
+            raise CommandError('%d statement queries scan a whole table' % failures)
+        self.stdout.write('Every statement query uses an index\n')
+        return
@@ -0,0 +1,121 @@
+from datetime import datetime
+from django.core.management.base import NoArgsCommand, CommandError
+from optparse import make_option
+from lrs import models
+from lrs.util import retrieve_statement
+from lrs.util.hydrator import StatementHydrator
+import gzip
+import json
+import os
+import pytz
+
+def parse_time(value):
+    # Same format as the more cursors, always UTC
+    try:
+        return pytz.timezone("UTC").localize(datetime.strptime(value, retrieve_statement.CURSOR_TIME_FORMAT))
+    except ValueError:
+        raise CommandError('Times must look like %s' % datetime(2013, 1, 2, 3, 4, 5, 6).strftime(
+            retrieve_statement.CURSOR_TIME_FORMAT))
+
+def read_watermark(path):
+    # ((stored, id) of the last statement written, size of the output file after it) - the size is
+    # None when writing to stdout. None to start from the beginning
+    if not path or not os.path.exists(path):
+        return None
+    with open(path) as f:
+        fields = f.read().strip().split(' ')
+    size = int(fields[2]) if len(fields) > 2 and fields[2] != '-' else None
+    return (parse_time(fields[0]), int(fields[1])), size
+
+def write_watermark(path, stmt, size):
+    # Written to a temp file and renamed over the old one so a crash never leaves half of it
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        # Stored is always UTC in the DB
+        f.write('%s %d %s\n' % (stmt.stored.strftime(retrieve_statement.CURSOR_TIME_FORMAT), stmt.id,
+            '-' if size is None else size))
+    os.rename(tmp_path, path)
+
+def open_output(path, size):
+    # Cuts off whatever was written after the watermark - a batch that didn't get to move it, or
+    # an unfinished gzip member - so a resume neither repeats lines nor leaves a corrupt file
+    if size is None or not os.path.exists(path):
+        return open(path, 'wb')
+    f = open(path, 'r+b')
+    f.truncate(size)
+    f.seek(size)
+    return f
+
+def iter_batches(since, until, cursor, batch_size):
+    # Archived statements were all stored before the ones in the statement table, so going through
+    # the archive and then the table is one ascending (stored, id) walk
+    for model in (models.statement_archive, models.statement):
+        stmt_set = model.objects.order_by('stored', 'id')
+        if since:
+            stmt_set = stmt_set.filter(stored__gte=since)
+        if until:
+            stmt_set = stmt_set.filter(stored__lt=until)
+        while True:
+            batch = list(retrieve_statement.after_cursor(stmt_set, True, cursor)[:batch_size])
+            if not batch:
+                break
+            yield batch
+            cursor = (batch[-1].stored, batch[-1].id)
+
+class Command(NoArgsCommand):
+    args = 'None'
+    help = ('Writes statements out as newline delimited JSON in (stored, id) order. Run one per '
+        '--since/--until range to export in parallel, and use --watermark to resume where a run stopped. '
+        'Resuming into a file drops anything written after the watermark, output to stdout repeats the '
+        'batch that was being written when the run stopped.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--output', dest='output', default='-',
+            help='File to write to (continued when resuming), - for stdout'),
+        make_option('--gzip', action='store_true', dest='gzip', default=False,
+            help='Gzip the output, one gzip member per batch'),
+        make_option('--since', dest='since', default=None,
+            help='Only statements stored at or after this UTC time'),
+        make_option('--until', dest='until', default=None,
+            help='Only statements stored before this UTC time'),
+        make_option('--watermark', dest='watermark', default=None,
+            help='File holding the last statement written - read on start and updated after every batch'),
+        make_option('--batch', type='int', dest='batch', default=1000,
+            help='Statements read and rendered per query'),
+    )
+
+    def handle_noargs(self, *args, **options):
+        since = parse_time(options['since']) if options['since'] else None
+        until = parse_time(options['until']) if options['until'] else None
+        watermark = options['watermark']
+        cursor, size = read_watermark(watermark) or (None, 0)
+        to_file = options['output'] != '-'
+
+        if to_file:
+            f = open_output(options['output'], size if cursor else None)
+        else:
+            f = self.stdout
+
+        count = 0
+        try:
+            for batch in iter_batches(since, until, cursor, options['batch']):
+                # Each batch is a whole gzip member, members can be concatenated
+                out = gzip.GzipFile(fileobj=f, mode='wb') if options['gzip'] else f
+                hydrator = StatementHydrator(batch)
+                for stmt in batch:
+                    out.write(json.dumps(hydrator.get_statement_json(stmt)))
+                    out.write('\n')
+                if options['gzip']:
+                    # Writes the member's trailer, f stays open
+                    out.close()
+                f.flush()
+                if to_file:
+                    os.fsync(f.fileno())
+                # A crash before this line redoes the batch on resume, so nothing is ever skipped
+                if watermark:
+                    write_watermark(watermark, batch[-1], f.tell() if to_file else None)
+                count += len(batch)
+        finally:
+            if to_file:
+                f.close()
+        self.stderr.write('Exported %d statements\n' % count)
+        return
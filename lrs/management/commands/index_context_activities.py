@@ -0,0 +1,36 @@
+from django.contrib.contenttypes.models import ContentType
+from django.core.management.base import NoArgsCommand
+from django.db import transaction
+from lrs import models
+
+# Three query variables a row, keeps bulk inserts under sqlite's limit
+BATCH_SIZE = 300
+
+@transaction.commit_on_success
+def index_batch(after_id):
+    # Adds whatever the next batch of statement context activities is missing from
+    # statement_context_activity, returns the last ContextActivity id looked at
+    stmt_ct = ContentType.objects.get_for_model(models.statement)
+    con_acts = list(models.ContextActivity.objects.filter(id__gt=after_id, context__content_type=stmt_ct)
+        .order_by('id').values_list('id', 'context_activity', 'key', 'context__object_id')[:BATCH_SIZE])
+    if not con_acts:
+        return None
+    stmt_ids = set(c[3] for c in con_acts)
+    indexed = set(models.statement_context_activity.objects.filter(statement__in=stmt_ids).values_list(
+        'activity_iri', 'key', 'statement'))
+    missing = set((iri, key, stmt_id) for ca_id, iri, key, stmt_id in con_acts) - indexed
+    models.statement_context_activity.objects.bulk_create([models.statement_context_activity(
+        activity_iri=iri, key=key, statement=stmt_id) for iri, key, stmt_id in missing])
+    return con_acts[-1][0]
+
+class Command(NoArgsCommand):
+    args = 'None'
+    help = 'Fills in statement_context_activity for statements stored before it existed.'
+
+    def handle_noargs(self, *args, **options):
+        last_id = index_batch(0)
+        while last_id is not None:
+            last_id = index_batch(last_id)
+        self.stdout.write('Indexed %d statement context activities\n' %
+            models.statement_context_activity.objects.count())
+        return
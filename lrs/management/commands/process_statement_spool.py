@@ -0,0 +1,61 @@
+from django.conf import settings
+from django.core.management.base import NoArgsCommand, CommandError
+from django.db import connection
+from optparse import make_option
+from lrs.util import statement_spool
+import fcntl
+import time
+
+# Longest wait between tries of an entry that couldn't be saved
+MAX_BACKOFF = 60
+
+class Command(NoArgsCommand):
+    args = 'None'
+    help = ('Saves the statements accepted while STMT_ASYNC_INGEST is on, in the order they were accepted. '
+        'Only one can run against a spool at a time. An entry that fails for any reason but its statements '
+        '(the database being down) is tried again, waiting longer each time, with --once it stops the command.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--once', action='store_true', dest='once', default=False,
+            help='Stop once the spool is empty instead of waiting for more'),
+        make_option('--interval', type='float', dest='interval', default=1.0,
+            help='Seconds to wait before looking at an empty spool again'),
+        make_option('--retry-failed', action='store_true', dest='retry_failed', default=False,
+            help='Try the entries that failed to save again'),
+    )
+
+    def handle_noargs(self, *args, **options):
+        # Entries have to be saved in order, so only one worker runs at a time
+        lock = open(settings.STMT_SPOOL_PATH + '.lock', 'a')
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            lock.close()
+            raise CommandError('Another process_statement_spool is already running')
+
+        try:
+            if options['retry_failed']:
+                self.stdout.write('Retrying %d failed entries\n' % statement_spool.retry_failed())
+            count = 0
+            backoff = options['interval']
+            while True:
+                try:
+                    while statement_spool.process_next():
+                        count += 1
+                        backoff = options['interval']
+                except Exception, e:
+                    # The same entry is next again, the ones after it wait so the order holds
+                    if options['once']:
+                        raise CommandError('Stopped after %d spooled entries: %s' % (count, e))
+                    self.stderr.write('Retrying in %.1f seconds: %s\n' % (backoff, e))
+                    # Reconnects on the next query
+                    connection.close()
+                    time.sleep(backoff)
+                    backoff = min(backoff * 2, MAX_BACKOFF)
+                    continue
+                if options['once']:
+                    break
+                time.sleep(options['interval'])
+        finally:
+            lock.close()
+        self.stdout.write('Processed %d spooled entries\n' % count)
+        return
@@ -0,0 +1,12 @@
+from django.core.management.base import NoArgsCommand
+from lrs.util import statement_rollups
+
+class Command(NoArgsCommand):
+    args = 'None'
+    help = ('Recounts the statement rollups from every stored statement, archived or not. Statements '
+        'saved, voided or deleted while it runs can be missed, so run it with ingest stopped.')
+
+    def handle_noargs(self, *args, **options):
+        count = statement_rollups.rebuild()
+        self.stdout.write('Rebuilt %d statement rollups\n' % count)
+        return
@@ -0,0 +1,28 @@
+from django.core.management.base import NoArgsCommand
+from optparse import make_option
+from lrs.util import activity_metadata
+import time
+
+class Command(NoArgsCommand):
+    args = 'None'
+    help = ('Fetches the activity IDs statements have asked about for their metadata, and fills in the '
+        'definitions of the activities with the ones it finds. Also records whether link IDs resolve.')
+    option_list = NoArgsCommand.option_list + (
+        make_option('--once', action='store_true', dest='once', default=False,
+            help='Stop once nothing is waiting to be fetched instead of waiting for more'),
+        make_option('--interval', type='float', dest='interval', default=5.0,
+            help='Seconds to wait before looking for IDs to fetch again'),
+    )
+
+    def handle_noargs(self, *args, **options):
+        count = 0
+        while True:
+            resolved = activity_metadata.resolve()
+            while resolved:
+                count += resolved
+                resolved = activity_metadata.resolve()
+            if options['once']:
+                break
+            time.sleep(options['interval'])
+        self.stdout.write('Fetched %d activity IDs\n' % count)
+        return
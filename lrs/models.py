@@ -1,5 +1,6 @@
 from django.db import models
 from django.db import transaction
+from django.db.models.signals import post_delete, post_save, pre_save
 from django.conf import settings
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
@@ -12,6 +13,7 @@ import datetime as dt
 from django.utils.timezone import utc
 from lrs.exceptions import IDNotFoundError, ParamError
 import ast
+import hashlib
 import pytz
 import json
 import logging
@@ -362,9 +364,31 @@ class score(models.Model):
 
 
 class statement_object(models.Model):
+    # Which subclass table holds this object - written when the object is created
+    stmt_object_type = models.CharField(max_length=12, blank=True, null=True, db_index=True)
+    type_name = None
+
     def get_a_name(self):
         return "please override"
 
+    def save(self, *args, **kwargs):
+        if not self.stmt_object_type:
+            self.stmt_object_type = self.type_name
+        super(statement_object, self).save(*args, **kwargs)
+
+    def get_typed_object(self, allowed_types):
+        # Rows created before stmt_object_type existed fall back to probing each table
+        if self.stmt_object_type:
+            types = [t for t in allowed_types if t == self.stmt_object_type]
+        else:
+            types = allowed_types
+        for t in types:
+            try:
+                return stmt_object_models[t].objects.get(id=self.id), t
+            except stmt_object_models[t].DoesNotExist:
+                pass
+        return None, None
+
 agent_attrs_can_only_be_one = ('mbox', 'mbox_sha1sum', 'openid', 'account')
 class agentmgr(models.Manager):
     def gen(self, **kwargs):
@@ -432,6 +456,7 @@ class agentmgr(models.Manager):
         return ret_agent, created
 
 class agent(statement_object):
+    type_name = 'agent'
     objectType = models.CharField(max_length=200, blank=True, default="Agent")
     name = models.CharField(max_length=200, blank=True, null=True)
     mbox = models.CharField(max_length=200, blank=True, null=True, db_index=True)
@@ -553,6 +578,7 @@ class agent_profile(models.Model):
 
 
 class activity(statement_object):
+    type_name = 'activity'
     activity_id = models.CharField(max_length=200, db_index=True)
     objectType = models.CharField(max_length=200,blank=True, null=True, default="Activity") 
     authoritative = models.CharField(max_length=200, blank=True, null=True)
@@ -618,6 +644,8 @@ class activity_definition(models.Model):
     interactionType = models.CharField(max_length=200, blank=True, null=True)
     activity = models.OneToOneField(activity)
     extensions = generic.GenericRelation(extensions)
+    # sha1 of the last definition a statement sent that was applied, see lrs.objects.Activity
+    definition_hash = models.CharField(max_length=40, null=True, blank=True)
 
     def object_return(self, lang=None):
         ret = {}
@@ -799,6 +827,7 @@ class activity_definition_step(models.Model):
 
 
 class StatementRef(statement_object):
+    type_name = 'statementref'
     object_type = models.CharField(max_length=12, default="StatementRef")
     ref_id = models.CharField(max_length=200)
     context = models.OneToOneField('context', blank=True, null=True)
@@ -823,7 +852,7 @@ class ContextActivity(models.Model):
 
 
 class context(models.Model):    
-    registration = models.CharField(max_length=200)
+    registration = models.CharField(max_length=200, db_index=True)
     instructor = models.ForeignKey(agent,blank=True, null=True, on_delete=models.SET_NULL)
     team = models.ForeignKey(group,blank=True, null=True, on_delete=models.SET_NULL, related_name="context_team")
     revision = models.CharField(max_length=200,blank=True, null=True)
@@ -898,6 +927,7 @@ class activity_profile(models.Model):
 
 
 class SubStatement(statement_object):
+    type_name = 'substatement'
     stmt_object = models.ForeignKey(statement_object, related_name="object_of_substatement")
     actor = models.ForeignKey(agent,related_name="actor_of_substatement")
     verb = models.ForeignKey(Verb)
@@ -910,20 +940,12 @@ class SubStatement(statement_object):
         return self.stmt_object.statement_id
     
     def object_return(self, sparse=False, lang=None):
-        activity_object = True
         ret = {}
         ret['actor'] = self.actor.get_agent_json(sparse)
         ret['verb'] = self.verb.object_return()
 
-        try:
-            stmt_object = activity.objects.get(id=self.stmt_object.id)
-        except activity.DoesNotExist:
-            try:
-                stmt_object = agent.objects.get(id=self.stmt_object.id)
-                activity_object = False
-            except agent.DoesNotExist:
-                raise IDNotFoundError('No activity or agent object found with given ID')
-        if activity_object:
+        stmt_object, object_type = self.get_object()
+        if object_type == 'activity':
             ret['object'] = stmt_object.object_return(sparse, lang)  
         else:
             ret['object'] = stmt_object.get_agent_json(sparse)
@@ -938,17 +960,9 @@ class SubStatement(statement_object):
         return ret
 
     def get_object(self):
-        stmt_object = None
-        object_type = None
-        try:
-            stmt_object = activity.objects.get(id=self.stmt_object.id)
-            object_type = 'activity'
-        except activity.DoesNotExist:
-            try:
-                stmt_object = agent.objects.get(id=self.stmt_object.id)
-                object_type = 'agent'
-            except agent.DoesNotExist:
-                raise IDNotFoundError("No activity, or agent found with given ID")
+        stmt_object, object_type = self.stmt_object.get_typed_object(('activity', 'agent'))
+        if stmt_object is None:
+            raise IDNotFoundError("No activity, or agent found with given ID")
         return stmt_object, object_type
 
     def delete(self, *args, **kwargs):
@@ -1075,8 +1089,66 @@ class SubStatement(statement_object):
             stmt_object.delete()
 
 
+def filter_lang_map(lang_map, lang):
+    return dict((k, v) for k, v in lang_map.items() if k == lang)
+
+def filter_agent_json(ret, sparse):
+    # Sparse agents leave out their openid and account
+    if sparse:
+        ret.pop('openid', None)
+        ret.pop('account', None)
+
+def filter_activity_json(ret, lang):
+    if lang is not None and 'definition' in ret:
+        act_def = ret['definition']
+        act_def['name'] = filter_lang_map(act_def['name'], lang)
+        act_def['description'] = filter_lang_map(act_def['description'], lang)
+        for key in ('scale', 'choices', 'steps', 'source', 'target'):
+            for component in act_def.get(key, []):
+                component['description'] = filter_lang_map(component['description'], lang)
+
+def filter_stmt_object_json(ret, sparse, lang):
+    # Agents and groups are the only objects without an id
+    if not 'id' in ret:
+        filter_agent_json(ret, sparse)
+    elif ret.get('objectType') != 'StatementRef':
+        filter_activity_json(ret, lang)
+
+def filter_context_json(ret, sparse):
+    # Team members are always returned in full
+    if 'instructor' in ret:
+        filter_agent_json(ret['instructor'], sparse)
+
+def filter_stmt_json(ret, sparse=False, lang=None):
+    # Derives the sparse and single language formats from a full statement
+    filter_agent_json(ret['actor'], sparse)
+    if lang is not None and 'display' in ret['verb']:
+        ret['verb']['display'] = filter_lang_map(ret['verb']['display'], lang)
+        if not ret['verb']['display']:
+            del ret['verb']['display']
+    if 'authority' in ret:
+        filter_agent_json(ret['authority'], sparse)
+    if 'context' in ret:
+        filter_context_json(ret['context'], sparse)
+
+    stmt_object = ret['object']
+    if stmt_object.get('objectType') == 'SubStatement':
+        filter_agent_json(stmt_object['actor'], sparse)
+        filter_stmt_object_json(stmt_object['object'], sparse, lang)
+        if 'context' in stmt_object:
+            filter_context_json(stmt_object['context'], sparse)
+    else:
+        filter_stmt_object_json(stmt_object, sparse, lang)
+    return ret
+
+def invalidate_rendered_statements(stmt_ids):
+    # lrs.util imports the models so this can't be imported at the top
+    from lrs.util import statement_cache
+    statement_cache.invalidate(stmt_ids)
+
 class statement(models.Model):
-    statement_id = models.CharField(max_length=200)
+    # Composite indexes for statement queries are created by sql/statement.sql
+    statement_id = models.CharField(max_length=200, db_index=True)
     stmt_object = models.ForeignKey(statement_object, related_name="object_of_statement")
     actor = models.ForeignKey(agent,related_name="actor_statement")
     verb = models.ForeignKey(Verb)
@@ -1088,32 +1160,34 @@ class statement(models.Model):
     context = generic.GenericRelation(context)
     authoritative = models.BooleanField(default=True)
     user = models.ForeignKey(User, null=True, blank=True)
+    # Full JSON of the statement as it was stored - voided is the only part that can change
+    full_statement = models.TextField(blank=True, null=True)
+    # Shared by the statements a new one makes non-authoritative, see get_authoritative_key
+    authoritative_key = models.CharField(max_length=40, blank=True, null=True)
 
     def get_a_name(self):
         return self.statement_id
 
     def get_stmt_object(self):
-        object_type = 'activity'
-        try:
-            stmt_object = activity.objects.get(id=self.stmt_object.id)
-        except activity.DoesNotExist:
-            try:
-                stmt_object = agent.objects.get(id=self.stmt_object.id)
-                object_type = 'agent'
-            except agent.DoesNotExist:
-                try:
-                    stmt_object = SubStatement.objects.get(id=self.stmt_object.id)
-                    object_type = 'substatement'            
-                except SubStatement.DoesNotExist:
-                    try:
-                        stmt_object = StatementRef.objects.get(id=self.stmt_object.id)
-                        object_type = 'statementref'
-                    except Exception, e:
-                        raise IDNotFoundError("No activity, agent, substatement, or statementref found with given ID")
+        stmt_object, object_type = self.stmt_object.get_typed_object(
+            ('activity', 'agent', 'substatement', 'statementref'))
+        if stmt_object is None:
+            raise IDNotFoundError("No activity, agent, substatement, or statementref found with given ID")
         return (stmt_object, object_type)
 
     def object_return(self, sparse=False, lang=None):
-        object_type = 'activity'
+        if not self.full_statement:
+            return self.build_json(sparse, lang)
+        ret = filter_stmt_json(json.loads(self.full_statement), sparse, lang)
+        ret['voided'] = self.voided
+        return ret
+
+    def save_full_statement(self):
+        # Render from a fresh copy of the row so field values look the same as they do on reads
+        self.full_statement = json.dumps(statement.objects.get(id=self.id).build_json())
+        statement.objects.filter(id=self.id).update(full_statement=self.full_statement)
+
+    def build_json(self, sparse=False, lang=None):
         ret = {}
         ret['id'] = self.statement_id
         ret['actor'] = self.actor.get_agent_json(sparse)
@@ -1141,45 +1215,34 @@ class statement(models.Model):
         ret['voided'] = self.voided
         return ret
 
+    def get_authoritative_key(self, context_id=None):
+        # Statements with the same actor, object, authority and context share a key. A statement's
+        # context is saved after it is, so a new statement replaces the ones without a context
+        # and one with a context is keyed by it from then on
+        return hashlib.sha1('%s|%s|%s|%s' % (self.actor_id, self.stmt_object_id, self.authority_id or '',
+            context_id or '')).hexdigest()
+
     def save(self, *args, **kwargs):
-        stmts = statement.objects.filter(actor=self.actor, stmt_object=self.stmt_object, authority=self.authority)
-        cs = self.context.all()
-        # narrow down list of statements to just those that have the same number of
-        # context relations.. should be 0 or 1
-        sl = [x for x in stmts if len(x.context.all()) == len(cs)]
-        if len(cs) > 0:
-            # if self has context, check to see if the statement has the same context
-            sl = [s for s in sl if s.context.all()[0].id == cs.context.all().id]
-        
-        for s in sl:
-            statement.objects.filter(id=s.id).update(authoritative=False)
+        if self.pk is None:
+            # One indexed UPDATE (sql/statement.sql) makes the statements this one replaces
+            # non-authoritative. authoritative isn't part of the rendered JSON so nothing cached changes
+            self.authoritative_key = self.get_authoritative_key()
+            statement.objects.filter(authoritative_key=self.authoritative_key, authoritative=True).update(
+                authoritative=False)
         super(statement, self).save(*args, **kwargs)
 
     def get_object(self):
-        stmt_object = None
-        object_type = None
-        try:
-            stmt_object = activity.objects.get(id=self.stmt_object.id)
-            object_type = 'activity'
-        except activity.DoesNotExist:
-            try:
-                stmt_object = agent.objects.get(id=self.stmt_object.id)
-                object_type = 'agent'
-            except agent.DoesNotExist:
-                try:
-                    stmt_object = SubStatement.objects.get(id=self.stmt_object.id)
-                    object_type = 'substatement'
-                except SubStatement.DoesNotExist:
-                    try:
-                        stmt_object = StatementRef.objects.get(id=self.stmt_object.id)
-                        object_type = 'statementref'
-                    except Exception, e:
-                        raise IDNotFoundError("No activity, agent, substatement, or statementref found with given ID")
-        return stmt_object, object_type
+        return self.get_stmt_object()
 
     def unvoid_statement(self):
+        from lrs.util import statement_rollups
         statement_ref = StatementRef.objects.get(id=self.stmt_object.id)
+        for model in (statement, statement_archive):
+            for voided_stmt in model.objects.filter(statement_id=statement_ref.ref_id, voided=True):
+                statement_rollups.count_statement(voided_stmt, 1)
         voided_stmt = statement.objects.filter(statement_id=statement_ref.ref_id).update(voided=False)
+        statement_archive.objects.filter(statement_id=statement_ref.ref_id).update(voided=False)
+        invalidate_rendered_statements([statement_ref.ref_id])
 
     def check_usage(self, links, obj, num):
         in_use = False
@@ -1391,6 +1454,156 @@ class statement(models.Model):
 
 
 
+class statement_archive(models.Model):
+    # A statement moved out of the statement table by the archive_statements command. It keeps
+    # the statement's pk, so (stored, id) cursors carry on across both tables, and the columns
+    # the query filters need. actor, verb and stmt_object hold the pks the statement pointed at
+    # as plain integers so nothing cascades into the archive. Composite indexes are in
+    # sql/statement_archive.sql
+    statement_id = models.CharField(max_length=200, db_index=True)
+    stored = models.DateTimeField()
+    authoritative = models.BooleanField(default=True)
+    voided = models.NullBooleanField(blank=True, null=True)
+    actor = models.IntegerField(db_column='actor_id')
+    verb = models.IntegerField(db_column='verb_id')
+    stmt_object = models.IntegerField(db_column='stmt_object_id')
+    registration = models.CharField(max_length=200, blank=True, null=True, db_index=True)
+    instructor = models.IntegerField(db_column='instructor_id', blank=True, null=True, db_index=True)
+    authority = models.IntegerField(db_column='authority_id', blank=True, null=True)
+    full_statement = models.TextField()
+
+    def object_return(self, sparse=False, lang=None):
+        ret = filter_stmt_json(json.loads(self.full_statement), sparse, lang)
+        ret['voided'] = self.voided
+        return ret
+
+class statement_context_activity(models.Model):
+    # The activities each statement names in its contextActivities, written along with its
+    # ContextActivity rows so statements can be found by parent, grouping or other activity
+    # without going through the generic context relation. statement is the statement's pk,
+    # archived or not. The (activity_iri, key, statement_id) index is in
+    # sql/statement_context_activity.sql
+    activity_iri = models.CharField(max_length=200)
+    key = models.CharField(max_length=20)
+    statement = models.IntegerField(db_column='statement_id')
+
+class activity_metadata(models.Model):
+    # What lrs.util.activity_metadata found at an activity IRI. definition is the parsed metadata
+    # as JSON, null when the IRI had none, and reachable whether it resolved at all (null until
+    # it's fetched). link is set for link IDs, only whether those resolve is recorded. requested is
+    # set while the IRI waits to be fetched
+    activity_id = models.CharField(max_length=200, unique=True)
+    definition = models.TextField(null=True)
+    reachable = models.NullBooleanField()
+    link = models.BooleanField(default=False)
+    expires = models.DateTimeField(null=True)
+    requested = models.DateTimeField(null=True, db_index=True)
+
+class spooled_batch(models.Model):
+    # The spool entries lrs.util.statement_spool saved, written in the same transaction as their
+    # statements. A worker that stopped before it took an entry out of the spool can tell its own
+    # save apart from statements someone else saved with the same ids
+    entry = models.CharField(max_length=64, unique=True)
+    saved = models.DateTimeField(auto_now_add=True)
+
+class statement_rollup(models.Model):
+    # How many unvoided statements were stored each day for a verb, activity and authority, kept
+    # by lrs.util.statement_rollups as statements are saved, voided and deleted. Archiving leaves
+    # it alone. The pks are plain integers, 0 when the object isn't an activity or there's no
+    # authority. More indexes are in sql/statement_rollup.sql
+    day = models.DateField()
+    verb = models.IntegerField(db_column='verb_id')
+    activity = models.IntegerField(db_column='activity_id')
+    authority = models.IntegerField(db_column='authority_id')
+    count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('day', 'verb', 'activity', 'authority')
+
+class statement_watermark(models.Model):
+    # Moved whenever statements change without a newer one being stored (deletes, which can also
+    # unvoid) - conditional GETs on statements check it along with the latest stored time
+    changed = models.DateTimeField()
+
+def bump_statement_watermark(sender, **kwargs):
+    now = datetime.utcnow().replace(tzinfo=utc)
+    watermark, created = statement_watermark.objects.get_or_create(id=1, defaults={'changed': now})
+    if not created:
+        statement_watermark.objects.filter(id=1).update(changed=now)
+post_delete.connect(bump_statement_watermark, sender=statement)
+
+def forget_deleted_statement(sender, instance, **kwargs):
+    invalidate_rendered_statements([instance.statement_id])
+post_delete.connect(forget_deleted_statement, sender=statement)
+
+def uncount_deleted_statement(sender, instance, **kwargs):
+    from lrs.util import statement_rollups
+    statement_rollups.statement_deleted(instance)
+post_delete.connect(uncount_deleted_statement, sender=statement)
+
+def forget_context_activities(sender, instance, **kwargs):
+    # Archived statements keep theirs
+    if not statement_archive.objects.filter(id=instance.id).exists():
+        statement_context_activity.objects.filter(statement=instance.id).delete()
+post_delete.connect(forget_context_activities, sender=statement)
+
+# Keep the agent identifier cache in lrs.util.agent_resolver coherent - merges are a delete
+# and a save so they're covered too. lrs.util imports the models so it can't be imported at the top
+def forget_saved_agent(sender, instance, created, **kwargs):
+    from lrs.util import agent_resolver
+    agent_resolver.agent_saved(instance, created)
+
+def forget_deleted_agent(sender, instance, **kwargs):
+    from lrs.util import agent_resolver
+    agent_resolver.agent_deleted(instance)
+
+def forget_agent_account(sender, instance, **kwargs):
+    from lrs.util import agent_resolver
+    agent_resolver.account_changed(instance)
+
+for agent_model in (agent, group):
+    post_save.connect(forget_saved_agent, sender=agent_model)
+    post_delete.connect(forget_deleted_agent, sender=agent_model)
+post_save.connect(forget_agent_account, sender=agent_account)
+post_delete.connect(forget_agent_account, sender=agent_account)
+
+# Same for the activity IRI cache in lrs.util.activity_resolver
+def forget_activity(sender, instance, **kwargs):
+    from lrs.util import activity_resolver
+    activity_resolver.activity_changed(instance)
+post_save.connect(forget_activity, sender=activity)
+post_delete.connect(forget_activity, sender=activity)
+
+# And the verb registry in lrs.util.verb_registry, new verbs aren't in anyone's yet
+def forget_renamed_verb(sender, instance, **kwargs):
+    from lrs.util import verb_registry
+    if instance.pk:
+        for verb_id in Verb.objects.filter(pk=instance.pk).exclude(verb_id=instance.verb_id).values_list('verb_id', flat=True):
+            verb_registry.verb_changed(verb_id)
+
+def forget_saved_verb(sender, instance, created, **kwargs):
+    from lrs.util import verb_registry
+    if not created:
+        verb_registry.verb_changed(instance.verb_id)
+
+def forget_deleted_verb(sender, instance, **kwargs):
+    from lrs.util import verb_registry
+    verb_registry.verb_changed(instance.verb_id)
+
+def forget_verb_display(sender, instance, **kwargs):
+    from lrs.util import verb_registry
+    verb_registry.lang_map_changed(instance)
+
+pre_save.connect(forget_renamed_verb, sender=Verb)
+post_save.connect(forget_saved_verb, sender=Verb)
+post_delete.connect(forget_deleted_verb, sender=Verb)
+post_save.connect(forget_verb_display, sender=LanguageMap)
+post_delete.connect(forget_verb_display, sender=LanguageMap)
+
+# Maps statement_object.stmt_object_type to the subclass holding the row
+stmt_object_models = {'activity': activity, 'agent': agent, 'substatement': SubStatement,
+    'statementref': StatementRef}
+
 # - from http://djangosnippets.org/snippets/2283/
 # @transaction.commit_on_success
 def merge_model_objects(primary_object, alias_objects=[], save=True, keep_old=False):
@@ -1,27 +1,31 @@
 import json
-import urllib2
 import datetime
 from StringIO import StringIO
 from lrs import models, exceptions
-from lrs.util import log_message, update_parent_log_status
+from lrs.util import activity_metadata, commit_on_success_unless_managed, log_message, update_parent_log_status
 from lxml import etree
 from django.conf import settings
 from django.core.exceptions import ValidationError
 from django.core.validators import URLValidator
-from django.db import transaction
 import pdb
 import pprint
 import ast
+import hashlib
 import logging
 
 logger = logging.getLogger('user_system_actions')
 
+def get_definition_hash(definition):
+    # Same definition, same hash - whatever order the keys came in
+    return hashlib.sha1(json.dumps(definition, sort_keys=True, separators=(',', ':'))).hexdigest()
+
 class Activity():
     # Activity definition required fields
     ADRFs = ['name', 'description', 'type']
 
-    # URL Validator
+    # URL Validators - the first one requests the URL, see ACTIVITY_LINK_CHECK_INLINE
     validator = URLValidator(verify_exists=True)
+    syntax_validator = URLValidator()
 
     # XMLschema for Activity IDs
     try:
@@ -39,8 +43,10 @@ class Activity():
         can_validate_xml = False
 
     # Use single transaction for all the work done in function
-    @transaction.commit_on_success
-    def __init__(self, data, auth=None, log_dict=None):
+    @commit_on_success_unless_managed
+    def __init__(self, data, auth=None, log_dict=None, known=None):
+        # The batch's activities, see Statement.preload
+        self.known = known
         if auth:
             if auth.__class__.__name__ == 'group':
                 self.auth = auth.name
@@ -70,114 +76,11 @@ class Activity():
 
 
     def validateID(self,act_id):
-        validXML = False
-        resolves = True
-
         log_message(self.log_dict, "Validating Activity ID", __name__, self.validateID.__name__)
 
-        #Retrieve XML doc since function is only called when not a link. ID should either not resolve or 
-        #only conform to the TC schema - if it fails that means the URL didn't resolve at all
-        try:    
-            act_resp = urllib2.urlopen(act_id, timeout=10)
-        except Exception, e:
-            resolves = False
-        else:
-            act_XML = act_resp.read()
-
-        #Validate that it is good XML with the schema - if it fails it means the URL resolved but didn't conform to the schema
-        if resolves and Activity.can_validate_xml:
-            try:
-                act_xmlschema_doc = etree.parse(StringIO(act_XML))    
-                validXML = Activity.XMLschema.validate(act_xmlschema_doc)
-            except Exception, e:
-                #TODO: should put any warning here? validXML will still be false if there is an exception
-                self.activity.delete()
-                self.activity = None
-                err_msg = "The activity id resolved to invalid activity description"
-                log_message(self.log_dict, err_msg, __name__, self.parse.__name__, True) 
-                update_parent_log_status(self.log_dict, 400)                    
-                raise exceptions.ParamError(err_msg)
-
-        #Parse XML, create dictionary with the values from the XML doc
-        if validXML:
-            return self.parseXML(act_xmlschema_doc)
-        else:
-            return {}
-
-    # TODO: Thought xml was taken out? Need to update parsing of it then for name and desc?
-    def parseXML(self, xmldoc):
-        #Create namespace and get the root
-        ns = {'tc':'http://projecttincan.com/tincan.xsd'}
-        root = xmldoc.getroot()
-        act_def = {}
-
-        log_message(self.log_dict, "Parsing Activity XML", __name__, self.parseXML.__name__)                     
-
-        #Parse the name (required)
-        if len(root.xpath('//tc:activities/tc:activity/tc:name', namespaces=ns)) > 0:
-            act_def['name'] = {}
-
-            for element in root.xpath('//tc:activities/tc:activity/tc:name', namespaces=ns):
-                lang = element.get('lang')
-                act_def['name'][lang] = element.text
-        else:
-            err_msg = "XML is missing name"
-            log_message(self.log_dict, err_msg, __name__, self.parseXML.__name__, True) 
-            update_parent_log_status(self.log_dict, 400)                                
-            raise exceptions.ParamError(err_msg)
-            
-        #Parse the description (required)    
-        if len(root.xpath('//tc:activities/tc:activity/tc:description', namespaces=ns)) > 0:
-            act_def['description'] = {}
-            
-            for element in root.xpath('//tc:activities/tc:activity/tc:description', namespaces=ns):
-                lang = element.get('lang')
-                act_def['description'][lang] = element.text
-        else:
-            err_msg = "XML is missing description"
-            log_message(self.log_dict, err_msg, __name__, self.parseXML.__name__, True)
-            update_parent_log_status(self.log_dict, 400)
-            raise exceptions.ParamError(err_msg)
-            
-        #Parse the interactionType (required)
-        if root.xpath('//tc:activities/tc:activity/tc:interactionType/text()', namespaces=ns)[0]:
-            act_def['interactionType'] = root.xpath('//tc:activities/tc:activity/tc:interactionType/text()', namespaces=ns)[0]
-        else:
-            err_msg = "XML is missing interactionType"
-            log_message(self.log_dict, err_msg, __name__, self.parseXML.__name__, True)  
-            update_parent_log_status(self.log_dict, 400)          
-            raise exceptions.ParamError(err_msg)
-
-        #Parse the type (required)
-        if root.xpath('//tc:activities/tc:activity/@type', namespaces=ns)[0]:
-            act_def['type'] = root.xpath('//tc:activities/tc:activity/@type', namespaces=ns)[0]
-        else:
-            err_msg = "XML is missing type"
-            log_message(self.log_dict, err_msg, __name__, self.parseXML.__name__, True)
-            update_parent_log_status(self.log_dict, 400)
-            raise exceptions.ParamError(err_msg)
-
-        #Parse extensions if any
-        if root.xpath('//tc:activities/tc:activity/tc:extensions', namespaces=ns) is not None:
-            extensions = {}
-            extensionTags = root.xpath('//tc:activities/tc:activity/tc:extensions/tc:extension', namespaces=ns)
-            
-            for tag in extensionTags:
-                extensions[tag.get('key')] = tag.text
-
-            act_def['extensions'] = extensions
-
-        #Parse correctResponsesPattern if any
-        if root.xpath('//tc:activities/tc:activity/tc:correctResponsesPattern', namespaces=ns) is not None:
-            crList = []
-            correctResponseTags = root.xpath('//tc:activities/tc:activity/tc:correctResponsesPattern/tc:correctResponsePattern', namespaces=ns)
-                
-            for cr in correctResponseTags:    
-                crList.append(cr.text)
-
-            act_def['correctResponsesPattern'] = crList
-
-        return act_def
+        # Fetching the ID here would hold the statement up for as long as its host takes to answer.
+        # The resolve_activity_metadata command fetches it instead, this is what it found last
+        return activity_metadata.get_definition(act_id, self.known and self.known['metadata'])
 
     #Save activity definition to DB
     def save_activity_definition_to_db(self,act_def_type, intType):
@@ -199,10 +102,24 @@ class Activity():
 
         return created
 
-    def check_activity_definition_value(self, new_name_value, existing_name_value):
-        return new_name_value == existing_name_value
-
-    def update_activity_name_and_description(self, new_activity, existing_activity):
+    def update_lang_map(self, lang_maps, new_lang_map, parent, replace=False):
+        # Writes only the languages that are new or have a different value. replace also removes
+        # the languages new_lang_map doesn't have
+        existing = dict(lang_maps.values_list('key', 'value'))
+        if replace:
+            removed = [key for key in existing if key not in new_lang_map]
+            if removed:
+                lang_maps.filter(key__in=removed).delete()
+        added = []
+        for key, value in new_lang_map.items():
+            if key not in existing:
+                added.append(lang_maps.model(key=key, value=value, content_object=parent))
+            elif existing[key] != value:
+                lang_maps.filter(key=key).update(value=value)
+        if added:
+            lang_maps.model.objects.bulk_create(added)
+
+    def update_activity_name_and_description(self, new_activity, existing_activity, replace=False):
         # Try grabbing the activity definition (these aren't required)
         existing_act_def = None        
         try:
@@ -213,21 +130,7 @@ class Activity():
         # If there is an existing activity definition and the names or descriptions are different,
         # update it with new name and/or description info
         if existing_act_def:
-            # Get list of existing name lang maps
-            existing_name_lang_map_set = existing_act_def.name.all()
-
-            # Make lists of keys and values from existing name lang maps
-            existing_name_key_set = existing_name_lang_map_set.values_list('key', flat=True)
-
-            # Get list of existing desc lang maps
-            existing_desc_lang_map_set = existing_act_def.description.all()
-
-            # Make lists of keys and values from existing desc lang maps
-            existing_desc_key_set = existing_desc_lang_map_set.values_list('key', flat=True)
-
-            # Loop through all language maps in name
             the_definition = new_activity
-            
             try:
                 the_names = the_definition['name']
             except KeyError:
@@ -235,42 +138,16 @@ class Activity():
                 log_message(self.log_dict, err_msg, __name__, self.update_activity_name_and_description.__name__, True)
                 update_parent_log_status(self.log_dict, 400)
                 raise exceptions.ParamError(err_msg)
-            for new_name_lang_map in the_names.items():
-                # If there is already an entry in the same language
-                if new_name_lang_map[0] in existing_name_key_set:
-                    name_same = True                    
-                    # Retrieve existing language map with same key (all in the existing act_def)
-                    existing_lang_map = existing_act_def.name.get(key=new_name_lang_map[0])
-                    name_same = self.check_activity_definition_value(new_name_lang_map[1], existing_lang_map.value)
-                    # If names are different, update the language map with the new name
-                    if not name_same:
-                        existing_act_def.name.filter(id=existing_lang_map.id).update(value=new_name_lang_map[1])
-                # Else it's a new lang map and needs added
-                else:
-                    existing_act_def.name.create(key=new_name_lang_map[0], value=new_name_lang_map[1])
-                    existing_act_def.save()                    
+            self.update_lang_map(existing_act_def.name.all(), the_names, existing_act_def, replace)
 
-            # Loop through all language maps in description
             try:
                 the_descriptions = the_definition['description']
             except KeyError:
                 err_msg = "Activity definition has no description attribute"
                 log_message(self.log_dict, err_msg, __name__, self.update_activity_name_and_description.__name__, True)
                 update_parent_log_status(self.log_dict, 400)
-                raise exceptions.ParamError()
-            for new_desc_lang_map in the_descriptions.items():
-                # If there is already an entry in the same language
-                if new_desc_lang_map[0] in existing_desc_key_set:
-                    desc_same = False
-                    # Retrieve existing language map with same key (all in the existing act_def)
-                    existing_lang_map = existing_act_def.description.get(key=new_desc_lang_map[0])
-                    desc_same = self.check_activity_definition_value(new_desc_lang_map[1], existing_lang_map.value)
-                    # If desc are different, update the langage map with the new desc
-                    if not desc_same:
-                        existing_act_def.description.filter(id=existing_lang_map.id).update(value=new_desc_lang_map[1])
-                else:
-                    existing_act_def.description.create(key=new_desc_lang_map[0], value=new_desc_lang_map[1])
-                    existing_act_def.save()                    
+                raise exceptions.ParamError(err_msg)
+            self.update_lang_map(existing_act_def.description.all(), the_descriptions, existing_act_def, replace)
 
     #Once JSON is verified, populate the activity objects
     def populate(self, the_object):        
@@ -283,7 +160,14 @@ class Activity():
             update_parent_log_status(self.log_dict, 400)          
             raise exceptions.ParamError(err_msg)
 
-        self.activity, act_created = models.activity.objects.get_or_create(activity_id=activity_id)
+        if self.known is not None and activity_id in self.known['activities']:
+            self.activity, act_created = self.known['activities'][activity_id], False
+        else:
+            self.activity, act_created = models.activity.objects.get_or_create(activity_id=activity_id)
+            if self.known is not None:
+                self.known['activities'][activity_id] = self.activity
+                if act_created:
+                    self.known['definition_hashes'][self.activity.pk] = None
         if act_created: 
             log_message(self.log_dict, "Populating Activity - created Activity in database", __name__, self.populate.__name__)            
             if self.auth:
@@ -304,21 +188,40 @@ class Activity():
             #from the XML - else just save the activity (someone sent in an ID that doesn't resolve and an objectType
             #with no other data)                
             if xml_data:
-                self.populate_definition(xml_data, act_created)
+                self.populate_definition(xml_data, act_created, from_id=True)
         
         #Definition is provided
         else:
             self.validate_definition(the_object, act_created)
 
+    def definition_applied(self, definition_hash):
+        if self.known is not None and self.activity.pk in self.known['definition_hashes']:
+            return self.known['definition_hashes'][self.activity.pk] == definition_hash
+        return models.activity_definition.objects.filter(activity=self.activity, definition_hash=definition_hash).exists()
+
     def validate_definition(self, the_object, act_created):
         activity_definition = the_object['definition']
         activity_id = self.activity.activity_id
+        definition_hash = get_definition_hash(activity_definition)
+
+        # Tools send the same definition with every statement, there's nothing to do when it's the
+        # one that was last applied. Someone without authority still gets turned away below
+        if not act_created and (self.activity.authoritative is None or self.activity.authoritative == self.auth) \
+            and self.definition_applied(definition_hash):
+            log_message(self.log_dict, "Activity definition unchanged", __name__, self.validate_definition.__name__)
+            return
+
         #Verify the given activity_id resolves if it is a link (has to resolve if link) 
         xml_data = {}
         try:
             if activity_definition['type'] == 'link':
                 try:
-                    Activity.validator(activity_id)
+                    if settings.ACTIVITY_LINK_CHECK_INLINE:
+                        Activity.validator(activity_id)
+                    else:
+                        # Whether it resolves is checked by resolve_activity_metadata
+                        Activity.syntax_validator(activity_id)
+                        activity_metadata.check_link(activity_id, self.known and self.known['metadata'])
                 except ValidationError, e:
                     if act_created:
                         self.activity.delete()
@@ -340,11 +243,13 @@ class Activity():
             update_parent_log_status(self.log_dict, 400)
             raise exceptions.ParamError(err_msg)
         
-        #If the returned data is not empty, it overrides any JSON data sent in
+        #If the returned data is not empty, it overrides any JSON data sent in - and the hash, so the
+        #definition is checked against the ID again next time
         if xml_data:
             activity_definition = xml_data
+            definition_hash = None
         #If the URL did not resolve and is not type link, it will use the JSON data provided
-        self.populate_definition(activity_definition, act_created)
+        self.populate_definition(activity_definition, act_created, definition_hash)
         
     # Save language map object for activity definition name or description
     def save_lang_map(self, lang_map, parent):
@@ -440,11 +345,12 @@ class Activity():
         return interaction_flag
 
     #Populate definition either from JSON or validated XML
-    def populate_definition(self, act_def, act_created):
+    def populate_definition(self, act_def, act_created, definition_hash=None, from_id=False):
         log_message(self.log_dict, "Populating activity definition", __name__, self.populate_definition.__name__)
 
-        # only update existing def stuff if request has authority to do so
-        if not act_created and (self.activity.authoritative is not None and self.activity.authoritative != self.auth):
+        # only update existing def stuff if request has authority to do so - whoever controls the ID has
+        # authority over the definition found there
+        if not act_created and not from_id and (self.activity.authoritative is not None and self.activity.authoritative != self.auth):
             err_msg = "This ActivityID already exists, and you do not have the correct authority to create or update it."
             log_message(self.log_dict, err_msg, __name__, self.populate_definition.__name__, True)
             update_parent_log_status(self.log_dict, 403)
@@ -468,11 +374,16 @@ class Activity():
             interaction_flag = self.validate_cmi_interaction(act_def, act_created)
 
         act_def_created = self.save_activity_definition_to_db(act_def['type'], act_def.get('interactionType', None))
+        # The metadata at the ID can be fetched after a statement already gave the activity a definition
+        if from_id and not act_def_created:
+            models.activity_definition.objects.filter(activity=self.activity).update(activity_definition_type=act_def['type'],
+                interactionType=act_def.get('interactionType', None))
 
         if not act_created: 
-            if self.activity.authoritative is None or self.activity.authoritative == self.auth:
+            if from_id or self.activity.authoritative is None or self.activity.authoritative == self.auth:
                 # Update name and desc if needed
-                self.update_activity_name_and_description(act_def, self.activity)
+                # The definition at the ID replaces whatever statements gave the activity
+                self.update_activity_name_and_description(act_def, self.activity, replace=from_id)
             else:
                 err_msg = "This ActivityID already exists, and you do not have the correct authority to create or update it."
                 log_message(self.log_dict, err_msg, __name__, self.populate_definition.__name__, True)
@@ -511,6 +422,11 @@ class Activity():
         if act_def_created and 'extensions' in act_def.keys():
             self.populate_extensions(act_def) 
 
+        # So the same definition is skipped next time
+        models.activity_definition.objects.filter(activity=self.activity).update(definition_hash=definition_hash)
+        if self.known is not None:
+            self.known['definition_hashes'][self.activity.pk] = definition_hash
+
     def populate_correctResponsesPattern(self, act_def, interactionFlag):
         crp = models.activity_def_correctresponsespattern(activity_definition=self.activity.activity_definition)
         crp.save()
@@ -607,3 +523,91 @@ class Activity():
             act_def_ext = models.extensions(key=k, value=v,
                 content_object=self.activity.activity_definition)
             act_def_ext.save()    
+
+# TODO: Thought xml was taken out? Need to update parsing of it then for name and desc?
+def parse_xml(xmldoc, log_dict=None):
+    #Create namespace and get the root
+    ns = {'tc':'http://projecttincan.com/tincan.xsd'}
+    root = xmldoc.getroot()
+    act_def = {}
+
+    log_message(log_dict, "Parsing Activity XML", __name__, parse_xml.__name__)                     
+
+    #Parse the name (required)
+    if len(root.xpath('//tc:activities/tc:activity/tc:name', namespaces=ns)) > 0:
+        act_def['name'] = {}
+
+        for element in root.xpath('//tc:activities/tc:activity/tc:name', namespaces=ns):
+            lang = element.get('lang')
+            act_def['name'][lang] = element.text
+    else:
+        err_msg = "XML is missing name"
+        log_message(log_dict, err_msg, __name__, parse_xml.__name__, True) 
+        update_parent_log_status(log_dict, 400)                                
+        raise exceptions.ParamError(err_msg)
+
+    #Parse the description (required)    
+    if len(root.xpath('//tc:activities/tc:activity/tc:description', namespaces=ns)) > 0:
+        act_def['description'] = {}
+
+        for element in root.xpath('//tc:activities/tc:activity/tc:description', namespaces=ns):
+            lang = element.get('lang')
+            act_def['description'][lang] = element.text
+    else:
+        err_msg = "XML is missing description"
+        log_message(log_dict, err_msg, __name__, parse_xml.__name__, True)
+        update_parent_log_status(log_dict, 400)
+        raise exceptions.ParamError(err_msg)
+
+    #Parse the interactionType (required)
+    if root.xpath('//tc:activities/tc:activity/tc:interactionType/text()', namespaces=ns)[0]:
+        act_def['interactionType'] = root.xpath('//tc:activities/tc:activity/tc:interactionType/text()', namespaces=ns)[0]
+    else:
+        err_msg = "XML is missing interactionType"
+        log_message(log_dict, err_msg, __name__, parse_xml.__name__, True)  
+        update_parent_log_status(log_dict, 400)          
+        raise exceptions.ParamError(err_msg)
+
+    #Parse the type (required)
+    if root.xpath('//tc:activities/tc:activity/@type', namespaces=ns)[0]:
+        act_def['type'] = root.xpath('//tc:activities/tc:activity/@type', namespaces=ns)[0]
+    else:
+        err_msg = "XML is missing type"
+        log_message(log_dict, err_msg, __name__, parse_xml.__name__, True)
+        update_parent_log_status(log_dict, 400)
+        raise exceptions.ParamError(err_msg)
+
+    #Parse extensions if any
+    if root.xpath('//tc:activities/tc:activity/tc:extensions', namespaces=ns) is not None:
+        extensions = {}
+        extensionTags = root.xpath('//tc:activities/tc:activity/tc:extensions/tc:extension', namespaces=ns)
+
+        for tag in extensionTags:
+            extensions[tag.get('key')] = tag.text
+
+        act_def['extensions'] = extensions
+
+    #Parse correctResponsesPattern if any
+    if root.xpath('//tc:activities/tc:activity/tc:correctResponsesPattern', namespaces=ns) is not None:
+        crList = []
+        correctResponseTags = root.xpath('//tc:activities/tc:activity/tc:correctResponsesPattern/tc:correctResponsePattern', namespaces=ns)
+
+        for cr in correctResponseTags:    
+            crList.append(cr.text)
+
+        act_def['correctResponsesPattern'] = crList
+
+    return act_def
+
+def read_metadata(xml):
+    # The definition in the document an activity ID resolved to, {} unless it's valid against the
+    # tincan schema. Entities and network access are off, the document comes from anyone
+    if not Activity.can_validate_xml:
+        return {}
+    try:
+        xmldoc = etree.parse(StringIO(xml), etree.XMLParser(resolve_entities=False, no_network=True))
+        if not Activity.XMLschema.validate(xmldoc):
+            return {}
+        return parse_xml(xmldoc)
+    except Exception:
+        return {}
@@ -1,6 +1,6 @@
 from lrs import models
 from lrs.exceptions import IDNotFoundError
-from lrs.util import etag, get_user_from_auth, log_message, update_parent_log_status
+from lrs.util import activity_resolver, etag, get_user_from_auth, log_message, update_parent_log_status
 from django.core.files.base import ContentFile
 from django.core.exceptions import ValidationError
 import json
@@ -26,7 +26,7 @@ class ActivityProfile():
 
         #Check if activity exists
         try:
-            activity = models.activity.objects.get(activity_id=request_dict['activityId'])
+            activity_pk = activity_resolver.get_activity_pk(request_dict['activityId'])
         except models.activity.DoesNotExist:
             err_msg = 'There is no activity associated with the id: %s' % request_dict['activityId']
             log_message(self.log_dict, err_msg, __name__, self.put_profile.__name__, True)
@@ -35,7 +35,7 @@ class ActivityProfile():
 
         user = get_user_from_auth(request_dict.get('auth', None))
         #Get the profile, or if not already created, create one
-        p,created = models.activity_profile.objects.get_or_create(profileId=request_dict['profileId'],activity=activity, user=user)
+        p,created = models.activity_profile.objects.get_or_create(profileId=request_dict['profileId'],activity_id=activity_pk, user=user)
         
         if created:
             log_message(self.log_dict, "Created Activity Profile", __name__, self.put_profile.__name__)
@@ -72,7 +72,7 @@ class ActivityProfile():
         log_message(self.log_dict, "Getting profile with profile id: %s -- activity id: %s" % (profileId, activityId),
             __name__, self.get_profile.__name__)
         try:
-            activity = models.activity.objects.get(activity_id=activityId)
+            activity_pk = activity_resolver.get_activity_pk(activityId)
         except models.activity.DoesNotExist:
             err_msg = 'There is no activity associated with the id: %s' % activityId
             log_message(self.log_dict, err_msg, __name__, self.get_profile.__name__, True)
@@ -81,7 +81,7 @@ class ActivityProfile():
 
         #Retrieve the profile with the given profileId and activity
         try:
-            return models.activity_profile.objects.get(profileId=profileId, activity=activity)
+            return models.activity_profile.objects.get(profileId=profileId, activity_id=activity_pk)
         except models.activity_profile.DoesNotExist:
             err_msg = 'There is no profile associated with the id: %s' % profileId
             log_message(self.log_dict, err_msg, __name__, self.get_profile.__name__, True)
@@ -94,7 +94,7 @@ class ActivityProfile():
 
         #make sure activityId exists
         try:
-            activity = models.activity.objects.get(activity_id=activityId)
+            activity_pk = activity_resolver.get_activity_pk(activityId)
         except models.activity.DoesNotExist:
             err_msg = 'There is no activity associated with the id: %s' % activityId
             log_message(self.log_dict, err_msg, __name__, self.get_profile_ids.__name__, True)
@@ -104,15 +104,15 @@ class ActivityProfile():
         #If there is a since param return all profileIds since then
         if since:
             try:
-                profs = models.activity_profile.objects.filter(updated__gte=since, profileId=profileId, activity=activity)
+                profs = models.activity_profile.objects.filter(updated__gte=since, profileId=profileId, activity_id=activity_pk)
             except ValidationError:
                 since_i = int(float(since))
                 since_dt = datetime.datetime.fromtimestamp(since_i)
-                profs = models.activity_profile_set.filter(update__gte=since_dt, profileId=profileId, activity=activity)
+                profs = models.activity_profile_set.filter(update__gte=since_dt, profileId=profileId, activity_id=activity_pk)
             ids = [p.profileId for p in profs]
         else:
             #Return all IDs of profiles associated with this activity b/c there is no since param
-            ids = models.activity_profile.objects.filter(activity=activity).values_list('profileId', flat=True)
+            ids = models.activity_profile.objects.filter(activity_id=activity_pk).values_list('profileId', flat=True)
         return ids
 
     def delete_profile(self, request_dict):
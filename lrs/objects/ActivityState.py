@@ -1,7 +1,7 @@
 from lrs import models
 from lrs.objects.Agent import Agent
 from lrs.exceptions import IDNotFoundError #, Forbidden
-from lrs.util import etag, get_user_from_auth, log_message, update_parent_log_status
+from lrs.util import activity_resolver, etag, get_user_from_auth, log_message, update_parent_log_status
 from django.core.files.base import ContentFile
 from django.core.validators import URLValidator
 from django.db import transaction
@@ -18,7 +18,7 @@ class ActivityState():
         self.auth = request_dict.get('auth', None)
         self.user = get_user_from_auth(self.auth)
         try:
-            self.activity = models.activity.objects.get(activity_id=request_dict['activityId'])
+            self.activity_pk = activity_resolver.get_activity_pk(request_dict['activityId'])
         except models.activity.DoesNotExist:
             err_msg = "Error with Activity State. The activity id (%s) did not match any activities on record" % (request_dict['activityId'])
             log_message(self.log_dict, err_msg, __name__, self.__init__.__name__, True)
@@ -46,9 +46,9 @@ class ActivityState():
                 state = ContentFile(str(self.state))
 
         if self.registrationId:
-            p,created = models.activity_state.objects.get_or_create(state_id=self.stateId,agent=agent,activity=self.activity,registration_id=self.registrationId, user=self.user)
+            p,created = models.activity_state.objects.get_or_create(state_id=self.stateId,agent=agent,activity_id=self.activity_pk,registration_id=self.registrationId, user=self.user)
         else:
-            p,created = models.activity_state.objects.get_or_create(state_id=self.stateId,agent=agent,activity=self.activity, user=self.user)
+            p,created = models.activity_state.objects.get_or_create(state_id=self.stateId,agent=agent,activity_id=self.activity_pk, user=self.user)
         
         if created:
             log_message(self.log_dict, "Created Activity State", __name__, self.put.__name__)
@@ -82,8 +82,8 @@ class ActivityState():
 
         try:
             if self.registrationId:
-                return models.activity_state.objects.get(state_id=self.stateId, agent=agent, activity=self.activity, registration_id=self.registrationId)
-            return models.activity_state.objects.get(state_id=self.stateId, agent=agent, activity=self.activity)
+                return models.activity_state.objects.get(state_id=self.stateId, agent=agent, activity_id=self.activity_pk, registration_id=self.registrationId)
+            return models.activity_state.objects.get(state_id=self.stateId, agent=agent, activity_id=self.activity_pk)
         except models.activity_state.DoesNotExist:
             err_msg = 'There is no activity state associated with the id: %s' % self.stateId
             log_message(self.log_dict, err_msg, __name__, self.get.__name__, True)
@@ -98,9 +98,9 @@ class ActivityState():
         #         raise Forbidden("Unauthorized to retrieve activity state with ID %s" % self.stateId)
 
         if self.registrationId:
-            state_set = models.activity_state.objects.filter(agent=agent, activity=self.activity, registration_id=self.registrationId)
+            state_set = models.activity_state.objects.filter(agent=agent, activity_id=self.activity_pk, registration_id=self.registrationId)
         else:
-            state_set = models.activity_state.objects.filter(agent=agent, activity=self.activity)
+            state_set = models.activity_state.objects.filter(agent=agent, activity_id=self.activity_pk)
         return state_set
 
 
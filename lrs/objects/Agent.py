@@ -2,17 +2,30 @@ import json
 import datetime
 from lrs.models import agent, group, agent_profile
 from lrs.exceptions import IDNotFoundError
-from lrs.util import etag, get_user_from_auth, log_message, update_parent_log_status
+from lrs.util import agent_resolver, commit_on_success_unless_managed, etag, get_user_from_auth, log_message, update_parent_log_status
 from django.core.files.base import ContentFile
-from django.db import transaction
 import pdb
 import logging
 
 logger = logging.getLogger('user_system_actions')
 
+def find_known(params, known):
+    # The agent agent.objects.gen would get for params out of the ones a batch loaded, None when
+    # it has to run - the agent isn't there, is a group or has an account
+    try:
+        key = agent_resolver.get_ifi_key(params)
+    except Exception:
+        return None
+    if key is None or key[0] == 'Group' or key[1] == 'account' or key not in known['agents']:
+        return None
+    # gen matches every field it's given
+    matches = [a for a in known['agents'][key] if all(isinstance(value, basestring) and
+        getattr(a, field, None) == value for field, value in params.items())]
+    return matches[0] if len(matches) == 1 else None
+
 class Agent():
-    @transaction.commit_on_success
-    def __init__(self, initial=None, create=False, log_dict=None):
+    @commit_on_success_unless_managed
+    def __init__(self, initial=None, create=False, log_dict=None, known=None):
         self.initial = initial
         self.log_dict = log_dict
         params = self.initial
@@ -29,7 +42,15 @@ class Agent():
         else:
             obj = agent
         if create:
-            self.agent, created = obj.objects.gen(**params)
+            self.agent = find_known(params, known) if known is not None else None
+            if self.agent is not None:
+                created = False
+            else:
+                self.agent, created = obj.objects.gen(**params)
+                key = agent_resolver.get_ifi_key(params) if known is not None else None
+                if key is not None and self.agent not in known['agents'].get(key, ()):
+                    # The batch's later statements find it
+                    known['agents'].setdefault(key, []).append(self.agent)
             if created:
                 log_message(self.log_dict, "Created %s in database" % self.agent.objectType, __name__, self.__init__.__name__)
             elif not created:
@@ -38,7 +59,7 @@ class Agent():
             try:
                 if 'member' in params:
                     params.pop('member', None)
-                self.agent = obj.objects.get(**params)
+                self.agent = agent_resolver.get_agent(params, obj)
                 log_message(self.log_dict, "Retrieved %s from database" % self.agent.objectType, __name__, self.__init__.__name__)
 
             except:
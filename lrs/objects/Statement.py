@@ -3,10 +3,11 @@ import types
 import uuid
 import datetime
 from lrs import models, exceptions
-from lrs.util import get_user_from_auth, log_message, update_parent_log_status
+from lrs.util.hydrator import StatementHydrator
+from lrs.util import activity_metadata, activity_resolver, agent_resolver, commit_on_success_unless_managed, \
+    get_user_from_auth, log_message, update_parent_log_status, statement_cache, statement_rollups, verb_registry
 from Agent import Agent
 from django.core.exceptions import FieldError
-from django.db import transaction
 from functools import wraps
 from Activity import Activity
 from functools import wraps
@@ -15,6 +16,7 @@ import pdb
 import pprint
 import logging
 import ast
+from collections import Counter
 
 logger = logging.getLogger('user_system_actions')
 
@@ -32,11 +34,15 @@ class default_on_exception(object):
 
 class Statement():
     #Use single transaction for all the work done in function
-    @transaction.commit_on_success
-    def __init__(self, data, auth=None, log_dict=None):
+    @commit_on_success_unless_managed
+    def __init__(self, data, auth=None, log_dict=None, verbs=None, known=None):
         self.auth = auth
         self.params = data
         self.log_dict = log_dict
+        # Verbs by id and the agents and activities loaded up front (see preload), shared by a
+        # batch of statements
+        self.verbs = verbs
+        self.known = known
         if not isinstance(data, dict):
             self.params = self.parse(data)
         self.populate(self.params)
@@ -63,7 +69,10 @@ class Statement():
         # Retrieve statement, check if the verb is 'voided' - if not then set the voided flag to true else return error 
         # since you cannot unvoid a statement and should just reissue the statement under a new ID.
         try:
-            stmt = models.statement.objects.get(statement_id=stmt_id)
+            try:
+                stmt = models.statement.objects.get(statement_id=stmt_id)
+            except models.statement.DoesNotExist:
+                stmt = models.statement_archive.objects.get(statement_id=stmt_id)
         except Exception:
             err_msg = "Statement with ID %s does not exist" % str(stmt_id)
             log_message(self.log_dict, err_msg, __name__, self.voidStatement.__name__, True)
@@ -74,6 +83,8 @@ class Statement():
         if not stmt.voided:
             stmt.voided = True
             stmt.save()
+            statement_cache.invalidate([stmt.statement_id])
+            statement_rollups.count_statement(stmt, -1)
             # Create statement ref
             stmt_ref = models.StatementRef(ref_id=stmt_id)
             stmt_ref.save()
@@ -168,6 +179,10 @@ class Statement():
         # Save context
         cntx = models.context(content_object=self.model_object, **context)    
         cntx.save()
+        if isinstance(self.model_object, models.statement):
+            self.model_object.authoritative_key = self.model_object.get_authoritative_key(cntx.id)
+            models.statement.objects.filter(id=self.model_object.id).update(
+                authoritative_key=self.model_object.authoritative_key)
 
         # Set context in context statement and save
         if cs:
@@ -179,6 +194,10 @@ class Statement():
             for con_act in con_act_data.items():
                 ca = models.ContextActivity(key=con_act[0], context_activity=con_act[1]['id'], context=cntx)
                 ca.save()
+                # Substatements are only found through their parent statement
+                if isinstance(self.model_object, models.statement):
+                    models.statement_context_activity(activity_iri=ca.context_activity, key=ca.key,
+                        statement=self.model_object.id).save()
             cntx.save()
 
         # Save context extensions
@@ -205,6 +224,9 @@ class Statement():
         else:
             stmt = models.statement(**args)
             stmt.save()
+            # Same transaction as the statement
+            if not stmt.voided:
+                statement_rollups.count_statement(stmt, 1)
 
         if self.log_dict:
             self.log_dict['message'] = "Saved statement to database in %s.%s" % (__name__, self.saveObjectToDB.__name__)
@@ -252,7 +274,7 @@ class Statement():
 
         if 'instructor' in stmt_data['context']:
             stmt_data['context']['instructor'] = Agent(initial=stmt_data['context']['instructor'],
-                create=True, log_dict=self.log_dict).agent
+                create=True, log_dict=self.log_dict, known=self.known).agent
 
         # If there is an actor or object is a group in the stmt then remove the team
         if 'actor' in stmt_data or 'group' == stmt_data['object']['objectType'].lower():
@@ -282,24 +304,9 @@ class Statement():
         return self.saveContextToDB(context, contextExts)
 
 
-    def save_lang_map(self, lang_map, verb):
-        # If verb is model object but not saved yet
-        if not verb.id:
-            verb.save()
-        
-        k = lang_map[0]
-        v = lang_map[1]
-
-        # Save lang map
-        language_map = models.LanguageMap(key = k, value = v, content_object=verb)
-        language_map.save()        
-
-        return language_map
-
     def build_verb_object(self, incoming_verb):
         log_message(self.log_dict, "Building verb object", __name__, self.build_verb_object.__name__)
 
-        verb = {}    
         # Must have an ID
         if 'id' not in incoming_verb:
             err_msg = "ID field is not included in statement verb"
@@ -307,35 +314,16 @@ class Statement():
             update_parent_log_status(self.log_dict, 400)       
             raise exceptions.ParamError(err_msg)
 
-        # Get or create the verb
-        verb_object, created = models.Verb.objects.get_or_create(verb_id=incoming_verb['id'])
-
-        # If existing, get existing keys
-        if not created:
-            existing_lang_map_keys = verb_object.display.all().values_list('key', flat=True)
-        else:
-            existing_lang_map_keys = []
-
-        # Save verb displays
-        if 'display' in incoming_verb:
-            # Iterate incoming lang maps
-            for verb_lang_map in incoming_verb['display'].items():
-                # Make sure it's a tuple
-                if isinstance(verb_lang_map, tuple):
-                    # If incoming key doesn't already exist in verb's lang maps - add it
-                    if not verb_lang_map[0] in existing_lang_map_keys: 
-                        lang_map = self.save_lang_map(verb_lang_map, verb_object)    
-                    else:
-                        existing_verb_lang_map = verb_object.display.get(key=verb_lang_map[0])
-                        models.LanguageMap.objects.filter(id=existing_verb_lang_map.id).update(value=verb_lang_map[1])
-                else:
-                    err_msg = "Verb display for verb %s is not a correct language map" % incoming_verb['id']
-                    log_message(self.log_dict, err_msg, __name__, self.build_verb_object.__name__, True) 
-                    update_parent_log_status(self.log_dict, 400)       
-                    raise exceptions.ParamError(err_msg)
-            verb_object.save()
+        display = incoming_verb.get('display', {})
+        if not isinstance(display, dict):
+            err_msg = "Verb display for verb %s is not a correct language map" % incoming_verb['id']
+            log_message(self.log_dict, err_msg, __name__, self.build_verb_object.__name__, True) 
+            update_parent_log_status(self.log_dict, 400)       
+            raise exceptions.ParamError(err_msg)
 
-        return verb_object
+        # Gets or creates the verb and saves the displays that changed
+        verb_pk = verb_registry.get_verb(incoming_verb['id'], display, self.verbs)
+        return models.Verb(id=verb_pk, verb_id=incoming_verb['id'])
 
     #Once JSON is verified, populate the statement object
     def populate(self, stmt_data):
@@ -399,17 +387,16 @@ class Statement():
             # Check objectType, get object based on type
             if statementObjectData['objectType'].lower() == 'activity':
                 args['stmt_object'] = Activity(statementObjectData,auth=self.auth,
-                    log_dict=self.log_dict).activity
+                    log_dict=self.log_dict, known=self.known).activity
             elif statementObjectData['objectType'].lower() in valid_agent_objects:
                 args['stmt_object'] = Agent(initial=statementObjectData, create=True,
-                    log_dict=self.log_dict).agent
+                    log_dict=self.log_dict, known=self.known).agent
             elif statementObjectData['objectType'].lower() == 'substatement':
-                sub_statement = SubStatement(statementObjectData, self.auth, self.log_dict)
+                sub_statement = SubStatement(statementObjectData, self.auth, self.log_dict, self.verbs, self.known)
                 args['stmt_object'] = sub_statement.model_object
             elif statementObjectData['objectType'].lower() == 'statementref':
-                try:
-                    existing_stmt = models.statement.objects.get(statement_id=statementObjectData['id'])
-                except models.statement.DoesNotExist:
+                if not models.statement.objects.filter(statement_id=statementObjectData['id']).exists() and \
+                    not models.statement_archive.objects.filter(statement_id=statementObjectData['id']).exists():
                     err_msg = "No statement with ID %s was found" % statementObjectData['id']
                     log_message(self.log_dict, err_msg, __name__, self.populate.__name__, True)
                     update_parent_log_status(self.log_dict, 404)
@@ -420,7 +407,8 @@ class Statement():
                     args['stmt_object'] = stmt_ref
 
         #Retrieve actor
-        args['actor'] = Agent(initial=stmt_data['actor'], create=True, log_dict=self.log_dict).agent
+        args['actor'] = Agent(initial=stmt_data['actor'], create=True, log_dict=self.log_dict,
+            known=self.known).agent
 
         #Set voided to default false
         args['voided'] = False
@@ -431,7 +419,7 @@ class Statement():
 
         if 'authority' in stmt_data:
             args['authority'] = Agent(initial=stmt_data['authority'], create=True,
-                log_dict=self.log_dict).agent
+                log_dict=self.log_dict, known=self.known).agent
         else:
             # Look at request from auth if not supplied in stmt_data
             if self.auth:
@@ -442,13 +430,15 @@ class Statement():
                     authArgs['name'] = self.auth.username
                     authArgs['mbox'] = self.auth.email
                     args['authority'] = Agent(initial=authArgs, create=True,
-                        log_dict=self.log_dict).agent
-
-        # Check if statement_id already exists, throw exception if it does
-        if 'statement_id' in stmt_data:
-            try:
-                existingSTMT = models.statement.objects.get(statement_id=stmt_data['statement_id'])
-            except models.statement.DoesNotExist:
+                        log_dict=self.log_dict, known=self.known).agent
+
+        # Check if statement_id already exists, throw exception if it does - save_batch checked
+        # the whole batch's already
+        if 'statement_id' in stmt_data and self.known is not None:
+            args['statement_id'] = stmt_data['statement_id']
+        elif 'statement_id' in stmt_data:
+            if not models.statement.objects.filter(statement_id=stmt_data['statement_id']).exists() and \
+                not models.statement_archive.objects.filter(statement_id=stmt_data['statement_id']).exists():
                 args['statement_id'] = stmt_data['statement_id']
             else:
                 err_msg = "The Statement ID %s already exists in the system" % stmt_data['statement_id']
@@ -468,9 +458,14 @@ class Statement():
         if 'context' in stmt_data:
             self.populateContext(stmt_data)
 
+        # Substatements are returned as part of their parent statement's JSON. A batch's are
+        # rendered together once they're all saved, see save_full_statements
+        if self.__class__.__name__ != 'SubStatement' and self.known is None:
+            self.model_object.save_full_statement()
+
 class SubStatement(Statement):
-    @transaction.commit_on_success
-    def __init__(self, data, auth, log_dict=None):
+    @commit_on_success_unless_managed
+    def __init__(self, data, auth, log_dict=None, verbs=None, known=None):
         self.log_dict = log_dict
         unallowed_fields = ['id', 'stored', 'authority']
         # Raise error if an unallowed field is present
@@ -484,4 +479,123 @@ class SubStatement(Statement):
                 update_parent_log_status(self.log_dict, 400)
                 raise exceptions.ParamError("SubStatements cannot be nested inside of other SubStatements")
 
-        Statement.__init__(self, data, auth)
+        Statement.__init__(self, data, auth, verbs=verbs, known=known)
+
+def validate_batch(stmts_data, log_dict=None):
+    # Everything that can be checked without saving is checked for the whole batch before any
+    # of it is saved, with the statement ids checked in one query
+    checked = []
+    for stmt_data in stmts_data:
+        if not isinstance(stmt_data, dict):
+            try:
+                stmt_data = json.loads(stmt_data)
+            except Exception, e:
+                try:
+                    stmt_data = ast.literal_eval(stmt_data)
+                except Exception, e:
+                    stmt_data = None
+            if not isinstance(stmt_data, dict):
+                err_msg = "Error parsing the Statement object. Expecting json. Received: %s" % stmt_data
+                log_message(log_dict, err_msg, __name__, validate_batch.__name__, True)
+                update_parent_log_status(log_dict, 400)
+                raise exceptions.ParamError(err_msg)
+        for field in ('verb', 'object', 'actor'):
+            if field not in stmt_data:
+                err_msg = "No %s provided, must provide '%s' field" % (field, field)
+                log_message(log_dict, err_msg, __name__, validate_batch.__name__, True)
+                update_parent_log_status(log_dict, 400)
+                raise exceptions.ParamError(err_msg)
+        checked.append(stmt_data)
+
+    stmt_ids = [str(s['statement_id']) for s in checked if 'statement_id' in s]
+    err_msg = None
+    repeated = sorted(stmt_id for stmt_id, count in Counter(stmt_ids).items() if count > 1)
+    if repeated:
+        err_msg = "The Statement ID %s is in the batch more than once" % repeated[0]
+    elif stmt_ids:
+        taken = list(models.statement.objects.filter(statement_id__in=stmt_ids).values_list(
+            'statement_id', flat=True)[:1]) or list(models.statement_archive.objects.filter(
+            statement_id__in=stmt_ids).values_list('statement_id', flat=True)[:1])
+        if taken:
+            err_msg = "The Statement ID %s already exists in the system" % taken[0]
+    if err_msg:
+        log_message(log_dict, err_msg, __name__, validate_batch.__name__, True)
+        update_parent_log_status(log_dict, 409)
+        raise exceptions.ParamConflict(err_msg)
+    return checked
+
+def get_named_objects(stmt_data):
+    # The agents and activity IRIs a statement (and its substatement) names
+    agents, iris = [], []
+    for data in (stmt_data, stmt_data.get('object', None)):
+        if not isinstance(data, dict):
+            continue
+        obj = data.get('object', None)
+        context = data.get('context', None)
+        for agent_data in (data.get('actor', None), data.get('authority', None), obj,
+                context.get('instructor', None) if isinstance(context, dict) else None):
+            if isinstance(agent_data, dict) and agent_data.get('objectType', 'Agent') in ('Agent', 'Group'):
+                agents.append(agent_data)
+        if isinstance(obj, dict) and obj.get('objectType', 'Activity') == 'Activity' and \
+            isinstance(obj.get('id', None), basestring):
+            iris.append(obj['id'])
+    return agents, iris
+
+def preload(stmts_data, auth=None):
+    # Looks up every agent and activity a batch names in a few queries, so saving each statement
+    # doesn't look them up one by one. Agents by identifier key (lists, an identifier can have
+    # duplicates) and activities by IRI, with the hash of the definition each activity has
+    # and the activity_metadata rows for the IRIs. The statements add what they create
+    agents_data, iris = [], set()
+    for stmt_data in stmts_data:
+        stmt_agents, stmt_iris = get_named_objects(stmt_data)
+        agents_data.extend(stmt_agents)
+        iris.update(stmt_iris)
+    if auth and auth.__class__.__name__ != 'group':
+        agents_data.append({'name': auth.username, 'mbox': auth.email})
+
+    known = {'agents': {}, 'activities': {}, 'definition_hashes': {}}
+    try:
+        pks_by_key = agent_resolver.resolve_many(agents_data)
+    except Exception:
+        # Malformed agents are reported by the statement naming them
+        pks_by_key = {}
+    agent_pks = set(pk for pks in pks_by_key.values() for pk in pks)
+    loaded = models.agent.objects.in_bulk(agent_pks) if agent_pks else {}
+    for key, pks in pks_by_key.items():
+        # Anything deleted since the pks were cached is looked up again when it's used
+        if all(pk in loaded for pk in pks):
+            known['agents'][key] = [loaded[pk] for pk in pks]
+
+    pks_by_iri = activity_resolver.resolve_many(iris)
+    activity_pks = [pks[0] for pks in pks_by_iri.values() if pks]
+    loaded = models.activity.objects.in_bulk(activity_pks) if activity_pks else {}
+    for iri, pks in pks_by_iri.items():
+        if pks and pks[0] in loaded:
+            known['activities'][iri] = loaded[pks[0]]
+            known['definition_hashes'][pks[0]] = None
+    if loaded:
+        known['definition_hashes'].update(models.activity_definition.objects.filter(
+            activity__in=loaded.keys()).values_list('activity_id', 'definition_hash'))
+    known['metadata'] = activity_metadata.load(iris)
+    return known
+
+def save_full_statements(stmts):
+    # save_full_statement for a batch, rendered from fresh copies of the rows with one hydrator
+    rows = dict((row.id, row) for row in models.statement.objects.filter(id__in=[s.id for s in stmts]))
+    hydrator = StatementHydrator(rows.values())
+    for stmt in stmts:
+        stmt.full_statement = json.dumps(hydrator.get_statement_json(rows[stmt.id]))
+        models.statement.objects.filter(id=stmt.id).update(full_statement=stmt.full_statement)
+
+@commit_on_success_unless_managed
+def save_batch(stmts_data, auth=None, log_dict=None):
+    # A batch POST is saved in one transaction, so a statement failing part way through rolls
+    # back every one before it. Returns the statement models
+    stmts_data = validate_batch(stmts_data, log_dict)
+    # The verbs loaded while saving the batch, the registry only gets them once it commits
+    verbs = {}
+    known = preload(stmts_data, auth)
+    stmts = [Statement(s, auth=auth, log_dict=log_dict, verbs=verbs, known=known).model_object for s in stmts_data]
+    save_full_statements(stmts)
+    return stmts
@@ -0,0 +1,2 @@
+-- Statements and substatements look up their context through the generic relation
+CREATE INDEX lrs_context_object_content_type ON lrs_context (object_id, content_type_id);
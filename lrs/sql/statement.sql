@@ -0,0 +1,10 @@
+-- Indexes for the statement query shapes in retrieve_statement.complex_get. Every query
+-- orders by (stored, id), filters on authoritative unless authoritative=false is asked for,
+-- and may add an actor, verb or object filter.
+CREATE INDEX lrs_statement_stored_id ON lrs_statement (stored, id);
+CREATE INDEX lrs_statement_auth_stored_id ON lrs_statement (authoritative, stored, id);
+CREATE INDEX lrs_statement_actor_auth_stored_id ON lrs_statement (actor_id, authoritative, stored, id);
+CREATE INDEX lrs_statement_verb_auth_stored_id ON lrs_statement (verb_id, authoritative, stored, id);
+CREATE INDEX lrs_statement_object_auth_stored_id ON lrs_statement (stmt_object_id, authoritative, stored, id);
+-- statement.save makes the statements a new one replaces non-authoritative through this one
+CREATE INDEX lrs_statement_authoritative_key ON lrs_statement (authoritative_key, authoritative);
@@ -0,0 +1,7 @@
+-- Same query shapes as sql/statement.sql - archived statements are only read when a statement
+-- query reaches back past the newest archived stored time.
+CREATE INDEX lrs_statement_archive_stored_id ON lrs_statement_archive (stored, id);
+CREATE INDEX lrs_statement_archive_auth_stored_id ON lrs_statement_archive (authoritative, stored, id);
+CREATE INDEX lrs_statement_archive_actor_auth_stored_id ON lrs_statement_archive (actor_id, authoritative, stored, id);
+CREATE INDEX lrs_statement_archive_verb_auth_stored_id ON lrs_statement_archive (verb_id, authoritative, stored, id);
+CREATE INDEX lrs_statement_archive_object_auth_stored_id ON lrs_statement_archive (stmt_object_id, authoritative, stored, id);
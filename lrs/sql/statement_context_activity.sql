@@ -0,0 +1,4 @@
+-- related_activities statement queries look statements up by context activity IRI, optionally
+-- narrowed to one contextActivities key
+CREATE INDEX lrs_statement_context_activity_iri_key_stmt ON lrs_statement_context_activity (activity_iri, key, statement_id);
+CREATE INDEX lrs_statement_context_activity_stmt ON lrs_statement_context_activity (statement_id);
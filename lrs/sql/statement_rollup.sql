@@ -0,0 +1,4 @@
+-- The unique (day, verb_id, activity_id, authority_id) index covers day ranges, these cover
+-- rollups asked for by verb or activity.
+CREATE INDEX lrs_statement_rollup_verb_day ON lrs_statement_rollup (verb_id, day);
+CREATE INDEX lrs_statement_rollup_activity_day ON lrs_statement_rollup (activity_id, day);
@@ -3,8 +3,40 @@ from lrs import models
 import json
 from lrs.exceptions import ParamError, InvalidXML
 from lrs.objects import Activity
+from lrs.util import activity_metadata, activity_resolver
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+import threading
+import time
 import pdb
 
+METADATA_XML = """<?xml version="1.0" encoding="UTF-8"?>
+<tincan xmlns="http://projecttincan.com/tincan.xsd">
+    <activities>
+        <activity id="%s" type="course">
+            <name lang="en-US">Served</name>
+            <description lang="en-US">Served by the stand-in</description>
+            <interactionType>other</interactionType>
+        </activity>
+    </activities>
+</tincan>"""
+
+class MetadataHandler(BaseHTTPRequestHandler):
+    # Stands in for the hosts activity IDs point at
+    def do_GET(self):
+        self.server.paths.append(self.path)
+        if self.path == '/course':
+            body = METADATA_XML % ('http://127.0.0.1:%d/course' % self.server.server_port)
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/xml')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+        else:
+            self.send_error(404)
+
+    def log_message(self, *args):
+        pass
+
 class ActivityModelsTests(TestCase):        
     #Called on all activity django models to see if they were created with the correct fields    
     def do_activity_model(self,realid,act_id, objType):
@@ -151,13 +183,15 @@ class ActivityModelsTests(TestCase):
             self.assertIn(t_desc, target_lang_map_list)            
 
 
-    # Test activity that doesn't have a def, isn't a link and resolves (will not create Activity object)
+    # Test activity that doesn't have a def, isn't a link and resolves to something that isn't metadata
+    # (creates the Activity object, the ID is only fetched later)
     def test_activity_no_def_not_link_resolve(self):
-        self.assertRaises(ParamError, Activity.Activity, json.dumps({'objectType': 'Activity',
-            'id': 'http://yahoo.com'}))
+        act = Activity.Activity(json.dumps({'objectType': 'Activity', 'id': 'http://yahoo.com'}))
+        activity_metadata.resolve()
 
-        self.assertRaises(models.activity.DoesNotExist, models.activity.objects.get,
-            activity_id='http://yahoo.com')
+        self.do_activity_model(act.activity.id, 'http://yahoo.com', 'Activity')
+        self.assertEqual(0, len(models.activity_definition.objects.all()))
+        self.assertIsNone(models.activity_metadata.objects.get(activity_id='http://yahoo.com').definition)
 
     # Test activity that doesn't have a def, isn't a link and doesn't resolve (creates useless 
     # Activity object)
@@ -171,6 +205,7 @@ class ActivityModelsTests(TestCase):
     def test_activity_no_def_not_link_schema_conform(self):
         act = Activity.Activity(json.dumps({'objectType':'Activity',
             'id': 'http://localhost:8000/XAPI/tcexample/'}))
+        activity_metadata.resolve()
 
         fk = models.activity.objects.filter(id=act.activity.id)
         act_def = models.activity_definition.objects.filter(activity=fk)
@@ -234,6 +269,7 @@ class ActivityModelsTests(TestCase):
     def test_activity_no_def_not_link_schema_conform_extensions(self):
         act = Activity.Activity(json.dumps({'objectType':'Activity',
             'id': 'http://localhost:8000/XAPI/tcexample2/'}))
+        activity_metadata.resolve()
 
         fk = models.activity.objects.filter(id=act.activity.id)
         act_def = models.activity_definition.objects.filter(activity=fk)
@@ -255,13 +291,17 @@ class ActivityModelsTests(TestCase):
             'second value', 'third value')
 
     # Test an activity that has a def,is not a link yet the ID resolves, but doesn't conform to XML schema
-    # (will not create one)
+    # (should still use values from JSON)
     def test_activity_not_link_resolve(self):
-        self.assertRaises(ParamError, Activity.Activity, json.dumps({'objectType': 'Activity',
+        act = Activity.Activity(json.dumps({'objectType': 'Activity',
                 'id': 'http://tincanapi.wikispaces.com','definition': {'name': {'en-US':'testname'},
                 'description': {'en-US':'testdesc'}, 'type': 'course','interactionType': 'intType'}}))
-        self.assertRaises(models.activity.DoesNotExist, models.activity.objects.get,
-            activity_id='http://tincanapi.wikispaces.com')
+        activity_metadata.resolve()
+
+        fk = models.activity.objects.filter(id=act.activity.id)
+        self.do_activity_definition_model(fk, 'course', 'intType')
+        self.assertEqual(models.activity_definition.objects.get(activity=fk).object_return()['name'],
+            {'en-US':'testname'})
 
     # Test an activity that has a def, not a link and the provided ID doesn't resolve
     # (should still use values from JSON)
@@ -288,11 +328,12 @@ class ActivityModelsTests(TestCase):
         self.do_activity_definition_model(fk, 'course', 'intType')
 
     # Test an activity that has a def, not a link and the provided ID conforms to the schema
-    # (should use values from XML and override JSON)
+    # (should use values from XML and override JSON once the ID is fetched)
     def test_activity_not_link_schema_conform(self):
         act = Activity.Activity(json.dumps({'objectType': 'Activity',
                 'id':'http://localhost:8000/XAPI/tcexample4/','definition': {'name': {'en-FR': 'name'},
                 'description': {'en-FR':'desc'}, 'type': 'course','interactionType': 'intType'}}))
+        activity_metadata.resolve()
 
         fk = models.activity.objects.filter(id=act.activity.id)
         act_def = models.activity_definition.objects.filter(activity=fk)
@@ -1124,3 +1165,161 @@ class ActivityModelsTests(TestCase):
         self.assertEqual(0, len(models.desc_lang.objects.all()))
         self.assertEqual(0, len(models.name_lang.objects.all()))
         self.assertEqual(0, len(models.activity_def_correctresponsespattern.objects.all()))
+
+    def test_activity_resolver(self):
+        self.assertEqual(activity_resolver.resolve('act:resolver'), ())
+        # Unknown IRIs are remembered too
+        with self.assertNumQueries(0):
+            self.assertRaises(models.activity.DoesNotExist, activity_resolver.get_activity_pk, 'act:resolver')
+
+        act = models.activity(activity_id='act:resolver')
+        act.save()
+        self.assertEqual(activity_resolver.get_activity_pk('act:resolver'), act.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(activity_resolver.resolve('act:resolver'), (act.pk,))
+
+        act.delete()
+        self.assertEqual(activity_resolver.resolve('act:resolver'), ())
+
+        # Misses expire in case another process creates the activity
+        old_timeout = activity_resolver.activities.miss_timeout
+        activity_resolver.activities.miss_timeout = 0
+        try:
+            act = models.activity(activity_id='act:elsewhere')
+            act.save()
+            # As if it was cached before another process created it
+            activity_resolver.activities.set('act:elsewhere', (), activity_resolver.activities.generation)
+            self.assertEqual(activity_resolver.resolve('act:elsewhere'), (act.pk,))
+        finally:
+            activity_resolver.activities.miss_timeout = old_timeout
+
+    def test_definition_hash(self):
+        definition = {'type': 'course', 'name': {'en-US': 'Hashed', 'fr': 'Hache'},
+            'description': {'en-US': 'Hashed course'}}
+        act = Activity.Activity(json.dumps({'objectType': 'Activity', 'id': 'act:hashed', 'definition': definition}))
+        act_def = models.activity_definition.objects.get(activity=act.activity)
+        self.assertEqual(act_def.definition_hash, Activity.get_definition_hash(definition))
+
+        # The same definition only costs fetching the activity (and its parent row) and comparing the hash
+        with self.assertNumQueries(3):
+            Activity.Activity(json.dumps({'objectType': 'Activity', 'id': 'act:hashed',
+                'definition': dict(reversed(definition.items()))}))
+
+        changed = dict(definition, name={'en-US': 'Rehashed', 'fr': 'Hache', 'de': 'Gehasht'})
+        Activity.Activity(json.dumps({'objectType': 'Activity', 'id': 'act:hashed', 'definition': changed}))
+        act_def = models.activity_definition.objects.get(activity=act.activity)
+        self.assertEqual(act_def.object_return()['name'], changed['name'])
+        self.assertEqual(act_def.object_return()['description'], definition['description'])
+        self.assertEqual(act_def.definition_hash, Activity.get_definition_hash(changed))
+
+    def start_metadata_server(self):
+        server = HTTPServer(('127.0.0.1', 0), MetadataHandler)
+        server.paths = []
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def test_activity_metadata(self):
+        server = self.start_metadata_server()
+        course = 'http://127.0.0.1:%d/course' % server.server_port
+        missing = 'http://127.0.0.1:%d/missing' % server.server_port
+
+        # Saving the activity doesn't wait on its ID
+        act = Activity.Activity(json.dumps({'objectType': 'Activity', 'id': course}))
+        Activity.Activity(json.dumps({'objectType': 'Activity', 'id': missing}))
+        Activity.Activity(json.dumps({'objectType': 'Activity', 'id': 'act:not_fetched'}))
+        self.assertEqual(server.paths, [])
+        self.assertEqual(0, len(models.activity_definition.objects.all()))
+        self.assertEqual(set(models.activity_metadata.objects.filter(requested__isnull=False).values_list(
+            'activity_id', flat=True)), set([course, missing]))
+
+        # The resolver fetches them and fills in the definition it found
+        self.assertEqual(activity_metadata.resolve(), 2)
+        self.assertEqual(sorted(server.paths), ['/course', '/missing'])
+        act_def = models.activity_definition.objects.get(activity=act.activity)
+        self.assertEqual(act_def.object_return()['name'], {'en-US': 'Served'})
+        self.assertEqual(act_def.activity_definition_type, 'course')
+
+        # Both results are kept until they expire
+        Activity.Activity(json.dumps({'objectType': 'Activity', 'id': course}))
+        Activity.Activity(json.dumps({'objectType': 'Activity', 'id': missing}))
+        self.assertEqual(activity_metadata.resolve(), 0)
+        models.activity_metadata.objects.filter(activity_id=missing).update(expires=activity_metadata.get_now())
+        Activity.Activity(json.dumps({'objectType': 'Activity', 'id': missing}))
+        self.assertEqual(activity_metadata.resolve(), 1)
+        self.assertEqual(len(server.paths), 3)
+
+    def test_activity_metadata_host_limit(self):
+        lock = threading.Lock()
+        running = {}
+        most = {}
+        def fetch(iri):
+            host = activity_metadata.get_host(iri)
+            with lock:
+                running[host] = running.get(host, 0) + 1
+                most[host] = max(most.get(host, 0), running[host])
+            time.sleep(0.05)
+            with lock:
+                running[host] -= 1
+            if iri.endswith('/broken'):
+                raise IOError('no route to host')
+            return iri
+
+        iris = ['http://slow.example.com/%d' % i for i in range(4)] + ['http://fast.example.com/%d' % i for i in range(4)]
+        results = activity_metadata.fetch_all(iris + ['http://slow.example.com/broken'], fetch, 3, 2)
+        # Three workers, but never more than two on one host
+        self.assertEqual(sorted(most.keys()), ['fast.example.com', 'slow.example.com'])
+        self.assertTrue(max(most.values()) <= 2)
+        self.assertEqual(results, dict([(iri, iri) for iri in iris] + [('http://slow.example.com/broken', None)]))
+
+    def test_activity_link_check(self):
+        server = self.start_metadata_server()
+        definition = {'name': {'en-GB':'testname'}, 'description': {'en-GB':'testdesc'}, 'type': 'link'}
+        course = 'http://127.0.0.1:%d/course' % server.server_port
+        missing = 'http://127.0.0.1:%d/missing' % server.server_port
+
+        # Only the syntax is checked while saving
+        for iri in (course, missing, missing):
+            Activity.Activity(json.dumps({'objectType': 'Activity', 'id': iri, 'definition': definition}))
+        self.assertEqual(server.paths, [])
+        self.assertRaises(ParamError, Activity.Activity, json.dumps({'objectType': 'Activity',
+            'id': 'http://not a link', 'definition': definition}))
+        self.assertRaises(models.activity.DoesNotExist, models.activity.objects.get, activity_id='http://not a link')
+
+        # Each ID is requested once
+        self.assertEqual(activity_metadata.resolve(), 2)
+        self.assertEqual(sorted(server.paths), ['/course', '/missing'])
+        self.assertTrue(models.activity_metadata.objects.get(activity_id=course).reachable)
+        self.assertFalse(models.activity_metadata.objects.get(activity_id=missing).reachable)
+        act_def = models.activity_definition.objects.get(activity__activity_id=missing)
+        self.assertEqual(act_def.object_return()['name'], definition['name'])
+
+        # The metadata document at a link ID isn't applied
+        self.assertIsNone(models.activity_metadata.objects.get(activity_id=course).definition)
+        act_def = models.activity_definition.objects.get(activity__activity_id=course)
+        self.assertEqual(act_def.activity_definition_type, 'link')
+        self.assertEqual(act_def.object_return()['name'], definition['name'])
+
+    def test_activity_metadata_replaces_definition(self):
+        server = self.start_metadata_server()
+        course = 'http://127.0.0.1:%d/course' % server.server_port
+        definition = {'name': {'en-FR': 'name'}, 'description': {'en-FR': 'desc'}, 'type': 'module'}
+        act = Activity.Activity(json.dumps({'objectType': 'Activity', 'id': course, 'definition': definition}))
+        self.assertEqual(activity_metadata.resolve(), 1)
+
+        # The statement's languages don't survive the definition at the ID
+        act_def = models.activity_definition.objects.get(activity=act.activity)
+        self.assertEqual(act_def.object_return()['name'], {'en-US': 'Served'})
+        self.assertEqual(act_def.object_return()['description'], {'en-US': 'Served by the stand-in'})
+        self.assertEqual(act_def.activity_definition_type, 'course')
+        self.assertIsNone(act_def.definition_hash)
+
+        # Sending the same definition again isn't skipped, the one at the ID still wins
+        Activity.Activity(json.dumps({'objectType': 'Activity', 'id': course, 'definition': definition}))
+        act_def = models.activity_definition.objects.get(activity=act.activity)
+        self.assertEqual(act_def.object_return()['name'], {'en-US': 'Served'})
+        self.assertEqual(act_def.activity_definition_type, 'course')
+        self.assertIsNone(act_def.definition_hash)
@@ -1,7 +1,9 @@
 from django.test import TestCase
+from django.core.cache import get_cache
 from lrs.exceptions import ParamError
-from lrs.models import agent, group, agent_account
+from lrs.models import agent, group, agent_account, merge_model_objects
 from lrs.objects.Agent import Agent
+from lrs.util import agent_resolver
 import hashlib
 import json
 import pdb
@@ -186,3 +188,42 @@ class AgentModelsTests(TestCase):
 
         self.assertEquals(0, len(agent.objects.all()))
         self.assertEquals(0, len(agent_account.objects.all()))
+
+    def test_agent_resolver(self):
+        # Off unless AGENT_VERSION_CACHE is set
+        self.addCleanup(setattr, agent_resolver, 'stamps', agent_resolver.stamps)
+        agent_resolver.stamps = get_cache('default')
+        bob, created = agent.objects.gen(mbox="mailto:bob@example.com", name="bob")
+        self.assertEquals(agent_resolver.resolve({"mbox":"mailto:bob@example.com"}), (bob.pk,))
+        with self.assertNumQueries(0):
+            self.assertEquals(agent_resolver.resolve({"mbox":"mailto:bob@example.com", "name":"bobby"}), (bob.pk,))
+        # Lookups by account used to fail, they match on the account now
+        amy = Agent(initial={"name":"amy", "account":{"homePage":"http://adlnet.gov", "name":"amy"}}, create=True).agent
+        self.assertEquals(Agent(initial={"account":{"homePage":"http://adlnet.gov", "name":"amy"}}).agent.pk, amy.pk)
+        self.assertIsNone(agent_resolver.resolve({"mbox":"mailto:bob@example.com", "openid":"bob.openid.com"}))
+
+        # Changing an identifier drops the old one
+        bob.mbox = "mailto:robert@example.com"
+        bob.save()
+        self.assertEquals(agent_resolver.resolve({"mbox":"mailto:bob@example.com"}), ())
+        self.assertEquals(agent_resolver.resolve({"mbox":"mailto:robert@example.com"}), (bob.pk,))
+        # A new agent with the same identifier is picked up
+        rob = agent(mbox="mailto:robert@example.com", name="rob")
+        rob.save()
+        self.assertEquals(agent_resolver.resolve({"mbox":"mailto:robert@example.com"}), (bob.pk, rob.pk))
+        self.assertEquals(Agent(initial={"mbox":"mailto:robert@example.com"}).agent.pk, bob.pk)
+
+        # Merging deletes the alias and saves the primary
+        merge_model_objects(rob, [bob])
+        self.assertEquals(agent_resolver.resolve({"mbox":"mailto:robert@example.com"}), (rob.pk,))
+        amy.delete()
+        self.assertEquals(agent_resolver.resolve({"account":{"homePage":"http://adlnet.gov", "name":"amy"}}), ())
+
+        # An agent created by another process replaces the identifier's stamp, so what this process
+        # cached before is looked up again
+        key = ("Agent", "mbox", "mailto:robert@example.com")
+        stamp = agent_resolver.get_stamp(key)
+        robert = agent(mbox="mailto:robert@example.com", name="robert")
+        robert.save()
+        agent_resolver.agents.set(key, (rob.pk,), stamp, agent_resolver.agents.generation)
+        self.assertEquals(agent_resolver.resolve({"mbox":"mailto:robert@example.com"}), (rob.pk, robert.pk))
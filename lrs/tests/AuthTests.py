@@ -513,9 +513,8 @@ class AuthTests(TestCase):
         
         self.assertEqual(actorObjectGetResponse.status_code, 200)
         stmts = json.loads(actorObjectGetResponse.content)
-        dbstmts = models.statement.objects.all()
-        # Will return 10 since that is server limit
-        self.assertEqual(len(stmts["statements"]), 10)
+        # An agent that doesn't exist can't be the object of anything
+        self.assertEqual(len(stmts["statements"]), 0)
 
     def test_verb_filter(self):
         param = {"verb":"http://adlnet.gov/expapi/verbs/missed"}
@@ -1241,7 +1240,8 @@ class AuthTests(TestCase):
 
         self.assertEqual(len(statements), 11)
         self.assertEqual(voided_st.voided, False)
-        self.assertEqual(len(voided_verb), 1)
+        # The batch is checked before any of it is saved, so the voided verb never gets created
+        self.assertEqual(len(voided_verb), 0)
         self.assertEqual(len(only_actor), 0)
 
     def test_post_list_rollback_with_subs(self):
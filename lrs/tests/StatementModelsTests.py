@@ -1,4 +1,4 @@
-from django.test import TestCase
+from django.test import TestCase, TransactionTestCase
 from lrs import models
 from lrs.exceptions import ParamError, Forbidden, ParamConflict, IDNotFoundError
 import json
@@ -6,6 +6,15 @@ from datetime import datetime
 import uuid
 import pdb
 from lrs.objects import Statement
+from lrs.util.hydrator import StatementHydrator
+from lrs.util import activity_resolver, agent_resolver, statement_cache, verb_registry
+from django.core.cache import get_cache
+from django.core.exceptions import ImproperlyConfigured
+from django.core.management import call_command
+from lrs.MmapCache import MmapCache
+import os
+import tempfile
+from StringIO import StringIO
 
 def get_ctx_id(stmt):
     if len(stmt.context.all()) > 0:
@@ -638,6 +647,23 @@ class StatementModelsTests(TestCase):
         self.assertFalse(models.statement.objects.get(pk=stmt.model_object.pk).authoritative)
 
 
+    def test_authoritative_key(self):
+        data = {"actor":{"name":"tom","mbox":"mailto:tom@example.com"}, 'verb': {"id":"verb/url"}, "object": {"id":"activity"}}
+        stmt = Statement.Statement(json.dumps(data)).model_object
+        stmt2 = Statement.Statement(json.dumps(dict(data, context={"registration":str(uuid.uuid4())}))).model_object
+        stmt3 = Statement.Statement(json.dumps(data)).model_object
+        # The one with a context replaced the first but is keyed by its context after that
+        self.assertEqual([models.statement.objects.get(pk=s.pk).authoritative for s in (stmt, stmt2, stmt3)],
+            [False, True, True])
+        self.assertEqual(stmt.authoritative_key, stmt3.authoritative_key)
+        self.assertEqual(models.statement.objects.get(pk=stmt2.pk).authoritative_key,
+            stmt2.get_authoritative_key(stmt2.context.all()[0].id))
+
+        keys = dict(models.statement.objects.values_list('id', 'authoritative_key'))
+        models.statement.objects.update(authoritative_key=None)
+        call_command('backfill_authoritative_key', stdout=StringIO())
+        self.assertEqual(dict(models.statement.objects.values_list('id', 'authoritative_key')), keys)
+
     def test_group_stmt(self):
         ot = "Group"
         name = "the group SMT"
@@ -661,3 +687,329 @@ class StatementModelsTests(TestCase):
 
         self.assertEqual(actor.name, name)
         self.assertEqual(actor.mbox, mbox)
+
+
+    def create_render_stmts(self):
+        stmt_guid = str(uuid.uuid4())
+        Statement.Statement(json.dumps({'statement_id':stmt_guid, 'actor':{'objectType':'Agent',
+            'account':{'homePage':'http://example.com', 'name':'sacct'}},
+            'verb': {"id":"verb/url/outer", "display":{"en-US":"outer", "en-GB":"altouter"}},"object": {'id':'activityy16'}}))
+        Statement.Statement(json.dumps({'actor':{'objectType':'Agent','mbox':'jon@example.com', 'name':'jon'},
+            'verb': {"id":"verb/url", "display":{"en-US":"verb"}},"object": {'id':'activity17',
+            'definition': {'name': {'en-US':'testname', 'en-GB':'altname'}, 'description': {'en-US':'testdesc'},
+            'type': 'http://www.adlnet.gov/experienceapi/activity-types/cmi.interaction','interactionType': 'choice',
+            'correctResponsesPattern': ['golf', 'tetris'], 'choices':[{'id': 'golf', 'description': {'en-US':'Golf Example',
+            'en-GB':'alt golf'}}, {'id': 'tetris', 'description': {'en-US':'Tetris Example'}}],
+            'extensions': {'key1': 'value1'}}}, 'result': {'score':{'scaled':.85, 'raw':85, 'min':0, 'max':100},
+            'completion': True, 'success': True, 'response': 'kicked', 'extensions':{'rkey1': 'rvalue1'}},
+            'context':{'registration': str(uuid.uuid4()), 'instructor': {'objectType':'Agent', 'name':'bill','mbox':'bill@example.com'},
+            'contextActivities': {'other': {'id': 'NewActivityID'}}, 'revision': 'foo', 'platform':'bar',
+            'language': 'en-US', 'statement': {'id': stmt_guid}, 'extensions':{'ckey1': 'cval1'}}}))
+        Statement.Statement(json.dumps({'actor':{'objectType':'Agent','mbox':'s@s.com'},
+            'verb': {"id":"verb/url"}, 'object':{'objectType':'SubStatement',
+            'actor':{'objectType':'Agent','mbox':'ss@ss.com'},'verb': {"id":"verb/url/nest", "display":{"en-US":"nest"}},
+            'object': {'objectType':'activity', 'id':'testex.com'}, 'result':{'completion': True, 'success': True,
+            'response': 'kicked'}, 'context':{'registration': str(uuid.uuid4()),
+            'contextActivities': {'other': {'id': 'NewActivityID'}},'revision': 'foo', 'platform':'bar',
+            'language': 'en-US', 'extensions':{'k1': 'v1', 'k2': 'v2'}}}}))
+        Statement.Statement(json.dumps({'actor':{'objectType':'Agent','mbox':'s@s.com'},
+            'verb': {"id":"verb/url"}, 'object':{'objectType':'Agent', 'name':'obj', 'mbox':'obj@example.com'}}))
+        Statement.Statement(json.dumps({'actor':{'objectType':'Agent','mbox':'s@s.com'},
+            'verb': {"id":"verb/url"}, 'object':{'objectType':'StatementRef', 'id':stmt_guid}}))
+        return stmt_guid
+
+    def test_hydrator_matches_object_return(self):
+        self.create_render_stmts()
+        # Build everything from the relational tables
+        models.statement.objects.all().update(full_statement=None)
+
+        stmts = models.statement.objects.all().order_by('id')
+        for sparse in (True, False):
+            for lang in (None, 'en-GB'):
+                hydrated = StatementHydrator(stmts).get_statements_json(sparse, lang)
+                self.assertEqual(hydrated, [s.object_return(sparse, lang) for s in stmts])
+
+        acts = models.activity.objects.all().order_by('id')
+        self.assertEqual(StatementHydrator(activities=acts).get_activities_json(), [a.object_return() for a in acts])
+
+    def test_hydrator_query_count(self):
+        for i in range(3):
+            Statement.Statement(json.dumps({'actor':{'objectType':'Agent','mbox':'s%s@s.com' % i},
+                'verb': {"id":"verb/url/%s" % i, "display":{"en-US":"verb"}}, "object": {'id':'activity%s' % i},
+                'result': {'completion': True, 'extensions':{'rkey1': 'rvalue1'}},
+                'context':{'contextActivities': {'other': {'id': 'NewActivityID'}}}}))
+        models.statement.objects.all().update(full_statement=None)
+        stmts = list(models.statement.objects.all())
+        # Warm up the ContentType cache
+        StatementHydrator(stmts).get_statements_json()
+        # The number of queries does not depend on the number of statements
+        with self.assertNumQueries(13):
+            StatementHydrator(stmts[:1]).get_statements_json()
+        with self.assertNumQueries(13):
+            StatementHydrator(stmts).get_statements_json()
+
+    def test_stmt_object_type(self):
+        stmt = Statement.Statement(json.dumps({'actor':{'objectType':'Agent','mbox':'s@s.com'},
+            'verb': {"id":"verb/url"}, 'object':{'objectType':'SubStatement',
+            'actor':{'objectType':'Agent','mbox':'ss@ss.com'},'verb': {"id":"verb/url/nest"},
+            'object': {'objectType':'Agent', 'mbox':'obj@obj.com'}}}))
+        outer_stmt = models.statement.objects.get(id=stmt.model_object.id)
+        sub_stmt = models.SubStatement.objects.get(id=outer_stmt.stmt_object.id)
+        self.assertEqual(outer_stmt.stmt_object.stmt_object_type, 'substatement')
+        self.assertEqual(sub_stmt.stmt_object.stmt_object_type, 'agent')
+
+        # Only one query to fetch the typed object once the discriminator is loaded
+        outer_stmt.stmt_object
+        with self.assertNumQueries(1):
+            obj, object_type = outer_stmt.get_stmt_object()
+        self.assertEqual(object_type, 'substatement')
+        self.assertEqual(obj.id, sub_stmt.id)
+
+        # Rows without the discriminator still resolve and get backfilled
+        models.statement_object.objects.all().update(stmt_object_type=None)
+        outer_stmt = models.statement.objects.get(id=stmt.model_object.id)
+        obj, object_type = outer_stmt.get_stmt_object()
+        self.assertEqual(object_type, 'substatement')
+        call_command('backfill_stmt_object_type')
+        self.assertEqual(models.statement_object.objects.get(id=sub_stmt.id).stmt_object_type, 'substatement')
+        self.assertEqual(models.statement_object.objects.get(id=sub_stmt.stmt_object.id).stmt_object_type, 'agent')
+        self.assertEqual(models.statement_object.objects.filter(stmt_object_type__isnull=True).count(), 0)
+
+    def test_full_statement_matches_build_json(self):
+        stmt_guid = self.create_render_stmts()
+        stmts = models.statement.objects.all().order_by('id')
+        for s in stmts:
+            self.assertTrue(s.full_statement)
+            for sparse in (True, False):
+                for lang in (None, 'en-GB', 'en-US'):
+                    self.assertEqual(s.object_return(sparse, lang), s.build_json(sparse, lang))
+
+        # Rendering a page of stored statements doesn't touch the relational tables
+        StatementHydrator(stmts).get_statements_json()
+        with self.assertNumQueries(0):
+            StatementHydrator(stmts).get_statements_json(True, 'en-GB')
+
+        # Voided is read from the row, not the stored JSON
+        Statement.Statement(json.dumps({'actor':{'objectType':'Agent','mbox':'s@s.com'},
+            'verb': {"id":"http://adlnet.gov/expapi/verbs/voided"},
+            'object':{'objectType':'StatementRef', 'id':stmt_guid}}))
+        voided_stmt = models.statement.objects.get(statement_id=stmt_guid)
+        self.assertTrue(voided_stmt.object_return()['voided'])
+        self.assertFalse(json.loads(voided_stmt.full_statement)['voided'])
+
+    def test_rendered_statement_cache(self):
+        stmt_guid = str(uuid.uuid4())
+        Statement.Statement(json.dumps({'statement_id':stmt_guid, 'actor':{'objectType':'Agent','mbox':'s@s.com'},
+            'verb': {"id":"verb/url", "display":{"en-US":"verb", "en-GB":"altverb"}}, "object": {'id':'activity18'}}))
+        st = models.statement.objects.get(statement_id=stmt_guid)
+        rendered = statement_cache.get_statement_json(st, False, 'en-GB')
+        self.assertEqual(json.loads(rendered), st.object_return(False, 'en-GB'))
+        # Served from the cache
+        models.statement.objects.filter(id=st.id).update(full_statement=None)
+        with self.assertNumQueries(0):
+            self.assertEqual(statement_cache.get_statement_json(st, False, 'en-GB'), rendered)
+
+        # Voiding drops it and the voided flag picks a different entry anyway
+        Statement.Statement(json.dumps({'actor':{'objectType':'Agent','mbox':'s@s.com'},
+            'verb': {"id":"http://adlnet.gov/expapi/verbs/voided"},
+            'object':{'objectType':'StatementRef', 'id':stmt_guid}}))
+        self.assertIsNone(statement_cache.rendered_statements.get(stmt_guid, (st.id, str(st.stored), False, False, 'en-GB')))
+        st = models.statement.objects.get(statement_id=stmt_guid)
+        self.assertTrue(json.loads(statement_cache.get_statement_json(st, False, 'en-GB'))['voided'])
+
+    def test_rendered_statement_cache_is_bounded(self):
+        cache = statement_cache.RenderedStatementCache(2)
+        cache.set('a', 1, 'a1')
+        cache.set('b', 1, 'b1')
+        cache.get('a', 1)
+        cache.set('c', 1, 'c1')
+        # b was the least recently used
+        self.assertIsNone(cache.get('b', 1))
+        self.assertEqual(cache.get('a', 1), 'a1')
+        self.assertEqual(cache.get('c', 1), 'c1')
+        cache.invalidate(['a'])
+        self.assertIsNone(cache.get('a', 1))
+
+        # Variants of one statement count against the size too
+        for lang in ('en', 'fr', 'de'):
+            cache.set('d', lang, 'd' + lang)
+        self.assertEqual(len(cache.entries), 2)
+        self.assertIsNone(cache.get('d', 'en'))
+        self.assertEqual(cache.variants, {'d': set(['fr', 'de'])})
+        cache.invalidate(['d'])
+        self.assertEqual(len(cache.entries), 0)
+        self.assertEqual(cache.variants, {})
+
+    def test_mmap_cache(self):
+        path = tempfile.mktemp()
+        params = {'OPTIONS': {'MAX_ENTRIES': 8, 'SLOT_SIZE': 256, 'LOCAL_TIMEOUT': 0}}
+        try:
+            cache = MmapCache(path, params)
+            # Another process on the host sees the same file
+            other = MmapCache(path, params)
+            for i in range(8):
+                cache.set('key%s' % i, {'value': i})
+            self.assertEqual(other.get('key0'), {'value': 0})
+            # Only one set of 8 slots, key1 is now the least recently used
+            cache.set('key8', {'value': 8})
+            self.assertIsNone(other.get('key1'))
+            self.assertEqual(other.get('key8'), {'value': 8})
+            self.assertFalse(cache.add('key8', 'new'))
+            cache.delete('key8')
+            self.assertTrue(cache.add('key8', 'new'))
+            self.assertEqual(other.get('key8'), 'new')
+            # Too big for a slot, so it isn't shared
+            cache.set('big', 'x' * 1024)
+            self.assertIsNone(other.get('big'))
+            cache.set('short', 1, timeout=-1)
+            self.assertIsNone(other.get('short'))
+
+            stats = other.get_stats()
+            self.assertEqual(stats['hits'], 3)
+            self.assertEqual(stats['misses'], 3)
+            # key1, then whatever short pushed out of the full set
+            self.assertEqual(stats['evictions'], 2)
+            self.assertEqual(stats['slots'], 8)
+            cache.clear()
+            self.assertEqual(cache.get_stats()['entries'], 0)
+
+            # Other settings get a file of their own, the one in use is left alone
+            resized = MmapCache(path, {'OPTIONS': {'MAX_ENTRIES': 16, 'SLOT_SIZE': 256}})
+            resized.set('key0', 'resized')
+            self.assertNotEqual(resized._path, cache._path)
+            cache.set('key0', {'value': 0})
+            self.assertEqual(other.get('key0'), {'value': 0})
+            self.assertEqual(resized.get('key0'), 'resized')
+            os.remove(resized._path)
+
+            # A file that isn't a cache is refused, not overwritten
+            with open(cache._path, 'r+b') as f:
+                f.write('NOTCACHE')
+            self.assertRaises(ImproperlyConfigured, MmapCache(path, params).get, 'key0')
+        finally:
+            os.remove(cache._path)
+
+    def test_mmap_cache_local_tier(self):
+        path = tempfile.mktemp()
+        params = {'OPTIONS': {'MAX_ENTRIES': 8, 'SLOT_SIZE': 256, 'LOCAL_TIMEOUT': 60, 'LOCAL_MAX_ENTRIES': 2}}
+        try:
+            cache = MmapCache(path, params)
+            cache.set('a', 1)
+            self.assertEqual(cache.get('a'), 1)
+            self.assertEqual(cache.get_stats()['local_hits'], 1)
+            self.assertEqual(cache.get_stats()['hits'], 0)
+            cache.set('b', 2)
+            cache.set('c', 3)
+            # a fell out of the local tier but is still shared
+            self.assertEqual(cache.get_stats()['local_entries'], 2)
+            self.assertEqual(cache.get('a'), 1)
+            self.assertEqual(cache.get_stats()['hits'], 1)
+        finally:
+            os.remove(cache._path)
+
+# EXPLAIN commits the open transaction on sqlite, so this can't run inside a TestCase
+class StatementIndexTests(TransactionTestCase):
+
+    def test_statement_queries_use_indexes(self):
+        for i in range(3):
+            Statement.Statement(json.dumps({'actor':{'objectType':'Agent','mbox':'s%s@s.com' % i},
+                'verb': {"id":"verb/url/%s" % i}, "object": {'id':'activity%s' % i},
+                'context':{'registration': str(uuid.uuid4()), 'contextActivities': {'other': {'id': 'NewActivityID'}},
+                'instructor': {'objectType':'Agent', 'name':'bill','mbox':'bill@example.com'}}}))
+        # Raises CommandError if any complex_get filter combination does a full table scan
+        call_command('explain_statement_queries')
+
+# Checks the batch really is rolled back, which a TestCase's transaction would hide
+class StatementBatchTests(TransactionTestCase):
+
+    def setUp(self):
+        # Flushing the tables between tests doesn't tell the registry or the resolvers
+        verb_registry.verbs.entries.clear()
+        agent_resolver.agents.invalidate(list(agent_resolver.agents.entries))
+        activity_resolver.activities.invalidate(list(activity_resolver.activities.entries))
+
+    def test_batch_rolls_back(self):
+        stmts = [{'actor':{'objectType':'Agent','mbox':'batch@s.com'}, 'verb': {"id":"verb/url/batch"},
+            "object": {'id':'act:batch'}},
+            {'actor':{'objectType':'Agent','mbox':'batch@s.com'}, 'verb': {"id":"http://adlnet.gov/expapi/verbs/voided"},
+            "object": {'objectType':'StatementRef', 'id':str(uuid.uuid4())}}]
+        self.assertRaises(IDNotFoundError, Statement.save_batch, stmts)
+        self.assertEqual(models.statement.objects.count(), 0)
+        self.assertFalse(models.agent.objects.filter(mbox='batch@s.com').exists())
+        self.assertFalse(models.activity.objects.filter(activity_id='act:batch').exists())
+
+        saved = Statement.save_batch(stmts[:1] * 2)
+        self.assertEqual(len(saved), 2)
+        self.assertEqual(saved[0].verb_id, saved[1].verb_id)
+        self.assertEqual(models.statement.objects.count(), 2)
+
+    def test_batch_query_count(self):
+        def get_batch(actors, acts):
+            return [{'actor':{'objectType':'Agent','mbox':'mailto:%s@batch.com' % actor}, 'verb': {"id":"verb/url/batch"},
+                'object': {'id':'act:batch%s' % act, 'definition': {'type': 'course', 'name': {'en-US': 'batch'},
+                'description': {'en-US': 'batch'}}}, 'context': {'instructor': {'mbox':'mailto:teacher@batch.com'}}}
+                for actor, act in zip(actors, acts)]
+        Statement.save_batch(get_batch(range(10), range(10)))
+
+        # Ten agents and activities are looked up in the same queries as one and the verb once,
+        # what's left is saving each statement and a write per rollup
+        for actors, acts, num in ((range(10), range(10), 84), ([0] * 10, [0] * 10, 75)):
+            agent_resolver.agents.invalidate(list(agent_resolver.agents.entries))
+            activity_resolver.activities.invalidate(list(activity_resolver.activities.entries))
+            with self.assertNumQueries(num):
+                Statement.save_batch(get_batch(actors, acts))
+        self.assertEqual(models.agent.objects.filter(mbox__endswith='@batch.com').count(), 11)
+        self.assertEqual(models.activity.objects.filter(activity_id__startswith='act:batch').count(), 10)
+        self.assertEqual(sum(models.statement_rollup.objects.values_list('count', flat=True)), 30)
+        stmt = models.statement.objects.order_by('-id')[0]
+        self.assertEqual(json.loads(stmt.full_statement), stmt.build_json())
+
+    def test_batch_checked_up_front(self):
+        stmt_id = str(uuid.uuid4())
+        stmt = {'statement_id':stmt_id, 'actor':{'objectType':'Agent','mbox':'batch@s.com'},
+            'verb': {"id":"verb/url/batch"}, "object": {'id':'act:batch'}}
+        self.assertRaises(ParamConflict, Statement.save_batch, [stmt, stmt])
+        self.assertRaises(ParamError, Statement.save_batch, [stmt, {'verb': {"id":"verb/url/batch"}}])
+        self.assertEqual(models.Verb.objects.count(), 0)
+        Statement.save_batch([stmt])
+        self.assertRaises(ParamConflict, Statement.save_batch, [dict(stmt, object={'id':'act:other'})])
+        self.assertFalse(models.activity.objects.filter(activity_id='act:other').exists())
+
+    def test_verb_registry(self):
+        # Off unless VERB_VERSION_CACHE is set
+        self.addCleanup(setattr, verb_registry, 'stamps', verb_registry.stamps)
+        verb_registry.stamps = get_cache('default')
+        verb_id = 'verb/url/registry'
+        stmt = {'actor':{'objectType':'Agent','mbox':'batch@s.com'}, 'verb': {"id":verb_id,
+            "display": {"en-US":"registered"}}, "object": {'id':'act:batch'}}
+        saved = Statement.save_batch([stmt, stmt])
+        verb = models.Verb.objects.get(verb_id=verb_id)
+        self.assertEqual(saved[0].verb_id, verb.pk)
+        self.assertEqual(verb.object_return(), stmt['verb'])
+
+        # Registered once the batch committed, nothing changed so nothing to check
+        with self.assertNumQueries(0):
+            self.assertEqual(verb_registry.get_verb(verb_id, {"en-US":"registered"}), verb.pk)
+            self.assertEqual(verb_registry.get_verb(verb_id, {}), verb.pk)
+
+        # Only the changed and new languages are written
+        with self.assertNumQueries(4):
+            verb_registry.get_verb(verb_id, {"en-US":"changed", "fr":"change", "en-GB":"registered"})
+        self.assertEqual(verb.object_return()['display'], {"en-US":"changed", "fr":"change", "en-GB":"registered"})
+        with self.assertNumQueries(0):
+            verb_registry.get_verb(verb_id, {"fr":"change"})
+
+        # Another process changing the verb replaces its stamp
+        verb_registry.stamps.set(verb_registry.get_stamp_key(verb_id), 'other')
+        with self.assertNumQueries(2):
+            verb_registry.get_verb(verb_id, {"fr":"change"})
+        with self.assertNumQueries(0):
+            verb_registry.get_verb(verb_id, {"fr":"change"})
+
+        # So does editing it outside of statements
+        lang_map = verb.display.get(key='fr')
+        lang_map.value = 'edited'
+        lang_map.save()
+        with self.assertNumQueries(3):
+            verb_registry.get_verb(verb_id, {"fr":"change"})
+        self.assertEqual(verb.display.get(key='fr').value, 'change')
@@ -9,7 +9,8 @@ from django.utils.timezone import utc
 from lrs.objects import Activity
 import time
 import pdb
-from lrs.util import retrieve_statement
+from lrs.util import retrieve_statement, req_process, statement_cache
+from lrs.util.hydrator import StatementHydrator
 from django.conf import settings
 
 class StatementsMoreTests(TestCase):
@@ -408,7 +409,7 @@ class StatementsMoreTests(TestCase):
         rsp = sincePostResponse.content
         resp_json = json.loads(rsp)
         resp_url = resp_json['more']
-        resp_id = resp_url[-32:]
+        resp_id = resp_url[len(retrieve_statement.MORE_ENDPOINT):]
 
         self.assertIn(self.guid15, rsp)
         self.assertIn(self.guid14, rsp)
@@ -475,7 +476,7 @@ class StatementsMoreTests(TestCase):
         rsp = sincePostResponse.content
         resp_json = json.loads(rsp)
         resp_url = resp_json['more']
-        resp_id = resp_url[-32:]
+        resp_id = resp_url[len(retrieve_statement.MORE_ENDPOINT):]
 
         self.assertIn(self.guid20, rsp)
         self.assertIn(self.guid19, rsp)
@@ -542,7 +543,7 @@ class StatementsMoreTests(TestCase):
         rsp = sinceGetResponse.content
         resp_json = json.loads(rsp)
         resp_url = resp_json['more']
-        resp_id = resp_url[-32:]
+        resp_id = resp_url[len(retrieve_statement.MORE_ENDPOINT):]
 
         self.assertEqual(len(resp_json['statements']), 10)
 
@@ -578,7 +579,7 @@ class StatementsMoreTests(TestCase):
         more_rsp = moreURLGet.content
         more_json = json.loads(more_rsp)
         more_resp_url = more_json['more']
-        more_resp_id = more_resp_url[-32:]
+        more_resp_id = more_resp_url[len(retrieve_statement.MORE_ENDPOINT):]
 
         self.assertIn(self.guid14, more_rsp)
         self.assertIn(self.guid13, more_rsp)
@@ -644,7 +645,7 @@ class StatementsMoreTests(TestCase):
         rsp = sinceGetResponse.content
         resp_json = json.loads(rsp)
         resp_url = resp_json['more']
-        resp_id = resp_url[-32:]
+        resp_id = resp_url[len(retrieve_statement.MORE_ENDPOINT):]
 
         self.assertEqual(len(resp_json['statements']), 8)        
 
@@ -680,7 +681,7 @@ class StatementsMoreTests(TestCase):
         more_rsp = moreURLGet.content
         more_json = json.loads(more_rsp)
         more_resp_url = more_json['more']
-        more_resp_id = more_resp_url[-32:]
+        more_resp_id = more_resp_url[len(retrieve_statement.MORE_ENDPOINT):]
 
         self.assertIn(self.guid16, more_rsp)
         self.assertIn(self.guid15, more_rsp)
@@ -747,7 +748,7 @@ class StatementsMoreTests(TestCase):
         rsp = sinceGetResponse.content
         resp_json = json.loads(rsp)
         resp_url = resp_json['more']
-        resp_id = resp_url[-32:]
+        resp_id = resp_url[len(retrieve_statement.MORE_ENDPOINT):]
 
         self.assertEqual(len(resp_json['statements']), 10)
 
@@ -783,7 +784,7 @@ class StatementsMoreTests(TestCase):
         more_rsp = moreURLGet.content
         more_json = json.loads(more_rsp)
         more_resp_url = more_json['more']
-        more_resp_id = more_resp_url[-32:]
+        more_resp_id = more_resp_url[len(retrieve_statement.MORE_ENDPOINT):]
 
         self.assertIn(self.guid14, more_rsp)
         self.assertIn(self.guid13, more_rsp)
@@ -849,7 +850,7 @@ class StatementsMoreTests(TestCase):
         rsp = sinceGetResponse.content
         resp_json = json.loads(rsp)
         resp_url = resp_json['more']
-        resp_id = resp_url[-32:]
+        resp_id = resp_url[len(retrieve_statement.MORE_ENDPOINT):]
 
         self.assertEqual(len(resp_json['statements']), 10)        
         self.assertIn(self.guid24, rsp)
@@ -884,7 +885,7 @@ class StatementsMoreTests(TestCase):
         more_rsp = moreURLGet.content
         more_json = json.loads(more_rsp)
         more_resp_url = more_json['more']
-        more_resp_id = more_resp_url[-32:]
+        more_resp_id = more_resp_url[len(retrieve_statement.MORE_ENDPOINT):]
 
         self.assertIn(self.guid14, more_rsp)
         self.assertIn(self.guid13, more_rsp)
@@ -952,7 +953,7 @@ class StatementsMoreTests(TestCase):
         rsp = sinceGetResponse.content        
         resp_json = json.loads(rsp)
         resp_url = resp_json['more']
-        resp_id = resp_url[-32:]
+        resp_id = resp_url[len(retrieve_statement.MORE_ENDPOINT):]
 
         self.assertIn(self.guid24, rsp)
         self.assertIn(self.guid23, rsp)
@@ -986,7 +987,7 @@ class StatementsMoreTests(TestCase):
         more_rsp = moreURLGet.content
         more_json = json.loads(more_rsp)
         more_resp_url = more_json['more']
-        more_resp_id = more_resp_url[-32:]
+        more_resp_id = more_resp_url[len(retrieve_statement.MORE_ENDPOINT):]
 
         self.assertEqual(moreURLGet.status_code, 200)
         self.assertIn(self.guid14, more_rsp)
@@ -1052,7 +1053,7 @@ class StatementsMoreTests(TestCase):
         another_more_rsp = anotherMoreURLGet.content
         another_more_json = json.loads(another_more_rsp)
         another_more_resp_url = another_more_json['more']
-        another_more_resp_id = another_more_resp_url[-32:]
+        another_more_resp_id = another_more_resp_url[len(retrieve_statement.MORE_ENDPOINT):]
 
         self.assertEqual(anotherMoreURLGet.status_code, 200)
         self.assertIn(self.guid14, another_more_rsp)
@@ -1112,3 +1113,72 @@ class StatementsMoreTests(TestCase):
         self.assertNotIn(self.guid7, another_more2_rsp)
         self.assertNotIn(self.guid6, another_more2_rsp)
         self.assertNotIn(self.guid5, another_more2_rsp)
+
+    def test_more_stmts_same_stored_time(self):
+        # Give every stmt the same stored time so paging relies on the id tie breaker
+        time = retrieve_statement.convert_to_utc(str((datetime.utcnow()+timedelta(seconds=1)).replace(tzinfo=utc).isoformat()))
+        models.statement.objects.all().update(stored=time)
+
+        getResponse = self.client.get(reverse(views.statements), {"limit":10}, X_Experience_API_Version="0.95",HTTP_AUTHORIZATION=self.auth)
+        self.assertEqual(getResponse.status_code, 200)
+        resp_json = json.loads(getResponse.content)
+        self.assertEqual(len(resp_json['statements']), 10)
+        stmt_ids = [s['id'] for s in resp_json['statements']]
+
+        more_resp_url = resp_json['more']
+        while more_resp_url:
+            moreURLGet = self.client.get(reverse(views.statements_more,kwargs={'more_id':more_resp_url[len(retrieve_statement.MORE_ENDPOINT):]}), X_Experience_API_Version="0.95",HTTP_AUTHORIZATION=self.auth)
+            self.assertEqual(moreURLGet.status_code, 200)
+            more_json = json.loads(moreURLGet.content)
+            stmt_ids.extend([s['id'] for s in more_json['statements']])
+            more_resp_url = more_json['more']
+
+        self.assertEqual(len(stmt_ids), 25)
+        self.assertEqual(len(set(stmt_ids)), 25)
+
+    def test_tampered_more_id_url(self):
+        getResponse = self.client.get(reverse(views.statements), {"until":self.sixthTime}, X_Experience_API_Version="0.95",HTTP_AUTHORIZATION=self.auth)
+        self.assertEqual(getResponse.status_code, 200)
+        resp_id = json.loads(getResponse.content)['more'][len(retrieve_statement.MORE_ENDPOINT):]
+        # Signature is the last part of the token
+        tampered_id = resp_id[:-1] + ('a' if resp_id[-1] != 'a' else 'b')
+        moreURLGet = self.client.get(reverse(views.statements_more,kwargs={'more_id':tampered_id}), X_Experience_API_Version="0.95")
+        self.assertContains(moreURLGet, 'List does not exist - may have expired after 24 hours')
+
+    def test_stream_statement_result(self):
+        stmt_set = retrieve_statement.complex_get({"limit":10})
+        stream = retrieve_statement.stream_statement_result({"limit":10}, stmt_set)
+        # Nothing is read from the DB until the stream is consumed
+        with self.assertNumQueries(0):
+            self.assertEqual(stream.next(), '{"statements": [')
+        chunks = list(stream)
+        # One chunk per STREAM_CHUNK_SIZE statements and the closing more link
+        self.assertEqual(len(chunks), 2)
+        result = json.loads('{"statements": [' + ''.join(chunks))
+        self.assertEqual(len(result['statements']), 10)
+        self.assertTrue(result['more'].startswith(retrieve_statement.MORE_ENDPOINT))
+
+        # Each chunk of statements that aren't cached is hydrated together
+        hydrated = []
+        class CountingHydrator(StatementHydrator):
+            def __init__(self, stmts=None, activities=None):
+                hydrated.append(len(stmts))
+                StatementHydrator.__init__(self, stmts, activities)
+        chunk_size = retrieve_statement.STREAM_CHUNK_SIZE
+        retrieve_statement.STREAM_CHUNK_SIZE = 4
+        statement_cache.StatementHydrator = CountingHydrator
+        try:
+            statement_cache.rendered_statements.entries.clear()
+            statement_cache.rendered_statements.variants.clear()
+            chunks = list(retrieve_statement.stream_statement_result({"limit":10}, stmt_set))
+        finally:
+            retrieve_statement.STREAM_CHUNK_SIZE = chunk_size
+            statement_cache.StatementHydrator = StatementHydrator
+        self.assertEqual(hydrated, [4, 4, 2])
+        self.assertEqual(len(chunks), 5)
+        self.assertEqual(json.loads(''.join(chunks))['statements'], result['statements'])
+
+    def test_stream_nested_json(self):
+        data = {'a': {'b': [1, {'c': 'd'}], 'e': None}, 'f': (x for x in ['g', 'h'])}
+        chunks = list(req_process.stream_response_generator(data))
+        self.assertEqual(json.loads(''.join(chunks)), {'a': {'b': [1, {'c': 'd'}], 'e': None}, 'f': ['g', 'h']})
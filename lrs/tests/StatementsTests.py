@@ -14,6 +14,14 @@ from lrs.objects import Activity, Statement
 import time
 import urllib
 from lrs.util import retrieve_statement
+from django.core.management import call_command
+from django.db import DatabaseError
+from lrs.util import statement_cache
+from lrs.util import statement_spool
+from StringIO import StringIO
+import gzip
+import shutil
+import tempfile
 import pdb
 import hashlib
 import pprint
@@ -514,9 +522,367 @@ class StatementsTests(TestCase):
         
         self.assertEqual(actorObjectGetResponse.status_code, 200)
         stmts = json.loads(actorObjectGetResponse.content)
-        dbstmts = models.statement.objects.all()
-        # Will return 10 since that is server limit
-        self.assertEqual(len(stmts["statements"]), 10)
+        # An agent that doesn't exist can't be the object of anything
+        self.assertEqual(len(stmts["statements"]), 0)
+        self.assertEqual(stmts["more"], "")
+
+    def test_unknown_identifier_filters(self):
+        self.bunchostmts()
+        params = [{"verb":"http://adlnet.gov/expapi/verbs/nothing"}, {"registration": str(uuid.uuid1())},
+            {"object":{"objectType": "Activity", "id":"nothere"}}, {"actor":{"objectType": "Agent", "mbox":"nobody@example.com"}},
+            {"instructor":{"objectType": "Agent", "mbox":"nobody@example.com"}}, {"actor":{"objectType": "Agent", "name":"noifi"}}]
+        for param in params:
+            path = "%s?%s" % (reverse(views.statements), urllib.urlencode(param))
+            response = self.client.get(path, X_Experience_API_Version="0.95", Authorization=self.auth)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(json.loads(response.content)["statements"]), 0)
+
+    def test_my_statements_pages(self):
+        for i in range(settings.STMTS_PER_PAGE + 1):
+            self.client.post(reverse(views.statements), json.dumps({"actor":{"objectType":"Agent", "mbox":"t@t.com"},
+                "verb":{"id": "http://adlnet.gov/expapi/verbs/passed"}, "object": {"id":"act:mine%s" % i}}),
+                content_type="application/json", Authorization=self.auth, X_Experience_API_Version="0.95")
+        self.client.login(username=self.username, password=self.password)
+
+        first = json.loads(self.client.get(reverse(views.my_statements)).content)
+        self.assertEqual(len(first['stmts']), settings.STMTS_PER_PAGE)
+        self.assertNotIn('previous', first)
+        self.assertEqual(first['next'], "%s?page=2" % reverse(views.my_statements))
+
+        second = json.loads(self.client.get(reverse(views.my_statements), {'page': 2}).content)
+        self.assertEqual(len(second['stmts']), 1)
+        self.assertEqual(second['previous'], "%s?page=1" % reverse(views.my_statements))
+        self.assertNotIn('next', second)
+        self.assertNotIn(second['stmts'][0]['statement_id'], [st['statement_id'] for st in first['stmts']])
+
+    def test_conditional_get(self):
+        self.bunchostmts()
+        param = {"verb":"http://adlnet.gov/expapi/verbs/missed"}
+        path = "%s?%s" % (reverse(views.statements), urllib.urlencode(param))
+        response = self.client.get(path, X_Experience_API_Version="0.95", Authorization=self.auth)
+        self.assertEqual(response.status_code, 200)
+        tag = response['ETag']
+        last_modified = response['Last-Modified']
+
+        # Nothing changed so neither the query nor the serialization happen
+        response = self.client.get(path, X_Experience_API_Version="0.95", Authorization=self.auth,
+            HTTP_IF_NONE_MATCH=tag)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.content, '')
+        response = self.client.get(path, X_Experience_API_Version="0.95", Authorization=self.auth,
+            HTTP_IF_MODIFIED_SINCE=last_modified)
+        self.assertEqual(response.status_code, 304)
+
+        # Other filters have their own validator
+        response = self.client.get(reverse(views.statements), X_Experience_API_Version="0.95", Authorization=self.auth,
+            HTTP_IF_NONE_MATCH=tag)
+        self.assertEqual(response.status_code, 200)
+
+        # A new statement changes it
+        self.client.post(reverse(views.statements), json.dumps({"actor":{"objectType":"Agent", "mbox":"t@t.com"},
+            "verb":{"id": "http://adlnet.gov/expapi/verbs/missed"}, "object": {"id":"act:cond"}}),
+            content_type="application/json", Authorization=self.auth, X_Experience_API_Version="0.95")
+        response = self.client.get(path, X_Experience_API_Version="0.95", Authorization=self.auth,
+            HTTP_IF_NONE_MATCH=tag)
+        self.assertEqual(response.status_code, 200)
+        tag = response['ETag']
+
+        # So does deleting one
+        models.statement.objects.get(statement_id=self.guid9).delete()
+        response = self.client.get(path, X_Experience_API_Version="0.95", Authorization=self.auth,
+            HTTP_IF_NONE_MATCH=tag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn(self.guid9, response.content)
+
+    def test_archived_statements(self):
+        ids = [str(uuid.uuid4()) for i in range(4)]
+        for i, stmt_id in enumerate(ids):
+            stmt = {"statement_id":stmt_id, "actor":{"objectType":"Agent", "mbox":"old@t.com"},
+                "verb":{"id": "http://adlnet.gov/expapi/verbs/passed"}, "object": {"id":"act:archived%s" % i}}
+            if i == 0:
+                stmt["context"] = {"registration": ids[0]}
+            response = self.client.post(reverse(views.statements), json.dumps(stmt), content_type="application/json",
+                Authorization=self.auth, X_Experience_API_Version="0.95")
+            self.assertEqual(response.status_code, 200)
+        old = datetime.utcnow().replace(tzinfo=utc) - timedelta(days=400)
+        for i in range(3):
+            models.statement.objects.filter(statement_id=ids[i]).update(stored=old + timedelta(seconds=i))
+        call_command('archive_statements', stdout=StringIO())
+        self.assertEqual(models.statement_archive.objects.count(), 3)
+        self.assertEqual(list(models.statement.objects.filter(statement_id__in=ids).values_list('statement_id', flat=True)), [ids[3]])
+        self.assertEqual(models.context.objects.filter(registration=ids[0]).count(), 0)
+
+        # Pages run from the statement table into the archive
+        actor = json.dumps({"mbox":"old@t.com"})
+        path = "%s?%s" % (reverse(views.statements), urllib.urlencode({"actor":actor, "limit":2}))
+        first = json.loads(self.client.get(path, X_Experience_API_Version="0.95", Authorization=self.auth).content)
+        self.assertEqual([st['id'] for st in first['statements']], [ids[3], ids[2]])
+        more_id = first['more'][len(retrieve_statement.MORE_ENDPOINT):]
+        second = json.loads(self.client.get(reverse(views.statements_more, kwargs={'more_id':more_id}),
+            X_Experience_API_Version="0.95", HTTP_AUTHORIZATION=self.auth).content)
+        self.assertEqual([st['id'] for st in second['statements']], [ids[1], ids[0]])
+        self.assertEqual(second['more'], '')
+        path = "%s?%s" % (reverse(views.statements), urllib.urlencode({"actor":actor, "ascending":True}))
+        stmts = json.loads(self.client.get(path, X_Experience_API_Version="0.95", Authorization=self.auth).content)['statements']
+        self.assertEqual([st['id'] for st in stmts], ids)
+        path = "%s?%s" % (reverse(views.statements), urllib.urlencode({"registration":ids[0]}))
+        stmts = json.loads(self.client.get(path, X_Experience_API_Version="0.95", Authorization=self.auth).content)['statements']
+        self.assertEqual([st['id'] for st in stmts], [ids[0]])
+        # Queries that start after the archive never touch it
+        self.assertIsNone(retrieve_statement.archive_get({"since":self.firstTime}))
+
+        # Archived statements can still be fetched, voided and referenced, and their ids stay taken
+        path = "%s?%s" % (reverse(views.statements), urllib.urlencode({"statementId":ids[1]}))
+        self.assertFalse(json.loads(self.client.get(path, X_Experience_API_Version="0.95", Authorization=self.auth).content)['voided'])
+        response = self.client.post(reverse(views.statements), json.dumps({"actor":{"objectType":"Agent", "mbox":"old@t.com"},
+            "verb":{"id": "http://adlnet.gov/expapi/verbs/voided"}, "object": {"objectType":"StatementRef", "id":ids[1]}}),
+            content_type="application/json", Authorization=self.auth, X_Experience_API_Version="0.95")
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(json.loads(self.client.get(path, X_Experience_API_Version="0.95", Authorization=self.auth).content)['voided'])
+        response = self.client.post(reverse(views.statements), json.dumps({"statement_id":ids[0],
+            "actor":{"objectType":"Agent", "mbox":"old@t.com"}, "verb":{"id": "http://adlnet.gov/expapi/verbs/passed"},
+            "object": {"id":"act:archived0"}}), content_type="application/json", Authorization=self.auth, X_Experience_API_Version="0.95")
+        self.assertEqual(response.status_code, 409)
+
+    def test_export_statements(self):
+        ids = [str(uuid.uuid4()) for i in range(5)]
+        for i, stmt_id in enumerate(ids):
+            self.client.post(reverse(views.statements), json.dumps({"statement_id":stmt_id,
+                "actor":{"objectType":"Agent", "mbox":"export@t.com"}, "verb":{"id": "http://adlnet.gov/expapi/verbs/passed"},
+                "object": {"id":"act:export%s" % i}}), content_type="application/json", Authorization=self.auth,
+                X_Experience_API_Version="0.95")
+        old = datetime.utcnow().replace(tzinfo=utc) - timedelta(days=400)
+        for i in range(2):
+            models.statement.objects.filter(statement_id=ids[i]).update(stored=old + timedelta(seconds=i))
+        call_command('archive_statements', stdout=StringIO())
+
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            output = path.join(tmp_dir, 'stmts.json')
+            watermark = path.join(tmp_dir, 'watermark')
+            call_command('export_statements', output=output, watermark=watermark, batch=2, stderr=StringIO())
+            with open(output) as f:
+                exported = [json.loads(line) for line in f]
+            self.assertEqual([st['id'] for st in exported], ids)
+            self.assertEqual(exported[2], json.loads(statement_cache.get_statement_json(
+                models.statement.objects.get(statement_id=ids[2]), False)))
+
+            # Resuming only writes what was stored since
+            new_id = str(uuid.uuid4())
+            self.client.post(reverse(views.statements), json.dumps({"statement_id":new_id,
+                "actor":{"objectType":"Agent", "mbox":"export@t.com"}, "verb":{"id": "http://adlnet.gov/expapi/verbs/passed"},
+                "object": {"id":"act:export"}}), content_type="application/json", Authorization=self.auth,
+                X_Experience_API_Version="0.95")
+            call_command('export_statements', output=output, watermark=watermark, stderr=StringIO())
+            with open(output) as f:
+                self.assertEqual([json.loads(line)['id'] for line in f], ids + [new_id])
+
+            # Time ranges split the export between workers
+            boundary = (old + timedelta(days=1)).strftime(retrieve_statement.CURSOR_TIME_FORMAT)
+            gz_output = path.join(tmp_dir, 'old.json.gz')
+            call_command('export_statements', output=gz_output, until=boundary, gzip=True, stderr=StringIO())
+            with gzip.open(gz_output) as f:
+                self.assertEqual([json.loads(line)['id'] for line in f], ids[:2])
+            out = StringIO()
+            call_command('export_statements', since=boundary, stdout=out, stderr=StringIO())
+            self.assertEqual([json.loads(line)['id'] for line in out.getvalue().splitlines()], ids[2:] + [new_id])
+
+            # A gzip run that died partway through a batch resumes to a readable file without repeats
+            gz_watermark = path.join(tmp_dir, 'gz_watermark')
+            call_command('export_statements', output=gz_output, watermark=gz_watermark, until=boundary, gzip=True,
+                batch=1, stderr=StringIO())
+            with open(gz_output, 'ab') as f:
+                half = gzip.GzipFile(fileobj=f, mode='wb')
+                half.write(json.dumps({'id': 'partial'}) + '\n')
+                half.flush()
+            call_command('export_statements', output=gz_output, watermark=gz_watermark, gzip=True, batch=1,
+                stderr=StringIO())
+            with gzip.open(gz_output) as f:
+                self.assertEqual([json.loads(line)['id'] for line in f], ids + [new_id])
+        finally:
+            shutil.rmtree(tmp_dir)
+
+    def test_statement_rollups(self):
+        passed, failed = "http://adlnet.gov/expapi/verbs/passed", "http://adlnet.gov/expapi/verbs/failed"
+        ids = [str(uuid.uuid4()) for i in range(4)]
+        for stmt_id, verb, act in zip(ids, (passed, passed, failed, passed), ("act:rollup0",) * 3 + ("act:rollup1",)):
+            response = self.client.post(reverse(views.statements), json.dumps({"statement_id":stmt_id,
+                "actor":{"objectType":"Agent", "mbox":"rollup@t.com"}, "verb":{"id":verb}, "object":{"id":act}}),
+                content_type="application/json", Authorization=self.auth, X_Experience_API_Version="0.95")
+            self.assertEqual(response.status_code, 200)
+        old = datetime.utcnow().replace(tzinfo=utc) - timedelta(days=400)
+        models.statement.objects.filter(statement_id=ids[0]).update(stored=old)
+        call_command('rebuild_statement_rollups', stdout=StringIO())
+        call_command('archive_statements', stdout=StringIO())
+
+        def get_rollups(**params):
+            path = "%s?%s" % (reverse(views.statement_rollups), urllib.urlencode(params))
+            response = self.client.get(path, Authorization=self.auth, X_Experience_API_Version="0.95")
+            self.assertEqual(response.status_code, 200)
+            return json.loads(response.content)['rollups']
+        def by_verb():
+            return dict((r['verb'], r['count']) for r in get_rollups(activity="act:rollup0", by="verb"))
+
+        self.assertEqual(by_verb(), {passed:2, failed:1})
+        today = datetime.utcnow().replace(tzinfo=utc).date()
+        self.assertEqual(get_rollups(verb=passed, by="day,activity"), [
+            {"day":old.strftime('%Y-%m-%d'), "activity":"act:rollup0", "count":1},
+            {"day":today.strftime('%Y-%m-%d'), "activity":"act:rollup0", "count":1},
+            {"day":today.strftime('%Y-%m-%d'), "activity":"act:rollup1", "count":1}])
+        self.assertEqual(get_rollups(verb=passed, since=today.strftime('%Y-%m-%d'), by=""), [{"count":2}])
+
+        # Voiding takes the statement out, archived or not, and deleting the voiding statement puts it back
+        for stmt_id in ids[:2]:
+            response = self.client.post(reverse(views.statements), json.dumps({"actor":{"objectType":"Agent",
+                "mbox":"rollup@t.com"}, "verb":{"id": "http://adlnet.gov/expapi/verbs/voided"},
+                "object":{"objectType":"StatementRef", "id":stmt_id}}), content_type="application/json",
+                Authorization=self.auth, X_Experience_API_Version="0.95")
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(by_verb(), {failed:1})
+        models.statement.objects.get(stmt_object__in=models.StatementRef.objects.filter(ref_id=ids[1])).delete()
+        self.assertEqual(by_verb(), {passed:1, failed:1})
+        rollups = get_rollups()
+        self.assertEqual(rollups[0]['authority']['name'], self.username)
+
+        # Rebuilding comes up with the same counts
+        call_command('rebuild_statement_rollups', stdout=StringIO())
+        self.assertEqual(get_rollups(), rollups)
+
+        path = "%s?%s" % (reverse(views.statement_rollups), urllib.urlencode({"by":"registration"}))
+        self.assertEqual(self.client.get(path, Authorization=self.auth, X_Experience_API_Version="0.95").status_code, 400)
+
+    def test_related_activities_filter(self):
+        ids = [str(uuid.uuid4()) for i in range(4)]
+        stmts = [({"id":"act:course"}, None), ({"id":"act:lesson1"}, {"parent":{"id":"act:course"}}),
+            ({"id":"act:lesson2"}, {"grouping":{"id":"act:course"}}), ({"id":"act:quiz"}, {"other":{"id":"act:lesson1"}})]
+        for stmt_id, (obj, con_acts) in zip(ids, stmts):
+            stmt = {"statement_id":stmt_id, "actor":{"objectType":"Agent", "mbox":"related@t.com"},
+                "verb":{"id": "http://adlnet.gov/expapi/verbs/passed"}, "object":obj}
+            if con_acts:
+                stmt["context"] = {"contextActivities":con_acts}
+            response = self.client.post(reverse(views.statements), json.dumps(stmt), content_type="application/json",
+                Authorization=self.auth, X_Experience_API_Version="0.95")
+            self.assertEqual(response.status_code, 200)
+
+        def get_ids(**params):
+            path = "%s?%s" % (reverse(views.statements), urllib.urlencode(params))
+            response = self.client.get(path, X_Experience_API_Version="0.95", Authorization=self.auth)
+            return set(st['id'] for st in json.loads(response.content)['statements'])
+
+        course = json.dumps({"id":"act:course"})
+        self.assertEqual(get_ids(object=course), set(ids[:1]))
+        self.assertEqual(get_ids(object=course, related_activities="true"), set(ids[:3]))
+        self.assertEqual(get_ids(object=course, related_activities="parent"), set(ids[:2]))
+        self.assertEqual(get_ids(object=json.dumps({"id":"act:lesson1"}), related_activities="true"), set([ids[1], ids[3]]))
+        self.assertEqual(get_ids(object=json.dumps({"id":"act:nowhere"}), related_activities="true"), set())
+
+        # Statements stored before the mapping existed are picked up by the backfill
+        models.statement_context_activity.objects.all().delete()
+        self.assertEqual(get_ids(object=course, related_activities="true"), set(ids[:1]))
+        call_command('index_context_activities', stdout=StringIO())
+        call_command('index_context_activities', stdout=StringIO())
+        self.assertEqual(models.statement_context_activity.objects.count(), 3)
+        self.assertEqual(get_ids(object=course, related_activities="true"), set(ids[:3]))
+
+    def test_async_ingest(self):
+        tmp_dir = tempfile.mkdtemp()
+        spool_path = settings.STMT_SPOOL_PATH
+        settings.STMT_ASYNC_INGEST = True
+        settings.STMT_SPOOL_PATH = path.join(tmp_dir, 'spool.db')
+        try:
+            stmt_id, void_id = str(uuid.uuid4()), str(uuid.uuid4())
+            stmts = [{"statement_id":stmt_id, "actor":{"objectType":"Agent", "mbox":"async@t.com"},
+                "verb":{"id": "http://adlnet.gov/expapi/verbs/passed"}, "object":{"id":"act:async"}},
+                {"actor":{"objectType":"Agent", "mbox":"async@t.com"}, "verb":{"id": "http://adlnet.gov/expapi/verbs/passed"},
+                "object":{"id":"act:async"}}]
+            response = self.client.post(reverse(views.statements), json.dumps(stmts), content_type="application/json",
+                Authorization=self.auth, X_Experience_API_Version="0.95")
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.content.startswith(stmt_id))
+            other_id = response.content[len(stmt_id):]
+            self.assertEqual(len(other_id), len(stmt_id))
+            self.assertFalse(models.statement.objects.filter(statement_id__in=[stmt_id, other_id]).exists())
+
+            # Ids already spooled are taken
+            path_put = "%s?%s" % (reverse(views.statements), urllib.urlencode({"statementId":stmt_id}))
+            response = self.client.put(path_put, json.dumps(stmts[1]), content_type="application/json",
+                Authorization=self.auth, X_Experience_API_Version="0.95")
+            self.assertEqual(response.status_code, 409)
+            # Voiding a statement that doesn't exist is only found out when it's saved
+            response = self.client.post(reverse(views.statements), json.dumps({"statement_id":void_id,
+                "actor":{"objectType":"Agent", "mbox":"async@t.com"}, "verb":{"id": "http://adlnet.gov/expapi/verbs/voided"},
+                "object":{"objectType":"StatementRef", "id":str(uuid.uuid4())}}), content_type="application/json",
+                Authorization=self.auth, X_Experience_API_Version="0.95")
+            self.assertEqual(response.status_code, 200)
+
+            get_path = "%s?%s" % (reverse(views.statements), urllib.urlencode({"statementId":other_id}))
+            response = self.client.get(get_path, X_Experience_API_Version="0.95", Authorization=self.auth)
+            self.assertEqual(response.status_code, 202)
+            self.assertEqual(json.loads(response.content), {"id":other_id, "state":"accepted"})
+
+            call_command('process_statement_spool', once=True, stdout=StringIO())
+            response = self.client.get(get_path, X_Experience_API_Version="0.95", Authorization=self.auth)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(json.loads(response.content)['actor']['mbox'], "async@t.com")
+            self.assertTrue(models.statement.objects.filter(statement_id=stmt_id).exists())
+            get_path = "%s?%s" % (reverse(views.statements), urllib.urlencode({"statementId":void_id, "wait":1}))
+            response = self.client.get(get_path, X_Experience_API_Version="0.95", Authorization=self.auth)
+            self.assertEqual(response.status_code, 400)
+            self.assertIn("could not be saved", response.content)
+
+            # A fixed statement can be sent again with the id of one that failed
+            response = self.client.post(reverse(views.statements), json.dumps({"statement_id":void_id,
+                "actor":{"objectType":"Agent", "mbox":"async@t.com"}, "verb":{"id": "http://adlnet.gov/expapi/verbs/passed"},
+                "object":{"id":"act:async"}}), content_type="application/json", Authorization=self.auth,
+                X_Experience_API_Version="0.95")
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(statement_spool.get_state(void_id), (statement_spool.ACCEPTED, None))
+            self.assertTrue(statement_spool.process_next())
+            self.assertTrue(models.statement.objects.filter(statement_id=void_id).exists())
+
+            # An entry that was saved but not taken out isn't saved twice
+            saved_id, taken_id = str(uuid.uuid4()), str(uuid.uuid4())
+            statement_spool.enqueue([dict(stmts[1], statement_id=saved_id)])
+            conn = statement_spool.get_connection()
+            seq, accepted = conn.execute('SELECT seq, accepted FROM spool ORDER BY seq DESC LIMIT 1').fetchone()
+            statement_spool.save_entry(statement_spool.get_entry_key(seq, accepted),
+                [dict(stmts[1], statement_id=saved_id)], None)
+            self.assertTrue(statement_spool.process_next())
+            self.assertIsNone(statement_spool.get_state(saved_id))
+            self.assertEqual(models.statement.objects.filter(statement_id=saved_id).count(), 1)
+            self.assertFalse(models.spooled_batch.objects.exists())
+
+            # Ids someone else saved first fail the entry as a conflict
+            statement_spool.enqueue([dict(stmts[1], statement_id=taken_id)])
+            Statement.save_batch([dict(stmts[1], statement_id=taken_id)])
+            self.assertTrue(statement_spool.process_next())
+            state, error = statement_spool.get_state(taken_id)
+            self.assertEqual(state, statement_spool.FAILED)
+            self.assertIn("already exists", error)
+
+            # A database error leaves the entry to be tried again
+            down_id = str(uuid.uuid4())
+            statement_spool.enqueue([dict(stmts[1], statement_id=down_id)])
+            save_batch = Statement.save_batch
+            def fail(*args, **kwargs):
+                raise DatabaseError('database is down')
+            Statement.save_batch = fail
+            try:
+                self.assertRaises(DatabaseError, statement_spool.process_next)
+                # call_command exits on the CommandError
+                err = StringIO()
+                self.assertRaises(SystemExit, call_command, 'process_statement_spool', once=True,
+                    stdout=StringIO(), stderr=err)
+                self.assertIn('database is down', err.getvalue())
+            finally:
+                Statement.save_batch = save_batch
+            self.assertEqual(statement_spool.get_state(down_id), (statement_spool.ACCEPTED, None))
+            self.assertTrue(statement_spool.process_next())
+            self.assertTrue(models.statement.objects.filter(statement_id=down_id).exists())
+        finally:
+            settings.STMT_ASYNC_INGEST = False
+            settings.STMT_SPOOL_PATH = spool_path
+            shutil.rmtree(tmp_dir)
 
     def test_verb_filter(self):
         self.bunchostmts()
@@ -1398,7 +1764,8 @@ class StatementsTests(TestCase):
 
         self.assertEqual(len(statements), 11)
         self.assertEqual(voided_st.voided, False)
-        self.assertEqual(len(voided_verb), 1)
+        # The batch is checked before any of it is saved, so the voided verb never gets created
+        self.assertEqual(len(voided_verb), 0)
         self.assertEqual(len(only_actor), 0)
 
     def test_post_list_rollback_with_subs(self):
@@ -2,7 +2,8 @@ from django.conf.urls import patterns, include, url
 
 urlpatterns = patterns('lrs.views',
     url(r'^$', 'home'),
-    url(r'^statements/more/(?P<more_id>.{32})$', 'statements_more'),
+    url(r'^statements/more/(?P<more_id>[\w\-\.:]+)$', 'statements_more'),
+    url(r'^statements/rollups', 'statement_rollups'),
     url(r'^statements', 'statements'),
     url(r'^activities/state', 'activity_state'),
     url(r'^activities/profile', 'activity_profile'),
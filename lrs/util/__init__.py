@@ -1,8 +1,14 @@
 from django.contrib.auth.models import User
+from collections import OrderedDict
+from django.db import transaction
 from lrs.models import Consumer, SystemAction
+from functools import wraps
 import logging
+import threading
 
 logger = logging.getLogger('user_system_actions')
+# Callbacks waiting for the transaction each thread is running to commit
+local = threading.local()
 
 def get_user_from_auth(auth):
     if not auth:
@@ -18,6 +24,56 @@ def get_user_from_auth(auth):
         user = Consumer.objects.get(key__exact=key).user
     return user
 
+def commit_on_success_unless_managed(func):
+    # transaction.commit_on_success commits whatever transaction is open when it returns, so
+    # anything already running in one (a batch of statements) joins it instead
+    @wraps(func)
+    def inner(*args, **kwargs):
+        if transaction.is_managed():
+            return func(*args, **kwargs)
+        local.callbacks = []
+        local.pending = OrderedDict()
+        try:
+            ret = transaction.commit_on_success(flush_before_commit(func))(*args, **kwargs)
+            callbacks = local.callbacks
+        finally:
+            local.callbacks = None
+            local.pending = None
+        for callback in callbacks:
+            callback()
+        return ret
+    return inner
+
+def flush_before_commit(func):
+    @wraps(func)
+    def inner(*args, **kwargs):
+        ret = func(*args, **kwargs)
+        for pending in local.pending.values():
+            pending()
+        return ret
+    return inner
+
+def on_commit(func):
+    # Runs func after the transaction commit_on_success_unless_managed opened commits, and not at
+    # all if it rolls back. Runs it right away outside of a transaction, and never in one opened
+    # by something else since there's no telling if that commits
+    callbacks = getattr(local, 'callbacks', None)
+    if callbacks is not None:
+        callbacks.append(func)
+    elif not transaction.is_managed():
+        func()
+
+def before_commit(key, factory):
+    # The object factory made for key in the transaction commit_on_success_unless_managed opened,
+    # made the first time it's asked for. It's called with no arguments in the transaction, after
+    # everything else and just before it commits. None outside of one
+    pending = getattr(local, 'pending', None)
+    if pending is None:
+        return None
+    if key not in pending:
+        pending[key] = factory()
+    return pending[key]
+
 def log_info_processing(log_dict, method, func_name):
     if log_dict:
         log_dict['message'] = 'Processing %s data in %s' % (method, func_name)
@@ -0,0 +1,184 @@
+from datetime import datetime, timedelta
+from django.conf import settings
+from django.db import IntegrityError, transaction
+from django.utils.timezone import utc
+from lrs import exceptions, models
+import json
+import threading
+import urllib2
+import urlparse
+
+# Number of requested IRIs each resolve() call fetches
+BATCH_SIZE = 100
+# Metadata documents are small, anything bigger isn't one
+MAX_DOCUMENT_SIZE = 1024 * 1024
+
+def get_now():
+    return datetime.utcnow().replace(tzinfo=utc)
+
+def can_resolve(iri):
+    # Only http(s) IRIs are fetched, most activity ids aren't meant to resolve at all
+    return urlparse.urlparse(iri).scheme in ('http', 'https')
+
+def load(iris):
+    # The rows request() needs for a number of IRIs in one query, None for the ones without a row
+    iris = [iri for iri in iris if can_resolve(iri)]
+    rows = dict((iri, None) for iri in iris)
+    if iris:
+        for row in models.activity_metadata.objects.filter(activity_id__in=iris).values_list('activity_id',
+                'definition', 'expires', 'requested', 'link'):
+            rows[row[0]] = row[1:]
+    return rows
+
+def request(iri, link=False, rows=None):
+    # Leaves the IRI for resolve() when it was never fetched or what was found expired, returns
+    # the definition last found there as JSON. Runs in the caller's transaction. rows is what
+    # load() returned, kept up to date for the next request
+    now = get_now()
+    if rows is not None and iri in rows:
+        row = rows[iri]
+    else:
+        row = (list(models.activity_metadata.objects.filter(activity_id=iri).values_list('definition',
+            'expires', 'requested', 'link')[:1]) or [None])[0]
+    if row is None:
+        sid = transaction.savepoint()
+        try:
+            models.activity_metadata.objects.create(activity_id=iri, requested=now, link=link)
+            transaction.savepoint_commit(sid)
+            if rows is not None:
+                rows[iri] = (None, None, now, link)
+        except IntegrityError:
+            # Another statement asked for it first
+            transaction.savepoint_rollback(sid)
+            if link:
+                models.activity_metadata.objects.filter(activity_id=iri).update(link=True)
+            if rows is not None:
+                rows.pop(iri, None)
+        return None
+
+    definition, expires, requested, was_link = row
+    if link and not was_link:
+        # Whatever was found there before isn't used anymore
+        models.activity_metadata.objects.filter(activity_id=iri).update(link=True, definition=None)
+        definition = None
+    if requested is None and (expires is None or expires <= now):
+        models.activity_metadata.objects.filter(activity_id=iri, requested__isnull=True).update(requested=now)
+        requested = now
+    if rows is not None:
+        rows[iri] = (definition, expires, requested, was_link or link)
+    return definition
+
+def get_definition(iri, rows=None):
+    # The definition last found at the IRI, {} if there isn't one (yet). Never fetches
+    if not can_resolve(iri):
+        return {}
+    definition = request(iri, rows=rows)
+    # An expired definition is still used until it's fetched again
+    return json.loads(definition) if definition else {}
+
+def check_link(iri, rows=None):
+    # Link IDs have to resolve, resolve() records whether they do and leaves the activity alone
+    if can_resolve(iri):
+        request(iri, link=True, rows=rows)
+
+def get_host(iri):
+    return urlparse.urlparse(iri).netloc.lower()
+
+def fetch_all(iris, fetch, workers, per_host):
+    # Calls fetch for every IRI on up to workers threads, with no more than per_host calls for
+    # the same host at once. A worker takes the first IRI whose host has room, so a slow host only
+    # holds up its own IRIs. Returns IRI -> result, None where fetch raised
+    pending = list(iris)
+    busy = {}
+    results = {}
+    cond = threading.Condition()
+
+    def take():
+        for i, iri in enumerate(pending):
+            if busy.get(get_host(iri), 0) < per_host:
+                return pending.pop(i)
+        return None
+
+    def work():
+        while True:
+            with cond:
+                iri = take()
+                while iri is None and pending:
+                    cond.wait()
+                    iri = take()
+                if iri is None:
+                    return
+                host = get_host(iri)
+                busy[host] = busy.get(host, 0) + 1
+            try:
+                result = fetch(iri)
+            except Exception:
+                result = None
+            with cond:
+                results[iri] = result
+                busy[host] -= 1
+                cond.notify_all()
+
+    threads = [threading.Thread(target=work) for i in range(min(workers, len(pending)))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+def fetch_definition(iri):
+    # (True, the definition in the metadata document at the IRI or None). Raises when the IRI
+    # doesn't resolve, error statuses included
+    # lrs.objects imports this module, so it can't be imported at the top
+    from lrs.objects.Activity import read_metadata
+    resp = urllib2.urlopen(iri, timeout=settings.ACTIVITY_METADATA_TIMEOUT)
+    try:
+        return True, read_metadata(resp.read(MAX_DOCUMENT_SIZE + 1)[:MAX_DOCUMENT_SIZE]) or None
+    finally:
+        resp.close()
+
+def fetch_reachable(iri):
+    # (True, None), link IDs only have to resolve. Raises when the IRI doesn't
+    urllib2.urlopen(iri, timeout=settings.ACTIVITY_METADATA_TIMEOUT).close()
+    return True, None
+
+def fetch(iri, link):
+    return fetch_reachable(iri) if link else fetch_definition(iri)
+
+def store(iri, reachable, definition):
+    now = get_now()
+    ttl = settings.ACTIVITY_METADATA_TTL if definition else settings.ACTIVITY_METADATA_MISS_TTL
+    models.activity_metadata.objects.filter(activity_id=iri).update(definition=definition and json.dumps(definition),
+        reachable=reachable, expires=now + timedelta(seconds=ttl), requested=None)
+
+def fill_in(iri):
+    # Gives the activity the definition that was just stored, the same way a statement naming it
+    # without a definition would. False when the definition isn't one an activity can have
+    from lrs.objects.Activity import Activity
+    if not models.activity.objects.filter(activity_id=iri).exists():
+        return True
+    try:
+        Activity({'objectType': 'Activity', 'id': iri})
+    except exceptions.BadRequest:
+        return False
+    return True
+
+def resolve(batch_size=BATCH_SIZE):
+    # Fetches the IRIs that have waited longest, each once however many statements asked for it.
+    # Returns how many it did. The threads only fetch
+    # and parse, results are saved here so nothing shares a database connection
+    links = dict(models.activity_metadata.objects.filter(requested__isnull=False).order_by('requested').values_list(
+        'activity_id', 'link')[:batch_size])
+    iris = links.keys()
+    if not iris:
+        return 0
+    results = fetch_all(iris, lambda iri: fetch(iri, links[iri]), settings.ACTIVITY_METADATA_WORKERS,
+        settings.ACTIVITY_METADATA_PER_HOST)
+    for iri in iris:
+        reachable, definition = results.get(iri, None) or (False, None)
+        store(iri, reachable, definition)
+        if definition and not fill_in(iri):
+            # Statements naming the activity would fail on it
+            store(iri, reachable, None)
+    return len(iris)
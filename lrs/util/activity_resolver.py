@@ -0,0 +1,99 @@
+from collections import OrderedDict
+from django.conf import settings
+from lrs import models
+import threading
+import time
+
+class ActivityResolver():
+    # LRU of activity IRI -> activity pks, with the IRIs cached for each pk so a row reusing a
+    # rolled back pk drops them. Unknown IRIs are kept as () until they expire, since another
+    # process can create the activity without this one hearing about it
+    def __init__(self, size, miss_timeout):
+        self.size = size
+        self.miss_timeout = miss_timeout
+        self.entries = OrderedDict()
+        self.iris_by_pk = {}
+        # Bumped on every invalidation so a lookup that raced with one isn't cached
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def get(self, iri):
+        with self.lock:
+            entry = self.entries.pop(iri, None)
+            if entry is None:
+                return None
+            pks, expires = entry
+            if expires is not None and expires <= time.time():
+                self._forget(iri, entry)
+                return None
+            self.entries[iri] = entry
+            return pks
+
+    def set(self, iri, pks, generation):
+        with self.lock:
+            if generation != self.generation:
+                return
+            expires = None if pks else time.time() + self.miss_timeout
+            self._forget(iri, self.entries.pop(iri, None))
+            self.entries[iri] = (pks, expires)
+            for pk in pks:
+                self.iris_by_pk.setdefault(pk, set()).add(iri)
+            while len(self.entries) > self.size:
+                self._forget(*self.entries.popitem(last=False))
+
+    def get_iris(self, pk):
+        with self.lock:
+            return set(self.iris_by_pk.get(pk, ()))
+
+    def invalidate(self, iris):
+        with self.lock:
+            self.generation += 1
+            for iri in iris:
+                self._forget(iri, self.entries.pop(iri, None))
+
+    def _forget(self, iri, entry):
+        # entry has already been taken out of entries
+        if entry is None:
+            return
+        for pk in entry[0]:
+            iris = self.iris_by_pk.get(pk, None)
+            if iris is not None:
+                iris.discard(iri)
+                if not iris:
+                    del self.iris_by_pk[pk]
+
+activities = ActivityResolver(settings.ACTIVITY_CACHE_SIZE, settings.ACTIVITY_MISS_TIMEOUT)
+
+def resolve(iri):
+    # pks of the activities with the IRI, oldest first - () when there aren't any
+    pks = activities.get(iri)
+    if pks is None:
+        generation = activities.generation
+        pks = tuple(models.activity.objects.filter(activity_id=iri).order_by('pk').values_list('pk', flat=True))
+        activities.set(iri, pks, generation)
+    return pks
+
+def resolve_many(iris):
+    # resolve() for a number of IRIs at once, the ones that aren't cached are looked up together
+    pks_by_iri = dict((iri, activities.get(iri)) for iri in iris)
+    missing = [iri for iri, pks in pks_by_iri.items() if pks is None]
+    if missing:
+        generation = activities.generation
+        found = dict((iri, []) for iri in missing)
+        for iri, pk in models.activity.objects.filter(activity_id__in=missing).order_by('pk').values_list(
+                'activity_id', 'pk'):
+            found[iri].append(pk)
+        for iri, pks in found.items():
+            pks_by_iri[iri] = tuple(pks)
+            activities.set(iri, pks_by_iri[iri], generation)
+    return pks_by_iri
+
+def get_activity_pk(iri):
+    # The pk of the activity with the IRI, raises activity.DoesNotExist when it isn't on record
+    pks = resolve(iri)
+    if not pks:
+        raise models.activity.DoesNotExist('No activity has the id %s' % iri)
+    return pks[0]
+
+def activity_changed(instance):
+    activities.invalidate(activities.get_iris(instance.pk) | set([instance.activity_id]))
@@ -0,0 +1,261 @@
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import get_cache
+from django.db.models import Q
+from lrs import models
+from lrs.util import on_commit
+import ast
+import hashlib
+import json
+import threading
+import uuid
+
+AGENT_IFIS = ('mbox', 'mbox_sha1sum', 'openid')
+
+class AgentResolver():
+    # LRU of identifier key -> (agent pks, stamp), with the keys cached for each pk so saves and
+    # deletes can drop them. The stamp is the identifier's version in the shared cache when the pks
+    # were looked up - every process changing an agent with the identifier replaces it
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.keys_by_pk = {}
+        # Bumped on every invalidation so a lookup that raced with one isn't cached
+        self.generation = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, stamp):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is None:
+                return None
+            if entry[1] != stamp:
+                # Changed by another process
+                self.entries[key] = entry
+                self._forget(key)
+                return None
+            self.entries[key] = entry
+            return entry[0]
+
+    def set(self, key, pks, stamp, generation):
+        with self.lock:
+            if generation != self.generation:
+                return
+            self._forget(key)
+            self.entries[key] = (pks, stamp)
+            for pk in pks:
+                self.keys_by_pk.setdefault(pk, set()).add(key)
+            while len(self.entries) > self.size:
+                self._forget(next(iter(self.entries)))
+
+    def get_keys(self, pk):
+        with self.lock:
+            return set(self.keys_by_pk.get(pk, ()))
+
+    def invalidate(self, keys):
+        with self.lock:
+            self.generation += 1
+            for key in keys:
+                self._forget(key)
+
+    def _forget(self, key):
+        for pk in self.entries.pop(key, ((), None))[0]:
+            keys = self.keys_by_pk.get(pk, None)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self.keys_by_pk[pk]
+
+agents = AgentResolver(settings.AGENT_CACHE_SIZE)
+# Without a version cache nothing is remembered, every process could be caching agents another
+# one has changed
+stamps = get_cache(settings.AGENT_VERSION_CACHE) if settings.AGENT_VERSION_CACHE else None
+
+def get_stamp_key(key):
+    # Identifiers aren't always safe to use as cache keys
+    return 'agent_version:%s' % hashlib.sha1(json.dumps(key)).hexdigest()
+
+def get_stamp(key):
+    # None when there's no version cache
+    if stamps is None:
+        return None
+    stamp_key = get_stamp_key(key)
+    stamp = stamps.get(stamp_key)
+    if stamp is None:
+        # Evicted or never set, every process looks the identifier up again once
+        stamps.add(stamp_key, uuid.uuid4().hex)
+        stamp = stamps.get(stamp_key)
+    return stamp
+
+def bump_stamps(keys):
+    if stamps is None:
+        return
+    for key in keys:
+        stamps.set(get_stamp_key(key), uuid.uuid4().hex)
+
+def invalidate(keys):
+    # Other processes could look the identifiers up again before the change commits and cache
+    # what they found then, so their stamps are replaced again once it has
+    keys = set(keys)
+    agents.invalidate(keys)
+    bump_stamps(keys)
+    on_commit(lambda: bump_stamps(keys))
+
+def load_account(account):
+    if isinstance(account, dict):
+        return account
+    try:
+        return ast.literal_eval(account)
+    except:
+        return json.loads(account)
+
+def get_ifi_key(agent_data):
+    # The one inverse functional identifier in agent_data as a key, None when there isn't exactly one
+    ifis = [ifi for ifi in AGENT_IFIS if agent_data.get(ifi, None)]
+    if agent_data.get('account', None):
+        ifis.append('account')
+    if len(ifis) != 1:
+        return None
+    if ifis[0] != 'account' and not isinstance(agent_data[ifis[0]], basestring):
+        return None
+    kind = 'Group' if agent_data.get('objectType', None) == 'Group' else 'Agent'
+    if ifis[0] == 'account':
+        account = load_account(agent_data['account'])
+        if not isinstance(account, dict):
+            return None
+        home_page, name = account.get('homePage', None), account.get('name', None)
+        if not all(v is None or isinstance(v, basestring) for v in (home_page, name)):
+            return None
+        return (kind, 'account', home_page, name)
+    return (kind, ifis[0], agent_data[ifis[0]])
+
+def lookup_pks(key):
+    kind, ifi = key[0], key[1]
+    if ifi == 'account':
+        kwargs = {'agent_account__name': key[3]}
+        # No homePage matches the name on any homePage
+        if key[2]:
+            kwargs['agent_account__homePage'] = key[2]
+    else:
+        kwargs = {ifi: key[2]}
+    if kind == 'Group':
+        kwargs['objectType'] = 'Group'
+    return tuple(models.agent.objects.filter(**kwargs).order_by('pk').values_list('pk', flat=True))
+
+def lookup_many(keys):
+    # lookup_pks for every key, one query for the mbox, mbox_sha1sum and openid keys and one for the
+    # accounts
+    found = dict((key, []) for key in keys)
+    ifi_filter = Q()
+    for ifi in AGENT_IFIS:
+        values = [key[2] for key in keys if key[1] == ifi]
+        if values:
+            ifi_filter |= Q(**{'%s__in' % ifi: values})
+    if ifi_filter:
+        for row in models.agent.objects.filter(ifi_filter).values_list('pk', 'objectType', *AGENT_IFIS):
+            pk, kinds = row[0], ('Agent', 'Group') if row[1] == 'Group' else ('Agent',)
+            for ifi, value in zip(AGENT_IFIS, row[2:]):
+                for kind in kinds:
+                    if (kind, ifi, value) in found:
+                        found[(kind, ifi, value)].append(pk)
+    keys_by_name = {}
+    for key in keys:
+        if key[1] == 'account':
+            keys_by_name.setdefault(key[3], []).append(key)
+    if keys_by_name:
+        for pk, object_type, home_page, name in models.agent_account.objects.filter(
+                name__in=keys_by_name.keys()).values_list('agent_id', 'agent__objectType', 'homePage', 'name'):
+            for key in keys_by_name.get(name, ()):
+                # No homePage matches the name on any homePage
+                if (key[0] == 'Agent' or object_type == 'Group') and (not key[2] or key[2] == home_page):
+                    found[key].append(pk)
+    return dict((key, tuple(sorted(pks))) for key, pks in found.items())
+
+def resolve_many(agents_data):
+    # resolve() for a number of agents at once, by identifier key. The ones that aren't cached
+    # are looked up together
+    pks_by_key = {}
+    missing = []
+    for agent_data in agents_data:
+        key = get_ifi_key(agent_data)
+        if key is None or key in pks_by_key:
+            continue
+        stamp = get_stamp(key)
+        pks_by_key[key] = agents.get(key, stamp) if stamps is not None else None
+        if pks_by_key[key] is None:
+            missing.append((key, stamp))
+    if missing:
+        generation = agents.generation
+        found = lookup_many([key for key, stamp in missing])
+        for key, stamp in missing:
+            pks_by_key[key] = found[key]
+            if found[key] and stamps is not None:
+                agents.set(key, found[key], stamp, generation)
+    return pks_by_key
+
+def resolve(agent_data):
+    # pks of every agent agent_data identifies, oldest first. None when it doesn't have exactly
+    # one identifier
+    key = get_ifi_key(agent_data)
+    if key is None:
+        return None
+    if stamps is None:
+        return lookup_pks(key)
+    stamp = get_stamp(key)
+    pks = agents.get(key, stamp)
+    if pks is None:
+        generation = agents.generation
+        pks = lookup_pks(key)
+        # Unknown identifiers aren't remembered, the next request may create the agent
+        if pks:
+            agents.set(key, pks, stamp, generation)
+    return pks
+
+def get_agent(agent_data, model=models.agent):
+    # The agent (or group) agent_data identifies - the oldest one if there are duplicates
+    pks = resolve(agent_data)
+    if pks is None:
+        return model.objects.get(**agent_data)
+    if pks:
+        try:
+            return model.objects.get(pk=pks[0])
+        except model.DoesNotExist:
+            # Deleted by another process after it was cached here
+            invalidate([get_ifi_key(agent_data)])
+            pks = resolve(agent_data)
+    if not pks:
+        raise model.DoesNotExist('No %s matches %s' % (model.__name__, agent_data))
+    return model.objects.get(pk=pks[0])
+
+def get_instance_keys(instance):
+    keys = set()
+    for ifi in AGENT_IFIS:
+        value = getattr(instance, ifi)
+        if value:
+            # What the column holds, even if the agent was given something other than a string
+            value = unicode(value)
+            keys.add(('Agent', ifi, value))
+            if instance.objectType == 'Group':
+                keys.add(('Group', ifi, value))
+    return keys
+
+def get_account_keys(account):
+    return set((kind, 'account', home_page and unicode(home_page), unicode(account.name))
+        for kind in ('Agent', 'Group') for home_page in (account.homePage, None))
+
+def agent_saved(instance, created):
+    # Accounts are their own rows, see account_changed
+    cached = set(k for k in agents.get_keys(instance.pk) if k[1] != 'account')
+    current = get_instance_keys(instance)
+    if created:
+        # A new agent can join the pks cached for an identifier
+        invalidate(cached | current)
+    elif cached != current:
+        invalidate(cached ^ current)
+
+def agent_deleted(instance):
+    invalidate(agents.get_keys(instance.pk) | get_instance_keys(instance))
+
+def account_changed(account):
+    cached = set(k for k in agents.get_keys(account.agent_id) if k[1] == 'account')
+    invalidate(cached | get_account_keys(account))
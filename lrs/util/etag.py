@@ -1,8 +1,14 @@
+import calendar
 import hashlib
+import json
+from django.db.models import Max
+from django.utils.http import parse_http_date_safe
 from lrs.exceptions import Conflict, PreconditionFail
+from lrs.models import statement, statement_watermark
 
 IF_MATCH = "HTTP_IF_MATCH"
 IF_NONE_MATCH = "HTTP_IF_NONE_MATCH"
+IF_MODIFIED_SINCE = "HTTP_IF_MODIFIED_SINCE"
 
 def create_tag(resource):
     return hashlib.sha1(resource).hexdigest()
@@ -19,6 +25,9 @@ def get_etag_info(headers, r_dict, required=True):
         etag[IF_NONE_MATCH] = headers.get('If_None_Match', None)
     if not etag[IF_NONE_MATCH]:
         etag[IF_NONE_MATCH] = r_dict.get('If-None-Match', None)
+    etag[IF_MODIFIED_SINCE] = headers.get(IF_MODIFIED_SINCE, None)
+    if not etag[IF_MODIFIED_SINCE]:
+        etag[IF_MODIFIED_SINCE] = r_dict.get('If-Modified-Since', None)
     if required and not etag[IF_MATCH] and not etag[IF_NONE_MATCH]:
         raise MissingEtagInfo("If-Match and If-None-Match headers were missing. One of these headers is required for this request.")
     return etag
@@ -46,6 +55,28 @@ def check_preconditions(request, contents, required=False):
     else:
         raise MissingEtagInfo("If-Match and If-None-Match headers were missing. One of these headers is required for this request.")
 
+def get_statements_validator(query):
+    # Nothing can change the result of a statement query without storing a new statement or
+    # moving the watermark, so they stand in for the result. The newest id catches statements
+    # stored with an older time (e.g. by a server with a slow clock)
+    latest = statement.objects.aggregate(Max('stored'), Max('id'))
+    last_stored = latest['stored__max']
+    changed = statement_watermark.objects.aggregate(Max('changed'))['changed__max']
+    tag = create_tag("%s|%s|%s|%s" % (json.dumps(query, sort_keys=True), last_stored, latest['id__max'], changed))
+    modified = [t for t in (last_stored, changed) if t]
+    return tag, max(modified) if modified else None
+
+def not_modified(request_etag, tag, last_modified):
+    if not request_etag:
+        return False
+    # If-None-Match wins over If-Modified-Since when both are sent
+    if request_etag.get(IF_NONE_MATCH, None):
+        return request_etag[IF_NONE_MATCH] == "*" or tag in request_etag[IF_NONE_MATCH]
+    if request_etag.get(IF_MODIFIED_SINCE, None) and last_modified:
+        since = parse_http_date_safe(request_etag[IF_MODIFIED_SINCE])
+        return since is not None and calendar.timegm(last_modified.utctimetuple()) <= since
+    return False
+
 class MissingEtagInfo(Conflict):
     def __init__(self, msg):
         self.message = msg
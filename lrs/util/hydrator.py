@@ -0,0 +1,341 @@
+from collections import defaultdict
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Q
+from lrs import models
+from lrs.exceptions import IDNotFoundError
+
+# Interaction components of an activity definition and the key each one is returned under
+INTERACTION_COMPONENTS = (
+    ('scale', models.activity_definition_scale, 'scale_id'),
+    ('choices', models.activity_definition_choice, 'choice_id'),
+    ('steps', models.activity_definition_step, 'step_id'),
+    ('source', models.activity_definition_source, 'source_id'),
+    ('target', models.activity_definition_target, 'target_id'),
+)
+
+def get_ct_id(model):
+    # ContentType caches these so it's only a query the first time per process
+    return ContentType.objects.get_for_model(model).id
+
+def group_by(rows, attr):
+    grouped = defaultdict(list)
+    for row in rows:
+        grouped[getattr(row, attr)].append(row)
+    return grouped
+
+def group_by_generic(rows):
+    grouped = defaultdict(list)
+    for row in rows:
+        grouped[(row.content_type_id, row.object_id)].append(row)
+    return grouped
+
+def generic_filter(model, parents):
+    # parents is a list of (content type id, list of object ids)
+    q = None
+    for ct_id, obj_ids in parents:
+        if obj_ids:
+            parent_q = Q(content_type=ct_id, object_id__in=list(obj_ids))
+            q = parent_q if q is None else q | parent_q
+    if q is None:
+        return []
+    return list(model.objects.filter(q).order_by('id'))
+
+def update_dict(rows):
+    ret = {}
+    for row in rows:
+        ret.update(row.object_return())
+    return ret
+
+def filter_lang(rows, lang):
+    if lang is not None:
+        return [row for row in rows if row.key == lang]
+    return rows
+
+class StatementHydrator():
+    # Loads everything needed to render a page of statements (and/or activities) in a fixed
+    # number of bulk queries, then builds the same JSON as the models' object_return methods
+    # from the in-memory rows
+    def __init__(self, stmts=None, activities=None):
+        self.stmts = list(stmts or [])
+        self.activity_list = list(activities or [])
+        self.load()
+
+    def load(self):
+        stmt_ct = get_ct_id(models.statement)
+        sub_ct = get_ct_id(models.SubStatement)
+        # Statements with a stored full_statement don't need anything loaded
+        stmts = [s for s in self.stmts if not s.full_statement]
+
+        # Statement objects - substatements first since their objects need resolving too
+        obj_ids = set(s.stmt_object_id for s in stmts)
+        self.subs = self.in_bulk(models.SubStatement, obj_ids)
+        obj_ids.update(s.stmt_object_id for s in self.subs.values())
+        self.activities = self.in_bulk(models.activity, obj_ids)
+        self.activities.update((a.id, a) for a in self.activity_list)
+
+        # Results and contexts hang off of statements and substatements through generic relations
+        parents = [(stmt_ct, [s.id for s in stmts]), (sub_ct, self.subs.keys())]
+        self.results = self.first_by_generic(generic_filter(models.result, parents))
+        self.contexts = self.first_by_generic(generic_filter(models.context, parents))
+        context_ids = [c.id for c in self.contexts.values()]
+        self.context_activities = group_by(models.ContextActivity.objects.filter(
+            context__in=context_ids).order_by('id'), 'context_id') if context_ids else {}
+
+        # Statement refs are either statement objects or context statements
+        refs = []
+        if obj_ids and context_ids:
+            refs = models.StatementRef.objects.filter(Q(id__in=list(obj_ids)) | Q(context__in=context_ids))
+        elif obj_ids:
+            refs = models.StatementRef.objects.filter(id__in=obj_ids)
+        self.refs = dict((r.id, r) for r in refs if r.id in obj_ids)
+        self.context_refs = dict((r.context_id, r) for r in refs if r.context_id)
+
+        # Teams and their members
+        team_ids = set(c.team_id for c in self.contexts.values() if c.team_id)
+        self.members = group_by(models.group.member.through.objects.filter(
+            group__in=team_ids).order_by('id'), 'group_id') if team_ids else {}
+
+        # Every agent that shows up anywhere on the page
+        agent_ids = set()
+        for s in stmts:
+            agent_ids.add(s.actor_id)
+            if s.authority_id:
+                agent_ids.add(s.authority_id)
+        for s in self.subs.values():
+            agent_ids.add(s.actor_id)
+        for c in self.contexts.values():
+            if c.instructor_id:
+                agent_ids.add(c.instructor_id)
+        for members in self.members.values():
+            agent_ids.update(m.agent_id for m in members)
+        agent_ids.update(team_ids)
+        agent_ids.update(i for i in obj_ids if not (i in self.subs or i in self.activities or i in self.refs))
+        self.agents = self.in_bulk(models.agent, agent_ids)
+        self.accounts = dict((a.agent_id, a) for a in models.agent_account.objects.filter(
+            agent__in=self.agents.keys())) if self.agents else {}
+
+        # Verbs
+        verb_ids = set(s.verb_id for s in stmts)
+        verb_ids.update(s.verb_id for s in self.subs.values())
+        self.verbs = self.in_bulk(models.Verb, verb_ids)
+
+        # Result scores
+        result_ids = [r.id for r in self.results.values()]
+        self.scores = dict((sc.result_id, sc) for sc in models.score.objects.filter(
+            result__in=result_ids)) if result_ids else {}
+
+        # Activity definitions and everything under them
+        act_ids = self.activities.keys()
+        self.definitions = dict((d.activity_id, d) for d in models.activity_definition.objects.filter(
+            activity__in=act_ids)) if act_ids else {}
+        def_ids = [d.id for d in self.definitions.values()]
+        def_ct = get_ct_id(models.activity_definition)
+        self.names = group_by_generic(generic_filter(models.name_lang, [(def_ct, def_ids)]))
+        self.descriptions = group_by_generic(generic_filter(models.desc_lang, [(def_ct, def_ids)]))
+        self.patterns = dict((p.activity_definition_id, p) for p in
+            models.activity_def_correctresponsespattern.objects.filter(
+            activity_definition__in=def_ids)) if def_ids else {}
+        pattern_ids = [p.id for p in self.patterns.values()]
+        self.answers = group_by(models.correctresponsespattern_answer.objects.filter(
+            correctresponsespattern__in=pattern_ids).order_by('id'), 'correctresponsespattern_id') if pattern_ids else {}
+
+        # Interactions only need loading for definitions with a correctResponsesPattern
+        pattern_def_ids = self.patterns.keys()
+        self.components = {}
+        lang_map_parents = [(get_ct_id(models.Verb), list(verb_ids))]
+        for key, model, id_attr in INTERACTION_COMPONENTS:
+            rows = list(model.objects.filter(activity_definition__in=pattern_def_ids).order_by('id')) if pattern_def_ids else []
+            self.components[key] = group_by(rows, 'activity_definition_id')
+            lang_map_parents.append((get_ct_id(model), [r.id for r in rows]))
+        self.lang_maps = group_by_generic(generic_filter(models.LanguageMap, lang_map_parents))
+
+        # Extensions for results, contexts and activity definitions
+        self.extensions = group_by_generic(generic_filter(models.extensions, [
+            (get_ct_id(models.result), result_ids), (get_ct_id(models.context), context_ids),
+            (def_ct, def_ids)]))
+
+    def in_bulk(self, model, ids):
+        if not ids:
+            return {}
+        return dict((o.id, o) for o in model.objects.filter(id__in=ids))
+
+    def first_by_generic(self, rows):
+        # Should only ever be one per statement, object_return uses the first
+        ret = {}
+        for row in rows:
+            ret.setdefault((row.content_type_id, row.object_id), row)
+        return ret
+
+    def get_extensions(self, obj):
+        return self.extensions.get((get_ct_id(obj.__class__), obj.id), [])
+
+    def get_agent_json(self, agent_id, sparse=False):
+        ag = self.agents[agent_id]
+        ret = {}
+        ret['objectType'] = ag.objectType
+        if ag.name:
+            ret['name'] = ag.name
+        if ag.mbox:
+            ret['mbox'] = ag.mbox
+        if ag.mbox_sha1sum:
+            ret['mbox_sha1sum'] = ag.mbox_sha1sum
+        if ag.openid and not sparse:
+            ret['openid'] = ag.openid
+        if not sparse and agent_id in self.accounts:
+            ret['account'] = self.accounts[agent_id].get_json()
+        return ret
+
+    def get_group_json(self, group_id, sparse=False):
+        ret = {}
+        ret['objectType'] = self.agents[group_id].objectType
+        ret['member'] = [self.get_agent_json(m.agent_id, sparse) for m in self.members.get(group_id, [])]
+        return ret
+
+    def get_verb_json(self, verb_id, lang=None):
+        verb = self.verbs[verb_id]
+        ret = {}
+        ret['id'] = verb.verb_id
+        lang_map_set = filter_lang(self.lang_maps.get((get_ct_id(models.Verb), verb_id), []), lang)
+        if len(lang_map_set) > 0:
+            ret['display'] = update_dict(lang_map_set)
+        return ret
+
+    def get_definition_json(self, act_def, lang=None):
+        ret = {}
+        ret['name'] = update_dict(filter_lang(self.names.get((get_ct_id(models.activity_definition), act_def.id), []), lang))
+        ret['description'] = update_dict(filter_lang(self.descriptions.get((get_ct_id(models.activity_definition), act_def.id), []), lang))
+        ret['type'] = act_def.activity_definition_type
+
+        if not act_def.interactionType is None:
+            ret['interactionType'] = act_def.interactionType
+
+        pattern = self.patterns.get(act_def.id, None)
+        if not pattern is None:
+            ret['correctResponsesPattern'] = [a.objReturn() for a in self.answers.get(pattern.id, [])]
+            for key, model, id_attr in INTERACTION_COMPONENTS:
+                components = self.components[key].get(act_def.id, [])
+                if components:
+                    ret[key] = []
+                    for c in components:
+                        lang_map_set = filter_lang(self.lang_maps.get((get_ct_id(model), c.id), []), lang)
+                        ret[key].append({'id': getattr(c, id_attr), 'description': update_dict(lang_map_set)})
+
+        def_ext = self.get_extensions(act_def)
+        if len(def_ext) > 0:
+            ret['extensions'] = update_dict(def_ext)
+        return ret
+
+    def get_activity_json(self, act, sparse=False, lang=None):
+        ret = {}
+        ret['id'] = act.activity_id
+        ret['objectType'] = act.objectType
+        if act.id in self.definitions:
+            ret['definition'] = self.get_definition_json(self.definitions[act.id], lang)
+
+        if sparse:
+            if 'definition' in ret:
+                if 'correctresponsespattern' in ret['definition']:
+                    del ret['definition']['correctresponsespattern']
+                    ret['definition']['definition'] = ret['definition']['description'].keys()
+                    ret['definition']['name'] = ret['definition']['name'].keys()
+        return ret
+
+    def get_result_json(self, rslt):
+        ret = {}
+        if rslt.success:
+            ret['success'] = rslt.success
+        if rslt.completion:
+            ret['completion'] = rslt.completion
+        if rslt.response:
+            ret['response'] = rslt.response
+        if rslt.duration:
+            ret['duration'] = rslt.duration
+        if rslt.id in self.scores:
+            ret['score'] = self.scores[rslt.id].object_return()
+
+        result_ext = self.get_extensions(rslt)
+        if len(result_ext) > 0:
+            ret['extensions'] = update_dict(result_ext)
+        return ret
+
+    def get_context_json(self, cntx, sparse=False):
+        ret = {}
+        for field in ('registration', 'revision', 'platform', 'language'):
+            value = getattr(cntx, field)
+            if not value is None:
+                ret[field] = value
+        if not cntx.instructor_id is None:
+            ret['instructor'] = self.get_agent_json(cntx.instructor_id, sparse)
+        if not cntx.team_id is None:
+            ret['team'] = self.get_group_json(cntx.team_id)
+
+        ret['contextActivities'] = {}
+        for con_act in self.context_activities.get(cntx.id, []):
+            ret['contextActivities'].update(con_act.object_return())
+        if cntx.id in self.context_refs:
+            ret['statement'] = self.context_refs[cntx.id].object_return()
+
+        context_ext = self.get_extensions(cntx)
+        if len(context_ext) > 0:
+            ret['extensions'] = update_dict(context_ext)
+        return ret
+
+    def get_result_and_context(self, ret, stmt, sparse):
+        key = (get_ct_id(stmt.__class__), stmt.id)
+        if key in self.results:
+            ret['result'] = self.get_result_json(self.results[key])
+        if key in self.contexts:
+            ret['context'] = self.get_context_json(self.contexts[key], sparse)
+
+    def get_substatement_json(self, sub, sparse=False, lang=None):
+        ret = {}
+        ret['actor'] = self.get_agent_json(sub.actor_id, sparse)
+        ret['verb'] = self.get_verb_json(sub.verb_id)
+
+        if sub.stmt_object_id in self.activities:
+            ret['object'] = self.get_activity_json(self.activities[sub.stmt_object_id], sparse, lang)
+        elif sub.stmt_object_id in self.agents:
+            ret['object'] = self.get_agent_json(sub.stmt_object_id, sparse)
+        else:
+            raise IDNotFoundError('No activity or agent object found with given ID')
+
+        self.get_result_and_context(ret, sub, sparse)
+        ret['timestamp'] = str(sub.timestamp)
+        ret['objectType'] = "SubStatement"
+        return ret
+
+    def get_statement_json(self, stmt, sparse=False, lang=None):
+        if stmt.full_statement:
+            return stmt.object_return(sparse, lang)
+        ret = {}
+        ret['id'] = stmt.statement_id
+        ret['actor'] = self.get_agent_json(stmt.actor_id, sparse)
+        ret['verb'] = self.get_verb_json(stmt.verb_id, lang)
+
+        obj_id = stmt.stmt_object_id
+        if obj_id in self.activities:
+            ret['object'] = self.get_activity_json(self.activities[obj_id], sparse, lang)
+        elif obj_id in self.agents:
+            ret['object'] = self.get_agent_json(obj_id, sparse)
+        elif obj_id in self.subs:
+            ret['object'] = self.get_substatement_json(self.subs[obj_id], sparse, lang)
+        elif obj_id in self.refs:
+            ret['object'] = self.refs[obj_id].object_return()
+        else:
+            raise IDNotFoundError("No activity, agent, substatement, or statementref found with given ID")
+
+        self.get_result_and_context(ret, stmt, sparse)
+        ret['timestamp'] = str(stmt.timestamp)
+        ret['stored'] = str(stmt.stored)
+
+        if not stmt.authority_id is None:
+            ret['authority'] = self.get_agent_json(stmt.authority_id, sparse)
+
+        ret['voided'] = stmt.voided
+        return ret
+
+    def get_statements_json(self, sparse=False, lang=None):
+        return [self.get_statement_json(stmt, sparse, lang) for stmt in self.stmts]
+
+    def get_activities_json(self, sparse=False, lang=None):
+        return [self.get_activity_json(act, sparse, lang) for act in self.activity_list]
@@ -1,10 +1,15 @@
+from django.conf import settings
 from django.http import HttpResponse
+from django.utils.http import http_date
 from lrs import objects, models, exceptions
-from lrs.util import etag
+from lrs.util import activity_resolver, etag, statement_cache, statement_rollups, statement_spool
+from lrs.util.hydrator import StatementHydrator
 from lrs.util import log_info_processing, log_exception, update_parent_log_status
 import json
 from lrs.objects import Agent, Activity, ActivityState, ActivityProfile, Statement
+import calendar
 import json
+import types
 import retrieve_statement
 import pprint
 
@@ -16,21 +21,20 @@ def statements_post(req_dict):
     log_dict = req_dict['initial_user_action'] 
     log_info_processing(log_dict, 'POST', __name__)
 
+    if settings.STMT_ASYNC_INGEST:
+        # Only checked and spooled here, process_statement_spool saves them
+        stmts_data = req_dict['body'] if type(req_dict['body']) is list else [req_dict['body']]
+        stmt_responses = statement_spool.enqueue(stmts_data, auth=req_dict['auth'], log_dict=log_dict)
     # Handle batch POST
-    if type(req_dict['body']) is list:
+    elif type(req_dict['body']) is list:
+        # Saved in one transaction - nothing from the batch is kept if any of it fails
         try:
-            for st in req_dict['body']:
-                stmt = Statement.Statement(st, auth=req_dict['auth'], log_dict=log_dict).model_object
-                stmt_responses.append(str(stmt.statement_id))
+            stmts = Statement.save_batch(req_dict['body'], auth=req_dict['auth'], log_dict=log_dict)
         except Exception, e:
-            for stmt_id in stmt_responses:
-                try:
-                    models.statement.objects.get(statement_id=stmt_id).delete()
-                except models.statement.DoesNotExist:
-                    pass # stmt already deleted 
             log_exception(log_dict, e.message, statements_post.__name__)
             update_parent_log_status(log_dict, 500)
             raise e
+        stmt_responses = [str(stmt.statement_id) for stmt in stmts]
     else:
         # Handle single POST
         stmt = Statement.Statement(req_dict['body'], auth=req_dict['auth'], log_dict=log_dict).model_object
@@ -46,7 +50,10 @@ def statements_put(req_dict):
     
     # Set statement ID in body so all data is together
     req_dict['body']['statement_id'] = req_dict['statementId']
-    stmt = Statement.Statement(req_dict['body'], auth=req_dict['auth'], log_dict=log_dict).model_object
+    if settings.STMT_ASYNC_INGEST:
+        statement_spool.enqueue([req_dict['body']], auth=req_dict['auth'], log_dict=log_dict)
+    else:
+        stmt = Statement.Statement(req_dict['body'], auth=req_dict['auth'], log_dict=log_dict).model_object
     
     update_parent_log_status(log_dict, 204)
     return HttpResponse("No Content", status=204)
@@ -55,25 +62,77 @@ def statements_get(req_dict):
     log_dict = req_dict['initial_user_action']    
     log_info_processing(log_dict, 'GET', __name__)
 
-    stmt_result = {}
     # If statementId is in req_dict then it is a single get
     if 'statementId' in req_dict:
         statementId = req_dict['statementId']
         # Try to retrieve stmt, if DNE then return empty else return stmt info                
-        try:
-            st = models.statement.objects.get(statement_id=statementId)
-        except models.statement.DoesNotExist:
+        st = get_stored_statement(statementId)
+        if st is None:
+            # Could have been accepted by an async POST and not saved yet, wait=seconds waits for it.
+            # Looked for again after the spool since the worker takes entries out once they're saved
+            state = statement_spool.wait(statementId, get_wait(req_dict))
+            st = get_stored_statement(statementId)
+            if st is None and state:
+                return spooled_statement_response(log_dict, statementId, state)
+        if st is None:
             err_msg = 'There is no statement associated with the id: %s' % statementId
             log_exception(log_dict, err_msg, statements_get.__name__)
             update_parent_log_status(log_dict, 404)
             raise exceptions.IDNotFoundError(err_msg)
-        stmt_result = st.object_return()
+        update_parent_log_status(log_dict, 200)
+        return HttpResponse(statement_cache.get_statement_json(st), mimetype="application/json", status=200)
+
+    # Pollers that already have the current result get a 304 without the query being run
+    query = retrieve_statement.normalize_query(req_dict, retrieve_statement.get_limit(req_dict))
+    validator, last_modified = etag.get_statements_validator(query)
+    if etag.not_modified(req_dict.get('ETAG', None), validator, last_modified):
+        update_parent_log_status(log_dict, 304)
+        response = HttpResponse(status=304)
     else:
-        stmt_list = retrieve_statement.complex_get(req_dict)
-        stmt_result = retrieve_statement.build_statement_result(req_dict.copy(), stmt_list)
-    
+        stmt_set = retrieve_statement.complex_get(req_dict)
+        update_parent_log_status(log_dict, 200)
+        # The page is read and written out a statement at a time as the response is sent
+        response = HttpResponse(retrieve_statement.stream_statement_result(req_dict.copy(), stmt_set),
+            mimetype="application/json", status=200)
+    response['ETag'] = '"%s"' % validator
+    if last_modified:
+        response['Last-Modified'] = http_date(calendar.timegm(last_modified.utctimetuple()))
+    return response
+
+def get_stored_statement(statement_id):
+    try:
+        return models.statement.objects.get(statement_id=statement_id)
+    except models.statement.DoesNotExist:
+        try:
+            return models.statement_archive.objects.get(statement_id=statement_id)
+        except models.statement_archive.DoesNotExist:
+            return None
+
+def get_wait(req_dict):
+    try:
+        return max(float(req_dict.get('wait', 0)), 0)
+    except ValueError:
+        raise exceptions.ParamError("wait must be a number of seconds, received %s" % req_dict['wait'])
+
+def spooled_statement_response(log_dict, statement_id, state):
+    # 202 while it's waiting to be saved, 400 with why if it couldn't be
+    status, error = state
+    if status == statement_spool.FAILED:
+        err_msg = 'The statement with the id %s was accepted but could not be saved: %s' % (statement_id, error)
+        log_exception(log_dict, err_msg, statements_get.__name__)
+        update_parent_log_status(log_dict, 400)
+        raise exceptions.ParamError(err_msg)
+    update_parent_log_status(log_dict, 202)
+    return HttpResponse(json.dumps({'id': statement_id, 'state': status}), mimetype="application/json", status=202)
+
+def statement_rollups_get(req_dict):
+    log_dict = req_dict['initial_user_action']    
+    log_info_processing(log_dict, 'GET', __name__)
+
+    # Read off of the rollup table, never the statements
+    rollups = statement_rollups.get_rollups(req_dict)
     update_parent_log_status(log_dict, 200)
-    return HttpResponse(stream_response_generator(stmt_result), mimetype="application/json", status=200)
+    return HttpResponse(json.dumps({'rollups': rollups}), mimetype="application/json", status=200)
 
 def activity_state_put(req_dict):
     log_dict = req_dict['initial_user_action']    
@@ -173,16 +232,14 @@ def activities_get(req_dict):
 
     activityId = req_dict['activityId']
     # Try to retrieve activity, if DNE then return empty else return activity info
-    act_list = models.activity.objects.filter(activity_id=activityId)
+    act_list = models.activity.objects.filter(pk__in=activity_resolver.resolve(activityId))
     if not act_list:
         err_msg = "No activities found with ID %s" % activityId
         log_exception(log_dict, err_msg, activities_get.__name__)
         update_parent_log_status(log_dict, 404)
         raise exceptions.IDNotFoundError(err_msg)
     
-    full_act_list = []
-    for act in act_list:
-        full_act_list.append(act.object_return())
+    full_act_list = StatementHydrator(activities=act_list).get_activities_json()
 
     update_parent_log_status(log_dict, 200)
     return HttpResponse(json.dumps([k for k in full_act_list]), mimetype="application/json", status=200)
@@ -245,34 +302,31 @@ def agents_get(req_dict):
 
 #Generate JSON
 def stream_response_generator(data):
-    first = True
-    yield "{"
-    for k,v in data.items():
-        if not first:
-            yield ", "
-        else:
-            first = False
-        #Catch nested dictionaries
-        if type(v) is dict:
-            stream_response_generator(v)
-        #Catch lists as dictionary values
-        if type(v) is list:
-            lfirst = True
+    # Yields the JSON a piece at a time, walking into nested dicts and lists so generators
+    # inside them are only consumed as they're written out
+    if isinstance(data, dict):
+        yield "{"
+        first = True
+        for k,v in data.items():
+            if not first:
+                yield ", "
+            else:
+                first = False
             yield json.dumps(k)
             yield ": "
-            yield "["
-            for item in v:
-                if not lfirst:
-                    yield ", "
-                else:
-                    lfirst = False
-                #Catch dictionaries as items in a list
-                if type(item) is dict:
-                    stream_response_generator(item)
-                yield json.dumps(item)
-            yield "]"
-        else:
-            yield json.dumps(k)
-            yield ": "
-            yield json.dumps(v)
-    yield "}"
+            for chunk in stream_response_generator(v):
+                yield chunk
+        yield "}"
+    elif isinstance(data, (list, tuple, types.GeneratorType)):
+        yield "["
+        first = True
+        for item in data:
+            if not first:
+                yield ", "
+            else:
+                first = False
+            for chunk in stream_response_generator(item):
+                yield chunk
+        yield "]"
+    else:
+        yield json.dumps(data)
@@ -15,7 +15,7 @@ logger = logging.getLogger('user_system_actions')
 def check_for_existing_statementId(stmtID):
     exists = False
     stmt = models.statement.objects.filter(statement_id=stmtID)
-    if stmt:
+    if stmt or models.statement_archive.objects.filter(statement_id=stmtID).exists():
         exists = True
     return exists
 
@@ -64,6 +64,11 @@ def statements_post(r_dict):
 def statements_get(r_dict):
     return r_dict
 
+@auth
+@log_parent_action(method='GET', endpoint='statements/rollups')
+def statement_rollups_get(r_dict):
+    return r_dict
+
 @auth
 @log_parent_action(method='PUT', endpoint='statements')
 def statements_put(r_dict):
@@ -1,20 +1,25 @@
 from lrs import models
-from django.core.cache import cache
-from lrs.objects import Agent, Statement
+from django.core import signing
 from datetime import datetime
 from django.conf import settings
-from django.core.paginator import Paginator
+from django.contrib.contenttypes.models import ContentType
+from django.db.models import Max, Q
 from lrs.exceptions import BadRequest
-import bencode
+from lrs.util import activity_resolver, agent_resolver, statement_cache
 import pytz
-import hashlib
 import json
-import pickle
 import ast
 import pdb
 import ast
 
 MORE_ENDPOINT = '/XAPI/statements/more/'
+MORE_TOKEN_SALT = 'lrs.statements.more'
+CURSOR_TIME_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+# Statements rendered together while streaming, the ones that aren't cached share one hydrator
+STREAM_CHUNK_SIZE = 50
+AGENT_IFIS = ('mbox', 'mbox_sha1sum', 'openid')
+QUERY_PARAMS = ('since', 'until', 'object', 'verb', 'registration', 'actor', 'instructor',
+    'authoritative', 'sparse', 'ascending', 'related_activities')
 
 def convert_to_utc(timestr):
     # Strip off TZ info
@@ -38,110 +43,162 @@ def convert_to_dict(incoming_data):
             raise BadRequest("JSON not found, expecting JSON for endpoint and received string instead")
     return data
 
-def parse_incoming_object(objectData, args):
-    # If object is not dict, try to load as one. Even when parsing body in req_parse-data in object key is not converted
-    obj = None
-    if not type(objectData) is dict:
-        object_data = convert_to_dict(objectData)
-    else:
-        object_data = objectData
-
-    # Check the objectType
-    if 'objectType' in object_data:
-        # If type is activity try go retrieve object
-        if object_data['objectType'].lower() == 'activity':
-            try:
-                activity = models.activity.objects.get(activity_id=object_data['id'])
-                if activity:
-                    obj = activity
-            except models.activity.DoesNotExist:
-                pass # no object found
-        # If type is not an activity then it must be an agent
-        elif object_data['objectType'].lower() == 'agent':
-            try:
-                agent = Agent.Agent(json.dumps(object_data)).agent
-                if agent:
-                    obj = agent
-            except models.IDNotFoundError:
-                pass # no stmt_object filter added
-        elif object_data['objectType'].lower() == 'statementref':
-            try:
-                stmt_ref = models.StatementRef.objects.get(ref_id=object_data['id'])
-                if stmt_ref:
-                    obj = stmt_ref
-            except models.StatementRef.DoesNotExist:
-                pass
+def load_filter_value(data):
+    # Filter params that hold objects can come in as JSON (or python dict) strings
+    if isinstance(data, dict):
+        return data
+    return convert_to_dict(data)
+
+def agent_filter(agent_data):
+    # Matches agents on their identifier without creating anything, None means nothing can match
+    agent_data = load_filter_value(agent_data)
+    pks = agent_resolver.resolve(agent_data)
+    if pks is not None:
+        return pks or None
+    # More than one identifier - they all have to match
+    kwargs = dict((ifi, agent_data[ifi]) for ifi in AGENT_IFIS if agent_data.get(ifi, None))
+    if agent_data.get('account', None):
+        account = load_filter_value(agent_data['account'])
+        kwargs['agent_account__name'] = account.get('name', None)
+        if account.get('homePage', None):
+            kwargs['agent_account__homePage'] = account['homePage']
+    if not kwargs:
+        return None
+    if agent_data.get('objectType', None) == 'Group':
+        kwargs['objectType'] = 'Group'
+    return models.agent.objects.filter(**kwargs).values('pk')
+
+def object_filter(object_data):
+    object_data = load_filter_value(object_data)
     # Default to activity
-    else:
-        try:
-            activity = models.activity.objects.get(activity_id=object_data['id'])
-            if activity:
-                obj = activity
-        except models.activity.DoesNotExist:
-            pass
-    return obj
-
-def parse_incoming_actor(actorData):
-    actor = None
-    # agent = convert_to_dict(actorData)
-    if not type(actorData) is dict:
-        try:
-            actorData = json.loads(actorData)
-        except Exception, e:
-            actorData = json.loads(actorData.replace("'",'"'))
-    try:
-        actor = Agent.Agent(json.dumps(actorData)).agent
-    except models.IDNotFoundError:
-        pass # no actor filter added
-    return actor
-
-def parse_incoming_instructor(instData):
-    inst = None
-    if not type(instData) is dict:
-        try:
-            instData = json.loads(instData)
-        except Exception, e:
-            instData = json.loads(instData.replace("'",'"'))        
-    try:
-        instructor = Agent.Agent(json.dumps(instData)).agent                 
-        if instructor:
-            cntxList = models.context.objects.filter(instructor=instructor)
-            inst = cntxList
-    except models.IDNotFoundError:
-        pass # no actor filter added
-    return inst
+    object_type = object_data.get('objectType', 'Activity').lower()
+    if object_type == 'activity':
+        return activity_resolver.resolve(object_data.get('id', None)) or None
+    elif object_type == 'agent' or object_type == 'group':
+        return agent_filter(object_data)
+    elif object_type == 'statementref':
+        return models.StatementRef.objects.filter(ref_id=object_data.get('id', None)).values('pk')
+    return None
+
+def related_filter(the_dict):
+    # related_activities=true also matches statements naming the object activity in their
+    # contextActivities, a contextActivities key (parent, grouping or other) only under that key
+    related = str(the_dict.get('related_activities', 'false')).lower()
+    if related == 'false':
+        return None
+    object_data = load_filter_value(the_dict['object'])
+    if object_data.get('objectType', 'Activity').lower() != 'activity':
+        return None
+    kwargs = {'activity_iri': object_data.get('id', None)}
+    if related != 'true':
+        kwargs['key'] = related
+    return models.statement_context_activity.objects.filter(**kwargs).values('statement')
+
+def context_filter(**kwargs):
+    # Statements whose context matches - contexts point at their statement through a generic relation
+    stmt_ct = ContentType.objects.get_for_model(models.statement)
+    return models.context.objects.filter(content_type=stmt_ct, **kwargs).values('object_id')
+
+def get_filters(the_dict, archive=False):
+    # Agents come from the agent_resolver cache, every other identifier filter becomes a subquery
+    # of the one statement query - related activities go through statement_context_activity. Returns None when an identifier can never match anything.
+    # Archived statements keep their registration and instructor on the row
+    filters = []
+    if 'object' in the_dict:
+        objs = object_filter(the_dict['object'])
+        related = related_filter(the_dict)
+        if related is not None:
+            # The mapping holds statement pks for both tables
+            if objs is None:
+                filters.append(Q(id__in=related))
+            else:
+                filters.append(Q(stmt_object__in=objs) | Q(id__in=related))
+        elif objs is None:
+            return None
+        else:
+            filters.append(Q(stmt_object__in=objs))
 
-def retrieve_stmts_from_db(the_dict, limit, stored_param, args):
-    return models.statement.objects.filter(**args).order_by(stored_param)
+    if 'verb' in the_dict:
+        filters.append(Q(verb__in=models.Verb.objects.filter(verb_id=the_dict['verb']).values('pk')))
 
-def complex_get(req_dict):
-    args = {}
-    language = None
-    # Set language if one
-    if 'language' in req_dict:
-        language = req_dict['language']
-    
-    user = None
-    if 'user' in req_dict:
-        user = req_dict['user']
+    if 'registration' in the_dict:
+        if archive:
+            filters.append(Q(registration=str(the_dict['registration'])))
+        else:
+            filters.append(Q(id__in=context_filter(registration=str(the_dict['registration']))))
 
+    if 'actor' in the_dict:
+        actors = agent_filter(the_dict['actor'])
+        if actors is None:
+            return None
+        filters.append(Q(actor__in=actors))
+
+    if 'instructor' in the_dict:
+        instructors = agent_filter(the_dict['instructor'])
+        if instructors is None:
+            return None
+        if archive:
+            filters.append(Q(instructor__in=instructors))
+        else:
+            filters.append(Q(id__in=context_filter(instructor__in=instructors)))
+    return filters
+
+def retrieve_stmts_from_db(the_dict, limit, stored_param, args, filters, model=models.statement):
+    # Order by stored with the id as a tie breaker so the (stored, id) pair is a stable keyset cursor
+    id_param = stored_param.replace('stored', 'id')
+    if filters is None:
+        return model.objects.none()
+    return model.objects.filter(*filters, **args).order_by(stored_param, id_param)
+
+def get_query_dict(req_dict):
     # Parse out params into single dict
     try:
         the_dict = req_dict['body']
-        if isinstance(the_dict, str):
+        if isinstance(the_dict, basestring):
             try:
                 the_dict = ast.literal_eval(the_dict)
             except:
                 the_dict = json.loads(the_dict)
     except KeyError:
         the_dict = req_dict
+    return the_dict
 
-    # The ascending initilization statement here sometimes throws mysql warning, but needs to be here
-    ascending = False    
+def is_ascending(the_dict):
     # If want ordered by ascending
     if 'ascending' in the_dict:
         if the_dict['ascending']:
-            ascending = True
+            return True
+    return False
+
+def is_sparse(the_dict):
+    sparse = True    
+    # If want sparse results
+    if 'sparse' in the_dict:
+        # If sparse input as string
+        if not type(the_dict['sparse']) is bool:
+            if the_dict['sparse'].lower() == 'false':
+                sparse = False
+        else:
+            sparse = the_dict['sparse']
+    return sparse
+
+def get_limit(req_dict):
+    # Limit can be a param on the request or in the body
+    try:
+        limit = int(req_dict['limit'])
+    except KeyError:
+        try:
+            limit = int(get_query_dict(req_dict)['limit'])
+        except:
+            limit = None
+    if not limit or limit > settings.SERVER_STMT_LIMIT:
+        limit = settings.SERVER_STMT_LIMIT
+    return limit
+
+def get_query_args(the_dict):
+    args = {}
+    # The ascending initilization statement here sometimes throws mysql warning, but needs to be here
+    ascending = is_ascending(the_dict)
 
     # Cycle through the_dict and set since and until params
     for k,v in the_dict.items():
@@ -152,206 +209,147 @@ def complex_get(req_dict):
             date_object = convert_to_utc(v)
             args['stored__lte'] = date_object   
     
-    # If searching by activity or actor
-    if 'object' in the_dict:
-        objectData = the_dict['object']
-        obj = parse_incoming_object(objectData, args)
-        if obj:
-            args['stmt_object'] = obj
-
-    # If searching by verb
-    if 'verb' in the_dict:
-        verb_id = the_dict['verb']
-        verb = models.Verb.objects.filter(verb_id=verb_id)
-        if verb:
-            args['verb'] = verb
-
-    # If searching by registration
-    if 'registration' in the_dict:
-        uuid = str(the_dict['registration'])
-        cntx = models.context.objects.filter(registration=uuid)
-        args['context'] = cntx
-    
-    # If searching by actor
-    if 'actor' in the_dict:
-        actorData = the_dict['actor']
-        actor = parse_incoming_actor(actorData)
-        if actor:
-            args['actor'] = actor
-
-    # If searching by instructor
-    if 'instructor' in the_dict:
-        instData = the_dict['instructor']
-        inst = parse_incoming_instructor(instData)
-        if inst:
-            args['context__in'] = inst
-    
     # there's a default of true
     if not 'authoritative' in the_dict or str(the_dict['authoritative']).upper() == 'TRUE':
         args['authoritative'] = True   
 
-    limit = 0    
-    # If want results limited
-    if 'limit' in the_dict:
-        limit = int(the_dict['limit'])
-   
-    sparse = True    
-    # If want sparse results
-    if 'sparse' in the_dict:
-        # If sparse input as string
-        if not type(the_dict['sparse']) is bool:
-            if the_dict['sparse'].lower() == 'false':
-                sparse = False
-        else:
-            sparse = the_dict['sparse']
-
     # Set stored param based on ascending
     if ascending:
         stored_param = 'stored'
     else:
         stored_param = '-stored'        
+    return args, stored_param
 
-    stmt_list = retrieve_stmts_from_db(the_dict, limit, stored_param, args)
-    full_stmt_list = []
-
-    # For each stmt convert to our Statement class and retrieve all json
-    for stmt in stmt_list:
-        full_stmt_list.append(stmt.object_return(sparse, language))
-    return full_stmt_list
-
-def create_cache_key(stmt_list):
-    # Create unique hash data to use for the cache key
-    hash_data = []
-    hash_data.append(str(datetime.now()))
-    hash_data.append(str(stmt_list))
-
-    # Create cache key from hashed data (always 32 digits)
-    key = hashlib.md5(bencode.bencode(hash_data)).hexdigest()
-    return key
-
-def initial_cache_return(stmt_list, encoded_list, req_dict, limit):
-    # First time someone queries POST/GET
-    result = {}
-    stmt_pager = Paginator(stmt_list, limit)
- 
-    cache_list = []
-    
-    # Always going to start on page 1
-    current_page = 1
-    total_pages = stmt_pager.num_pages
-    # Create cache key from hashed data (always 32 digits)
-    cache_key = create_cache_key(stmt_list)
-
-    # Add data to cache
-    cache_list.append(req_dict)
-    cache_list.append(current_page)
-    cache_list.append(total_pages)
-    cache_list.append(limit)
-
-    # Encode data
-    encoded_info = pickle.dumps(cache_list)
-
-    # Save encoded_dict in cache
-    cache.set(cache_key,encoded_info)
-    # Return first page of results
-    stmts = stmt_pager.page(1).object_list
-    result['statements'] = stmts
-    result['more'] = MORE_ENDPOINT + cache_key        
-    return result
+def complex_get(req_dict):
+    # Parse out params into single dict
+    the_dict = get_query_dict(req_dict)
+    args, stored_param = get_query_args(the_dict)
+
+    # Nothing is evaluated here, the page is sliced out of the queryset in stream_statement_result
+    return retrieve_stmts_from_db(the_dict, get_limit(req_dict), stored_param, args, get_filters(the_dict))
+
+def archive_get(req_dict):
+    # The archived statements matching the query, or None when since doesn't reach back past
+    # the newest archived statement
+    the_dict = get_query_dict(req_dict)
+    args, stored_param = get_query_args(the_dict)
+    newest = models.statement_archive.objects.aggregate(Max('stored'))['stored__max']
+    if newest is None or ('stored__gt' in args and args['stored__gt'] >= newest):
+        return None
+    return retrieve_stmts_from_db(the_dict, get_limit(req_dict), stored_param, args,
+        get_filters(the_dict, archive=True), models.statement_archive)
+
+def after_cursor(stmt_set, ascending, cursor=None):
+    # Continue after the last (stored, id) pair that was returned
+    if cursor:
+        stored, stmt_pk = cursor
+        if ascending:
+            stmt_set = stmt_set.filter(Q(stored__gt=stored) | Q(stored=stored, id__gt=stmt_pk))
+        else:
+            stmt_set = stmt_set.filter(Q(stored__lt=stored) | Q(stored=stored, id__lt=stmt_pk))
+    return stmt_set
+
+def normalize_query(req_dict, limit):
+    # Only the xAPI query params and language go in the cursor - never the auth, user or raw body
+    the_dict = get_query_dict(req_dict)
+    query = dict((k, the_dict[k]) for k in QUERY_PARAMS if k in the_dict)
+    query['limit'] = limit
+    if req_dict.get('language', None):
+        query['language'] = req_dict['language']
+    return query
+
+def create_more_token(query, cursor):
+    stored, stmt_pk = cursor
+    # Stored is always UTC in the DB
+    data = {'query': query, 'cursor': [stored.strftime(CURSOR_TIME_FORMAT), stmt_pk]}
+    # Compact, url-safe and HMAC signed with the SECRET_KEY so any node can verify it
+    return signing.dumps(data, salt=MORE_TOKEN_SALT, compress=True)
+
+def load_more_token(token):
+    data = signing.loads(token, salt=MORE_TOKEN_SALT, max_age=settings.STMT_MORE_TIMEOUT)
+    stored = pytz.timezone("UTC").localize(datetime.strptime(data['cursor'][0], CURSOR_TIME_FORMAT))
+    return data['query'], (stored, data['cursor'][1])
 
 def get_statement_request(req_id):  
-    # Retrieve encoded info for statements
-    encoded_info = cache.get(req_id)
-
-    # Could have expired or never existed
-    if not encoded_info:
-        return ['List does not exist - may have expired after 24 hours']
-
-    # Decode info
-    decoded_info = pickle.loads(encoded_info)
-
-    # Info is always cached as [query_dict, start_page, total_pages, limit]
-    query_dict = decoded_info[0]
-    start_page = decoded_info[1]
-    limit = decoded_info[3]
-
-    #Build list from query_dict
-    stmt_list = complex_get(query_dict)
-
-    # Build statementResult
-    stmt_result = build_statement_result(query_dict, stmt_list, req_id)
-    return stmt_result
-
-def build_statement_result(req_dict, stmt_list, more_id=None):
-    result = {}
-    limit = None
-    # Get length of stmt list
-    statement_amount = len(stmt_list)  
-    # See if something is already stored in cache
-    encoded_list = cache.get(more_id)
-    # If there is a more_id (means this is being called from get_statement_request) this is not the initial request (someone is pinging the 'more' link)
-    if more_id:
-        more_cache_list = []
-        # Get query_info and there should always be an encoded_list if there is a more_id
-        query_info = pickle.loads(encoded_list)
-        # Get page info 
-        start_page = query_info[1]
-        total_pages = query_info[2]
-        limit = query_info[3]
-        current_page = start_page + 1
-        # If that was the last page to display then just return the remaining stmts
-        if current_page == total_pages:
-            stmt_pager = Paginator(stmt_list, limit)
-            result['statements'] = stmt_pager.page(current_page).object_list
-            result['more'] = ''
-            # Set current page back for when someone hits the URL again
-            query_info[1] = query_info[1] - 1
-            encoded_list = pickle.dumps(query_info)
-            cache.set(more_id, encoded_list)
-            return result
-        # There are more pages to display
-        else:
-            stmt_pager = Paginator(stmt_list, limit)
-            # Create cache key from hashed data (always 32 digits)
-            cache_key = create_cache_key(stmt_list)
-            # Set result to have selected page of stmts and more endpoing
-            result['statements'] = stmt_pager.page(current_page).object_list
-            result['more'] = MORE_ENDPOINT + cache_key
-            more_cache_list = []
-            # Increment next page
-            start_page = query_info[1] + 1
-            more_cache_list.append(req_dict)
-            more_cache_list.append(start_page)
-            more_cache_list.append(query_info[2])
-            more_cache_list.append(limit)
-            # Encode info
-            encoded_list = pickle.dumps(more_cache_list)
-            cache.set(cache_key, encoded_list)
-            return result
-    # If get to here, this is on the initial request
-    # List will only be larger first time of more URLs.
-    if not limit:
-        try:
-            limit = int(req_dict['limit'])
-        except KeyError:
-            try:
-                bdy = req_dict['body']
-                if isinstance(bdy, basestring):
-                    try:
-                        bdy = ast.literal_eval(bdy)
-                    except:
-                        bdy = json.loads(bdy)
-                limit = int(bdy['limit'])
-            except:
-                limit = None
-        if not limit or limit > settings.SERVER_STMT_LIMIT:
-            limit = settings.SERVER_STMT_LIMIT
-
-    # If there are more than the limit, build the initial return
-    if statement_amount > limit:
-        result = initial_cache_return(stmt_list, encoded_list, req_dict, limit)
-    # Just provide statements since the list is under the limit
+    # Verify and decode the more token
+    try:
+        query_dict, cursor = load_more_token(req_id)
+    except signing.BadSignature:
+        # Could have expired, been tampered with or never existed
+        return [json.dumps(['List does not exist - may have expired after 24 hours'])]
+
+    # Build queryset from query_dict
+    stmt_set = complex_get(query_dict)
+
+    # Stream the statementResult starting after the cursor
+    return stream_statement_result(query_dict, stmt_set, cursor)
+
+def read_rows(stmt_sets, count):
+    # Reads up to count rows across the querysets in order. A callable is only called for its
+    # queryset (or None to skip it) once the ones before it run out
+    for stmt_set in stmt_sets:
+        if callable(stmt_set):
+            stmt_set = stmt_set()
+        if stmt_set is None or count <= 0:
+            continue
+        # Don't let the queryset cache rows (an empty queryset slices to a plain list)
+        rows = stmt_set[:count]
+        if hasattr(rows, 'iterator'):
+            rows = rows.iterator()
+        for row in rows:
+            count -= 1
+            yield row
+
+def stream_statement_result(req_dict, stmt_set, cursor=None):
+    # Writes the statementResult out a chunk of statements at a time straight off of the DB
+    # cursor. More goes last since it isn't known until the page has been read
+    the_dict = get_query_dict(req_dict)
+    limit = get_limit(req_dict)
+
+    language = req_dict.get('language', None)
+    sparse = is_sparse(the_dict)
+
+    # Everything archived was stored before anything left in the statement table, so the archive
+    # comes first going up and is only read once the statement table runs out going down
+    ascending = is_ascending(the_dict)
+    stmt_sets = [after_cursor(stmt_set, ascending, cursor)]
+    def get_archived():
+        archived = archive_get(req_dict)
+        if archived is not None:
+            archived = after_cursor(archived, ascending, cursor)
+        return archived
+    if ascending:
+        stmt_sets.insert(0, get_archived)
     else:
-        result['statements'] = stmt_list
-        result['more'] = ''
-    return result
\ No newline at end of file
+        stmt_sets.append(get_archived)
+
+    # Fetch one extra row to know if there is another page
+    rows = read_rows(stmt_sets, limit + 1)
+
+    def render(chunk, first):
+        return ('' if first else ', ') + ', '.join(statement_cache.get_statements_json(chunk, sparse, language))
+
+    yield '{"statements": ['
+    count = 0
+    last = None
+    has_more = False
+    chunk = []
+    for stmt in rows:
+        if count == limit:
+            has_more = True
+            break
+        chunk.append(stmt)
+        count += 1
+        last = stmt
+        if len(chunk) == STREAM_CHUNK_SIZE:
+            yield render(chunk, count == len(chunk))
+            chunk = []
+    if chunk:
+        yield render(chunk, count == len(chunk))
+
+    # If there are more than the limit, the more link continues from the last stmt returned
+    more = ''
+    if has_more:
+        query = normalize_query(req_dict, limit)
+        more = MORE_ENDPOINT + create_more_token(query, (last.stored, last.id))
+    yield '], "more": %s}' % json.dumps(more)
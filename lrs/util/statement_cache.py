@@ -0,0 +1,100 @@
+from collections import OrderedDict
+from django.conf import settings
+from django.core.cache import get_cache
+from lrs import models
+from lrs.util.hydrator import StatementHydrator
+import hashlib
+import json
+import threading
+
+class RenderedStatementCache():
+    # LRU of rendered statement JSON by (statement_id, variant). Every variant takes a place, the
+    # languages and formats come from clients so one statement can't grow without bound. variants
+    # keeps the ones each statement has so they can be dropped together
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.variants = {}
+        self.lock = threading.Lock()
+
+    def get(self, stmt_id, variant):
+        with self.lock:
+            rendered = self.entries.pop((stmt_id, variant), None)
+            if rendered is not None:
+                self.entries[(stmt_id, variant)] = rendered
+            return rendered
+
+    def set(self, stmt_id, variant, rendered):
+        with self.lock:
+            self.entries.pop((stmt_id, variant), None)
+            self.entries[(stmt_id, variant)] = rendered
+            self.variants.setdefault(stmt_id, set()).add(variant)
+            while len(self.entries) > self.size:
+                old_id, old_variant = self.entries.popitem(last=False)[0]
+                self.discard(old_id, old_variant)
+
+    def discard(self, stmt_id, variant):
+        variants = self.variants.get(stmt_id, None)
+        if variants is not None:
+            variants.discard(variant)
+            if not variants:
+                del self.variants[stmt_id]
+
+    def invalidate(self, stmt_ids):
+        with self.lock:
+            for stmt_id in stmt_ids:
+                for variant in self.variants.pop(stmt_id, ()):
+                    self.entries.pop((stmt_id, variant), None)
+
+rendered_statements = RenderedStatementCache(settings.STMT_CACHE_SIZE)
+
+def get_shared_cache():
+    if settings.STMT_SHARED_CACHE:
+        return get_cache(settings.STMT_SHARED_CACHE)
+    return None
+
+def get_shared_key(stmt_id, variant):
+    # Statement ids and languages aren't always safe to use as cache keys
+    return 'stmt_json:%s' % hashlib.sha1(repr((stmt_id, variant))).hexdigest()
+
+def get_variant(stmt, sparse, lang):
+    # The row id, stored time and voided are part of the key so a statement that was voided,
+    # unvoided or deleted and reissued by another process is never served from a stale entry
+    return (stmt.id, str(stmt.stored), stmt.voided, sparse, lang)
+
+def get_statements_json(stmts, sparse=False, lang=None):
+    # The rendered JSON of each statement. The ones that aren't cached are hydrated together, so a
+    # page of them costs the same few queries as one
+    keys = [(unicode(stmt.statement_id), get_variant(stmt, sparse, lang)) for stmt in stmts]
+    rendered = [rendered_statements.get(stmt_id, variant) for stmt_id, variant in keys]
+    shared = get_shared_cache()
+    missing = [i for i, r in enumerate(rendered) if r is None]
+    if shared:
+        for i in missing:
+            rendered[i] = shared.get(get_shared_key(*keys[i]))
+            if rendered[i] is not None:
+                rendered_statements.set(keys[i][0], keys[i][1], rendered[i])
+        missing = [i for i in missing if rendered[i] is None]
+    if not missing:
+        return rendered
+
+    # Archived statements only have their snapshot
+    live = [stmts[i] for i in missing if not isinstance(stmts[i], models.statement_archive)]
+    hydrator = StatementHydrator(live) if live else None
+    for i in missing:
+        stmt = stmts[i]
+        if isinstance(stmt, models.statement_archive):
+            rendered[i] = json.dumps(stmt.object_return(sparse, lang))
+        else:
+            rendered[i] = json.dumps(hydrator.get_statement_json(stmt, sparse, lang))
+        if shared:
+            shared.set(get_shared_key(*keys[i]), rendered[i])
+        rendered_statements.set(keys[i][0], keys[i][1], rendered[i])
+    return rendered
+
+def get_statement_json(stmt, sparse=False, lang=None):
+    return get_statements_json([stmt], sparse, lang)[0]
+
+def invalidate(stmt_ids):
+    # Shared entries can't go stale (see get_statement_json) so they're left to expire
+    rendered_statements.invalidate([unicode(stmt_id) for stmt_id in stmt_ids])
@@ -0,0 +1,155 @@
+from datetime import datetime
+from django.db import IntegrityError, transaction
+from django.db.models import F, Sum
+from lrs import models
+from lrs.exceptions import ParamError
+from lrs.util import activity_resolver, before_commit, retrieve_statement
+
+ROLLUP_FIELDS = ('day', 'verb', 'activity', 'authority')
+DAY_FORMAT = '%Y-%m-%d'
+# Keeps bulk inserts under sqlite's limit on query variables
+INSERT_BATCH_SIZE = 100
+
+def get_key(stmt):
+    # Works for statements and archived statements - the archive holds the pks as plain integers.
+    # The object is only the rollup's activity if it is one, see get_activity_keys
+    if isinstance(stmt, models.statement_archive):
+        verb_pk, object_pk, authority_pk = stmt.verb, stmt.stmt_object, stmt.authority
+    else:
+        verb_pk, object_pk, authority_pk = stmt.verb_id, stmt.stmt_object_id, stmt.authority_id
+    # Stored is always UTC in the DB
+    return (stmt.stored.date(), verb_pk, object_pk, authority_pk or 0)
+
+def get_activity_keys(deltas):
+    # Activities share their pk with the statement_object row the statement points at, one query
+    # finds which of the objects are
+    object_pks = list(set(key[2] for key in deltas))
+    activity_pks = set()
+    for i in range(0, len(object_pks), INSERT_BATCH_SIZE):
+        activity_pks.update(models.activity.objects.filter(
+            pk__in=object_pks[i:i + INSERT_BATCH_SIZE]).values_list('pk', flat=True))
+    ret = {}
+    for (day, verb_pk, object_pk, authority_pk), delta in deltas.items():
+        key = (day, verb_pk, object_pk if object_pk in activity_pks else 0, authority_pk)
+        ret[key] = ret.get(key, 0) + delta
+    return ret
+
+class RollupDeltas(dict):
+    # How much each rollup changes in a transaction. Each is written once just before it commits,
+    # in key order, so the row locks are held briefly and concurrent transactions take them in
+    # the same order
+    def __call__(self):
+        deltas = get_activity_keys(self)
+        for key in sorted(deltas):
+            if deltas[key]:
+                apply_delta(dict(zip(ROLLUP_FIELDS, key)), deltas[key])
+
+def count_statement(stmt, delta):
+    # Runs in the caller's transaction so the counts commit or roll back with the statement
+    key = get_key(stmt)
+    deltas = before_commit(__name__, RollupDeltas)
+    if deltas is None:
+        deltas = RollupDeltas({key: delta})
+        deltas()
+    else:
+        deltas[key] = deltas.get(key, 0) + delta
+
+def apply_delta(key, delta):
+    rollups = models.statement_rollup.objects.filter(**key)
+    if rollups.update(count=F('count') + delta) or delta < 0:
+        # Nothing to take it off of when it was stored before the rollups were built
+        return
+    sid = transaction.savepoint()
+    try:
+        models.statement_rollup.objects.create(count=delta, **key)
+        transaction.savepoint_commit(sid)
+    except IntegrityError:
+        # Another request created the row first
+        transaction.savepoint_rollback(sid)
+        rollups.update(count=F('count') + delta)
+
+def statement_deleted(stmt):
+    # Archiving deletes statements too, those are still counted
+    if not stmt.voided and not models.statement_archive.objects.filter(id=stmt.id).exists():
+        count_statement(stmt, -1)
+
+@transaction.commit_on_success
+def rebuild():
+    # Recounts every unvoided statement, archived or not. Returns how many rollups there are now
+    activity_pks = set(models.activity.objects.values_list('pk', flat=True))
+    counts = {}
+    for model in (models.statement_archive, models.statement):
+        rows = model.objects.exclude(voided=True).values_list('stored', 'verb', 'stmt_object', 'authority')
+        for stored, verb_pk, object_pk, authority_pk in rows.iterator():
+            key = (stored.date(), verb_pk, object_pk if object_pk in activity_pks else 0, authority_pk or 0)
+            counts[key] = counts.get(key, 0) + 1
+
+    models.statement_rollup.objects.all().delete()
+    rollups = [models.statement_rollup(count=count, **dict(zip(ROLLUP_FIELDS, key)))
+        for key, count in counts.iteritems()]
+    for i in range(0, len(rollups), INSERT_BATCH_SIZE):
+        models.statement_rollup.objects.bulk_create(rollups[i:i + INSERT_BATCH_SIZE])
+    return len(rollups)
+
+def parse_day(value):
+    try:
+        return datetime.strptime(value, DAY_FORMAT).date()
+    except (TypeError, ValueError):
+        raise ParamError("Rollup days must look like YYYY-MM-DD, received %s" % value)
+
+def get_group_fields(the_dict):
+    # by is a comma separated list of the fields to keep, the counts are summed over the rest
+    if 'by' not in the_dict:
+        return ROLLUP_FIELDS
+    fields = [f.strip() for f in the_dict['by'].split(',') if f.strip()]
+    unknown = [f for f in fields if f not in ROLLUP_FIELDS]
+    if unknown:
+        raise ParamError("Rollups can only be grouped by %s, received %s" % (', '.join(ROLLUP_FIELDS),
+            ', '.join(unknown)))
+    return tuple(f for f in ROLLUP_FIELDS if f in fields)
+
+def get_rollups(the_dict):
+    fields = get_group_fields(the_dict)
+    rollups = models.statement_rollup.objects.filter(count__gt=0)
+    if 'since' in the_dict:
+        rollups = rollups.filter(day__gte=parse_day(the_dict['since']))
+    if 'until' in the_dict:
+        rollups = rollups.filter(day__lte=parse_day(the_dict['until']))
+    if 'verb' in the_dict:
+        rollups = rollups.filter(verb__in=list(models.Verb.objects.filter(
+            verb_id=the_dict['verb']).values_list('pk', flat=True)))
+    if 'activity' in the_dict:
+        rollups = rollups.filter(activity__in=activity_resolver.resolve(the_dict['activity']))
+    if 'authority' in the_dict:
+        authorities = retrieve_statement.agent_filter(the_dict['authority'])
+        if authorities is None:
+            return []
+        rollups = rollups.filter(authority__in=authorities)
+
+    if not fields:
+        return [{'count': rollups.aggregate(total=Sum('count'))['total'] or 0}]
+    rows = list(rollups.values(*fields).annotate(total=Sum('count')).order_by(*fields))
+
+    # One query per kind of object to turn the pks back into IRIs and agents
+    verbs = models.Verb.objects.in_bulk(set(r['verb'] for r in rows)) if 'verb' in fields else {}
+    activities = models.activity.objects.in_bulk(set(r['activity'] for r in rows if r['activity'])) \
+        if 'activity' in fields else {}
+    authorities = models.agent.objects.in_bulk(set(r['authority'] for r in rows if r['authority'])) \
+        if 'authority' in fields else {}
+
+    ret = []
+    for row in rows:
+        rollup = {'count': row['total']}
+        if 'day' in fields:
+            rollup['day'] = row['day'].strftime(DAY_FORMAT)
+        if 'verb' in fields:
+            verb = verbs.get(row['verb'], None)
+            rollup['verb'] = verb and verb.verb_id
+        if 'activity' in fields:
+            act = activities.get(row['activity'], None)
+            rollup['activity'] = act and act.activity_id
+        if 'authority' in fields:
+            authority = authorities.get(row['authority'], None)
+            rollup['authority'] = authority and authority.get_agent_json()
+        ret.append(rollup)
+    return ret
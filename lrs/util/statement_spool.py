@@ -0,0 +1,167 @@
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.exceptions import ObjectDoesNotExist, ValidationError
+from lrs import exceptions, models
+from lrs.objects import Statement
+from lrs.util import commit_on_success_unless_managed, log_message, update_parent_log_status
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+
+# Each POST or PUT is one spool entry, saved in one transaction like any batch
+SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS spool (seq INTEGER PRIMARY KEY AUTOINCREMENT, body TEXT NOT NULL, '
+        'auth_model TEXT, auth_id INTEGER, accepted REAL NOT NULL, error TEXT)',
+    'CREATE TABLE IF NOT EXISTS spool_statement (statement_id TEXT PRIMARY KEY, seq INTEGER NOT NULL)',
+    'CREATE INDEX IF NOT EXISTS spool_statement_seq ON spool_statement (seq)',
+)
+ACCEPTED = 'accepted'
+FAILED = 'failed'
+POLL_INTERVAL = 0.1
+# What the statements themselves are to blame for - saving them again won't go any better. Anything
+# else (the database being down) leaves the entry where it is to be tried again
+REJECTED = (exceptions.BadRequest, exceptions.Unauthorized, exceptions.Forbidden, exceptions.NotFound,
+    exceptions.Conflict, ObjectDoesNotExist, ValidationError)
+
+local = threading.local()
+
+def get_connection():
+    # sqlite connections can't be shared between threads or carried across a fork
+    path = settings.STMT_SPOOL_PATH
+    conn = getattr(local, 'conn', None)
+    if conn is None or local.pid != os.getpid() or local.path != path:
+        # Autocommit, transactions are started explicitly
+        conn = sqlite3.connect(path, timeout=30, isolation_level=None)
+        conn.execute('PRAGMA journal_mode=WAL')
+        # An entry is on disk before its ids are handed back
+        conn.execute('PRAGMA synchronous=FULL')
+        for sql in SCHEMA:
+            conn.execute(sql)
+        local.conn, local.pid, local.path = conn, os.getpid(), path
+    return conn
+
+def dump_auth(auth):
+    if auth is None:
+        return None, None
+    if isinstance(auth, User):
+        return 'user', auth.pk
+    return 'group', auth.pk
+
+def load_auth(auth_model, auth_id):
+    if auth_model == 'user':
+        return User.objects.get(pk=auth_id)
+    elif auth_model == 'group':
+        return models.group.objects.get(pk=auth_id)
+    return None
+
+def enqueue(stmts_data, auth=None, log_dict=None):
+    # Checks the statements the way a batch is checked before it's saved, gives the ones without
+    # an id one and appends them to the spool as one entry. An entry that failed to save gives up
+    # its ids to statements sent again with them. Returns the statement ids
+    stmts_data = Statement.validate_batch(stmts_data, log_dict)
+    for stmt_data in stmts_data:
+        if 'statement_id' not in stmt_data:
+            stmt_data['statement_id'] = str(uuid.uuid4())
+    stmt_ids = [str(s['statement_id']) for s in stmts_data]
+    auth_model, auth_id = dump_auth(auth)
+
+    conn = get_connection()
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        failed = set()
+        for stmt_id in stmt_ids:
+            failed.update(seq for (seq,) in conn.execute('SELECT spool.seq FROM spool_statement JOIN spool ON '
+                'spool.seq = spool_statement.seq WHERE spool_statement.statement_id = ? AND spool.error IS NOT NULL',
+                (stmt_id,)))
+        for seq in failed:
+            delete_entry(conn, seq)
+        cursor = conn.execute('INSERT INTO spool (body, auth_model, auth_id, accepted) VALUES (?, ?, ?, ?)',
+            (json.dumps(stmts_data), auth_model, auth_id, time.time()))
+        conn.executemany('INSERT INTO spool_statement (statement_id, seq) VALUES (?, ?)',
+            [(stmt_id, cursor.lastrowid) for stmt_id in stmt_ids])
+        conn.execute('COMMIT')
+    except sqlite3.IntegrityError:
+        conn.execute('ROLLBACK')
+        err_msg = "A Statement ID in %s is already waiting to be saved" % ', '.join(stmt_ids)
+        log_message(log_dict, err_msg, __name__, enqueue.__name__, True)
+        update_parent_log_status(log_dict, 409)
+        raise exceptions.ParamConflict(err_msg)
+    except:
+        conn.execute('ROLLBACK')
+        raise
+    return stmt_ids
+
+def get_state(statement_id):
+    # (ACCEPTED, None) while a statement waits to be saved, (FAILED, error) if saving it failed
+    # and None when it isn't in the spool
+    if not os.path.exists(settings.STMT_SPOOL_PATH):
+        return None
+    row = get_connection().execute('SELECT spool.error FROM spool_statement JOIN spool ON '
+        'spool.seq = spool_statement.seq WHERE spool_statement.statement_id = ?', (statement_id,)).fetchone()
+    if row is None:
+        return None
+    return (FAILED, row[0]) if row[0] else (ACCEPTED, None)
+
+def wait(statement_id, seconds):
+    # Polls until the statement leaves the spool, fails or seconds run out, returns the last state
+    give_up = time.time() + min(seconds, settings.STMT_SPOOL_MAX_WAIT)
+    state = get_state(statement_id)
+    while state and state[0] == ACCEPTED and time.time() < give_up:
+        time.sleep(POLL_INTERVAL)
+        state = get_state(statement_id)
+    return state
+
+def delete_entry(conn, seq):
+    conn.execute('DELETE FROM spool_statement WHERE seq = ?', (seq,))
+    conn.execute('DELETE FROM spool WHERE seq = ?', (seq,))
+
+def remove(conn, seq):
+    conn.execute('BEGIN IMMEDIATE')
+    try:
+        delete_entry(conn, seq)
+        conn.execute('COMMIT')
+    except:
+        conn.execute('ROLLBACK')
+        raise
+
+def get_entry_key(seq, accepted):
+    # seq starts over when the spool file is replaced, the time it was accepted tells them apart
+    return '%d:%r' % (seq, accepted)
+
+@commit_on_success_unless_managed
+def save_entry(entry, stmts_data, auth):
+    Statement.save_batch(stmts_data, auth=auth)
+    models.spooled_batch.objects.create(entry=entry)
+
+def process_next():
+    # Saves the oldest entry that hasn't failed, in the order they were accepted so voids and
+    # statement refs find what they point at. Returns False when there's nothing left to save,
+    # raises when the entry couldn't be saved for a reason other than the statements in it
+    conn = get_connection()
+    row = conn.execute('SELECT seq, body, auth_model, auth_id, accepted FROM spool WHERE error IS NULL '
+        'ORDER BY seq LIMIT 1').fetchone()
+    if row is None:
+        return False
+    seq, body, auth_model, auth_id, accepted = row
+    entry = get_entry_key(seq, accepted)
+
+    # Saved already by a worker that stopped before it could take the entry out. Ids someone
+    # else took in the meantime fail the save below as a conflict
+    if not models.spooled_batch.objects.filter(entry=entry).exists():
+        try:
+            save_entry(entry, json.loads(body), load_auth(auth_model, auth_id))
+        except REJECTED, e:
+            # Kept with its error so reads can report it, the entries after it carry on
+            conn.execute('UPDATE spool SET error = ? WHERE seq = ?', (unicode(e) or e.__class__.__name__, seq))
+            return True
+    remove(conn, seq)
+    # Never needed again once the entry is gone
+    models.spooled_batch.objects.filter(entry=entry).delete()
+    return True
+
+def retry_failed():
+    # Clears the errors so the failed entries are tried again, returns how many there were
+    return get_connection().execute('UPDATE spool SET error = NULL WHERE error IS NOT NULL').rowcount
@@ -0,0 +1,121 @@
+from collections import OrderedDict
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.core.cache import get_cache
+from lrs import models
+from lrs.util import on_commit
+import hashlib
+import threading
+import uuid
+
+class VerbRegistry():
+    # LRU of verb IRI -> (pk, display map, stamp). The stamp is the verb's version in the shared
+    # cache when it was loaded - whoever changes the verb replaces it, so every process reloads
+    # the verb the next time a statement uses it
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, verb_id):
+        with self.lock:
+            entry = self.entries.pop(verb_id, None)
+            if entry is not None:
+                self.entries[verb_id] = entry
+            return entry
+
+    def set(self, verb_id, entry):
+        with self.lock:
+            self.entries.pop(verb_id, None)
+            self.entries[verb_id] = entry
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, verb_id):
+        with self.lock:
+            self.entries.pop(verb_id, None)
+
+verbs = VerbRegistry(settings.VERB_CACHE_SIZE)
+# Without a version cache nothing is remembered past the transaction, every process could be
+# using a display another one has changed
+stamps = get_cache(settings.VERB_VERSION_CACHE) if settings.VERB_VERSION_CACHE else None
+
+def get_stamp_key(verb_id):
+    # Verb IRIs aren't always safe to use as cache keys
+    return 'verb_version:%s' % hashlib.sha1(verb_id.encode('utf-8')).hexdigest()
+
+def get_stamp(verb_id):
+    # None when there's no version cache
+    if stamps is None:
+        return None
+    key = get_stamp_key(verb_id)
+    stamp = stamps.get(key)
+    if stamp is None:
+        # Evicted or never set, every process reloads the verb once
+        stamps.add(key, uuid.uuid4().hex)
+        stamp = stamps.get(key)
+    return stamp
+
+def bump_stamp(verb_id):
+    if stamps is None:
+        return None
+    stamp = uuid.uuid4().hex
+    stamps.set(get_stamp_key(verb_id), stamp)
+    verbs.invalidate(verb_id)
+    return stamp
+
+def is_current(entry, display, stamp):
+    # Only the languages the statement sends are compared, it doesn't remove the others
+    return entry is not None and entry[2] == stamp and \
+        all(entry[1].get(key, None) == value for key, value in display.items())
+
+def get_verb(verb_id, display, pending=None):
+    # The verb's pk, with the display languages merged into the ones it has. Costs no queries when
+    # this process already has the verb and nothing changed. pending holds the verbs loaded in the
+    # transaction the caller is running in, they're only registered once it commits
+    stamp = get_stamp(verb_id)
+    entry = pending.get(verb_id, None) if pending is not None else None
+    if entry is None:
+        entry = verbs.get(verb_id) if stamps is not None else None
+    elif entry[2] != stamp:
+        # Changed by someone else - drop it so it's reloaded below
+        entry = None
+    if is_current(entry, display, stamp):
+        return entry[0]
+
+    verb, created = models.Verb.objects.get_or_create(verb_id=verb_id)
+    verb_type = ContentType.objects.get_for_model(models.Verb)
+    lang_maps = models.LanguageMap.objects.filter(content_type=verb_type, object_id=verb.pk)
+    existing = {} if created else dict(lang_maps.values_list('key', 'value'))
+
+    # Write only the languages that are new or changed
+    changed = dict((key, value) for key, value in display.items() if existing.get(key, None) != value)
+    for key, value in changed.items():
+        if key in existing:
+            lang_maps.filter(key=key).update(value=value)
+    added = [models.LanguageMap(key=key, value=value, content_type=verb_type, object_id=verb.pk)
+        for key, value in changed.items() if key not in existing]
+    if added:
+        models.LanguageMap.objects.bulk_create(added)
+    existing.update(changed)
+
+    entry = (verb.pk, existing, stamp)
+    if pending is not None:
+        pending[verb_id] = entry
+
+    def register():
+        # A verb that changed gets a new stamp, which the other processes won't have
+        registered = (verb.pk, existing, bump_stamp(verb_id) if created or changed else stamp)
+        verbs.set(verb_id, registered)
+    if stamps is not None:
+        on_commit(register)
+    return verb.pk
+
+def verb_changed(verb_id):
+    bump_stamp(verb_id)
+
+def lang_map_changed(instance):
+    # Descriptions of activities and their interactions are language maps too
+    if instance.content_type_id == ContentType.objects.get_for_model(models.Verb).id:
+        for verb_id in models.Verb.objects.filter(pk=instance.object_id).values_list('verb_id', flat=True):
+            verb_changed(verb_id)
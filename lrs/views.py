@@ -7,7 +7,6 @@ from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
-from django.core.paginator import Paginator, EmptyPage, PageNotAnInteger
 from django.db.models import Q
 from django.shortcuts import render_to_response
 from django.utils.decorators import decorator_from_middleware
@@ -237,7 +236,18 @@ def my_statements(request):
         else:
             s = {}
             slist = []
-            for stmt in models.statement.objects.filter(user=request.user).order_by('-timestamp'):
+            page_no = request.GET.get('page', 1)
+            try:
+                page_no = max(int(page_no), 1)
+            except ValueError:
+                # If page is not an integer, deliver first page.
+                page_no = 1
+
+            # Fetch one extra stmt to know if there's a next page instead of counting them all
+            start = (page_no - 1) * settings.STMTS_PER_PAGE
+            stmts = list(models.statement.objects.filter(user=request.user).select_related('actor', 'verb',
+                'stmt_object').order_by('-timestamp', '-id')[start:start + settings.STMTS_PER_PAGE + 1])
+            for stmt in stmts[:settings.STMTS_PER_PAGE]:
                 d = {}
                 d['timestamp'] = stmt.timestamp.isoformat()
                 d['statement_id'] = stmt.statement_id
@@ -246,24 +256,12 @@ def my_statements(request):
                 stmtobj, otype = stmt.get_stmt_object()
                 d['object'] = stmtobj.get_a_name()
                 slist.append(d)
-            
-            paginator = Paginator(slist, settings.STMTS_PER_PAGE)
 
-            page_no = request.GET.get('page', 1)
-            try:
-                page = paginator.page(page_no)
-            except PageNotAnInteger:
-                # If page is not an integer, deliver first page.
-                page = paginator.page(1)
-            except EmptyPage:
-                # If page is out of range (e.g. 9999), deliver last page of results.
-                page = paginator.page(paginator.num_pages)
-
-            s['stmts'] = page.object_list
-            if page.has_previous():
-                s['previous'] = "%s?page=%s" % (reverse('lrs.views.my_statements'), page.previous_page_number())
-            if page.has_next():
-                s['next'] = "%s?page=%s" % (reverse('lrs.views.my_statements'), page.next_page_number())
+            s['stmts'] = slist
+            if page_no > 1:
+                s['previous'] = "%s?page=%s" % (reverse('lrs.views.my_statements'), page_no - 1)
+            if len(stmts) > settings.STMTS_PER_PAGE:
+                s['next'] = "%s?page=%s" % (reverse('lrs.views.my_statements'), page_no + 1)
             return HttpResponse(json.dumps(s), mimetype="application/json", status=200)
     except Exception as e:
         return HttpResponse(e, status=400)
@@ -304,14 +302,19 @@ def logout_view(request):
 # Called when user queries GET statement endpoint and returned list is larger than server limit (10)
 @decorator_from_middleware(TCAPIversionHeaderMiddleware.TCAPIversionHeaderMiddleware)
 def statements_more(request, more_id):
+    # Streamed out a statement at a time
     statementResult = retrieve_statement.get_statement_request(more_id) 
-    return HttpResponse(json.dumps(statementResult),mimetype="application/json",status=200)
+    return HttpResponse(statementResult,mimetype="application/json",status=200)
 
 @require_http_methods(["PUT","GET","POST"])
 # @decorator_from_middleware(TCAPIversionHeaderMiddleware.TCAPIversionHeaderMiddleware)
 def statements(request):
     return handle_request(request)   
 
+@require_GET
+def statement_rollups(request):
+    return handle_request(request)
+
 @require_http_methods(["PUT","POST","GET","DELETE"])
 @decorator_from_middleware(TCAPIversionHeaderMiddleware.TCAPIversionHeaderMiddleware)
 def activity_state(request):
@@ -382,6 +385,9 @@ validators = {
         "GET" : req_validate.statements_get,
         "PUT" : req_validate.statements_put
     },
+    reverse(statement_rollups) : {
+        "GET" : req_validate.statement_rollups_get
+    },
     reverse(activity_state) : {
         "PUT" : req_validate.activity_state_put,
         "GET" : req_validate.activity_state_get,
@@ -411,6 +417,9 @@ processors = {
         "GET" : req_process.statements_get,
         "PUT" : req_process.statements_put
     },
+    reverse(statement_rollups) : {
+        "GET" : req_process.statement_rollups_get
+    },
     reverse(activity_state) : {
         "PUT" : req_process.activity_state_put,
         "GET" : req_process.activity_state_get,